@@ -30,9 +30,25 @@ by Benji York. It is not believed to share code with that package any longer.
 """
 
 __all__ = [
+    'capabilities',
     'connection',
     'constants',
+    'converters',
+    'endpoints',
     'errors',
+    'loadgen',
+    'metrics',
+    'parallel',
+    'pool',
+    'reserved',
+    'resilience',
+    'resultcache',
+    'routing',
+    'rowcodec',
+    'rows',
+    'spill',
+    'sql',
+    'trace',
     'types',
     ]
 
@@ -0,0 +1,316 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Capability profiles that describe the data source behind a connection.
+
+Setting up a new connection used to take several round trips to the server
+before the first query could be sent: the driver name was looked up, the
+data types were loaded and a number of attributes were set. Most of that
+information never changes for a given server and data source, so it is
+gathered once into a CapabilityProfile and cached. Later connections to the
+same server, port and connect string reuse the profile and skip the calls
+that it makes unnecessary.
+
+Profiles are cached in memory by default_cache. A CapabilityCache can also
+be given a file name, in which case profiles are saved there and shared
+between processes. If the server or data source is reconfigured, call
+invalidate() so the profile is gathered again on the next connection.
+"""
+
+import os
+import tempfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ctypes import *
+
+from odbtp.errors import *
+from odbtp.constants import *
+from odbtp.metrics import _ProcessLock
+
+odb = cdll.LoadLibrary('libodbtp.so')
+
+# Numeric attributes whose initial values are recorded in a profile, so that
+# setting one to the value it already has can be skipped.
+TUNED_ATTRIBUTES = (
+    ODB_ATTR_DESCRIBEPARAMS,
+    ODB_ATTR_FULLCOLINFO,
+    ODB_ATTR_CACHEPROCS,
+    ODB_ATTR_TRANSACTIONS,
+    ODB_ATTR_RIGHTTRIMTEXT,
+    ODB_ATTR_VARDATASIZE,
+    )
+
+class CapabilityProfile:
+    """What is known about the server and data source of a connection.
+    
+    The driver attribute is one of the ODB_DRIVER_* constants, txn_capable
+    and oic_level are the raw values of the ODB_ATTR_TXNCAPABLE and
+    ODB_ATTR_OICLEVEL attributes, and defaults maps each of the
+    TUNED_ATTRIBUTES to the value it had right after login.
+    """
+    def __init__(self, **values):
+        self.driver = ODB_DRIVER_UNKNOWN
+        self.driver_name = ''
+        self.driver_version = ''
+        self.dbms_name = ''
+        self.dbms_version = ''
+        self.txn_capable = 0
+        self.oic_level = 0
+        self.defaults = {}
+        self.__dict__.update(values)
+    
+    def __repr__(self):
+        return '<CapabilityProfile %s %s (%s)>' % (
+            self.dbms_name, self.dbms_version, self.driver_name
+            )
+    
+    def supports_transactions(self):
+        """Return True if transactions should be enabled for the driver.
+        """
+        if self.driver in (ODB_DRIVER_FOXPRO, ODB_DRIVER_JET):
+            return False
+        return self.txn_capable != 0
+    
+    def needs_data_types(self):
+        """Return True if user-defined data types should be loaded.
+        
+        User-defined data types are specific to SQL Server, so loading them
+        is a wasted round trip with any other driver.
+        """
+        return self.driver in (ODB_DRIVER_MSSQL, ODB_DRIVER_UNKNOWN)
+
+class CapabilityCache:
+    """A thread-safe cache of capability profiles.
+    
+    If filename is given, profiles are loaded from that file when the cache
+    is created and written back to it whenever a profile is added or
+    removed. The file is JSON, and is locked while it is rewritten, so
+    that processes sharing it keep each other's profiles. The connect
+    string is only stored as a hash, since it may contain a password.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._profiles = {}
+        self._lock = _ProcessLock()
+        if filename is not None and os.path.exists(filename):
+            self._profiles = self._load()
+    
+    def get(self, server, port, connect_string):
+        """Return the cached profile for a data source, or None.
+        """
+        key = _make_key(server, port, connect_string)
+        self._lock.acquire()
+        try:
+            profile = self._profiles.get(key)
+            if profile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return profile
+        finally:
+            self._lock.release()
+    
+    def store(self, server, port, connect_string, profile):
+        """Add or replace the profile for a data source.
+        """
+        key = _make_key(server, port, connect_string)
+        def change(profiles):
+            profiles[key] = profile
+        self._lock.acquire()
+        try:
+            self._update(change)
+        finally:
+            self._lock.release()
+    
+    def invalidate(self, server=None, port=None, connect_string=None):
+        """Forget cached profiles.
+        
+        With no arguments, every profile is removed. Otherwise only the
+        profiles matching all of the given arguments are removed.
+        """
+        if connect_string is not None:
+            connect_string = _hash(connect_string)
+        def change(profiles):
+            for key in profiles.keys():
+                if server is not None and key[0] != server:
+                    continue
+                if port is not None and key[1] != port:
+                    continue
+                if connect_string is not None and key[2] != connect_string:
+                    continue
+                del profiles[key]
+        self._lock.acquire()
+        try:
+            self._update(change)
+        finally:
+            self._lock.release()
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _update(self, change):
+        """Apply change() to the profiles, and to the cache file if any.
+        
+        The file is read again under an exclusive lock and change() is
+        applied to what it holds, so that profiles stored by other
+        processes since it was loaded are kept. It is then replaced
+        atomically, so that readers never see it half written.
+        """
+        if self.filename is None:
+            change(self._profiles)
+            return
+        lock = self._lock_file()
+        try:
+            profiles = self._load()
+            change(profiles)
+            self._save(profiles)
+            self._profiles = profiles
+        finally:
+            if lock is not None:
+                lock.close()
+    
+    def _lock_file(self):
+        if fcntl is None:
+            return None
+        lock = open(self.filename + '.lock', 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        except:
+            lock.close()
+            raise
+        return lock
+    
+    def _load(self):
+        """Read the profiles in the cache file.
+        
+        A missing or unreadable file holds no profiles: the cache is only
+        an optimization, and is rebuilt as data sources are profiled.
+        """
+        profiles = {}
+        try:
+            stream = open(self.filename, 'rb')
+        except IOError:
+            return profiles
+        try:
+            try:
+                saved = json.load(stream)
+            except ValueError:
+                return profiles
+        finally:
+            stream.close()
+        if not isinstance(saved, list):
+            return profiles
+        for entry in saved:
+            try:
+                server, port, connect_string, values = entry
+                key = (str(server), int(port), str(connect_string))
+                profiles[key] = _make_profile(values)
+            except (TypeError, ValueError, AttributeError):
+                continue
+        return profiles
+    
+    def _save(self, profiles):
+        saved = []
+        for (server, port, connect_string), profile in profiles.items():
+            saved.append([server, port, connect_string, profile.__dict__])
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        descriptor, temp_name = tempfile.mkstemp(dir=directory)
+        stream = os.fdopen(descriptor, 'wb')
+        try:
+            json.dump(saved, stream)
+        finally:
+            stream.close()
+        os.rename(temp_name, self.filename)
+
+default_cache = CapabilityCache()
+
+def invalidate(server=None, port=None, connect_string=None):
+    """Forget profiles in the default cache. See CapabilityCache.invalidate.
+    """
+    default_cache.invalidate(server, port, connect_string)
+
+def get_profile(handle, server, port, connect_string, cache=None,
+        reattached=False):
+    """Return the profile for a logged in connection handle.
+    
+    The profile is taken from the cache if possible. Otherwise it is read
+    from the server, which must be done before any of the TUNED_ATTRIBUTES
+    have been changed, and then added to the cache.
+    
+    If the handle was reattached to a reserved connection, its attributes
+    are whatever the previous user left them at, so the profile is read
+    without defaults and is not cached.
+    """
+    if cache is not None:
+        profile = cache.get(server, port, connect_string)
+        if profile is not None:
+            return profile
+    
+    profile = CapabilityProfile(
+        driver=get_attribute_long(handle, ODB_ATTR_DRIVER),
+        driver_name=get_attribute_text(handle, ODB_ATTR_DRIVERNAME),
+        driver_version=get_attribute_text(handle, ODB_ATTR_DRIVERVER),
+        dbms_name=get_attribute_text(handle, ODB_ATTR_DBMSNAME),
+        dbms_version=get_attribute_text(handle, ODB_ATTR_DBMSVER),
+        txn_capable=get_attribute_long(handle, ODB_ATTR_TXNCAPABLE),
+        oic_level=get_attribute_long(handle, ODB_ATTR_OICLEVEL),
+        )
+    if reattached:
+        return profile
+    for attribute in TUNED_ATTRIBUTES:
+        profile.defaults[attribute] = get_attribute_long(handle, attribute)
+    
+    if cache is not None:
+        cache.store(server, port, connect_string, profile)
+    return profile
+
+def get_attribute_long(handle, attribute):
+    """Return the value of a numeric connection attribute.
+    """
+    value = c_ulong()
+    if not odb.odbGetAttrLong(handle, attribute, byref(value)):
+        raise get_exception(handle)
+    return value.value
+
+def get_attribute_text(handle, attribute, size=256):
+    """Return the value of a string connection attribute.
+    """
+    text_buffer = create_string_buffer(size)
+    if not odb.odbGetAttrText(handle, attribute, text_buffer, size):
+        raise get_exception(handle)
+    return text_buffer.value
+
+def _hash(connect_string):
+    return sha1(connect_string).hexdigest()
+
+def _make_key(server, port, connect_string):
+    return (server, port, _hash(connect_string))
+
+def _make_profile(values):
+    """Rebuild a profile from its JSON form.
+    
+    Only the known attributes are taken, and the keys of defaults, which
+    JSON turns into strings, are made attribute numbers again.
+    """
+    profile = CapabilityProfile()
+    for name in ('driver', 'txn_capable', 'oic_level'):
+        if name in values:
+            setattr(profile, name, int(values[name]))
+    for name in ('driver_name', 'driver_version', 'dbms_name',
+            'dbms_version'):
+        if name in values:
+            setattr(profile, name, str(values[name]))
+    for attribute, value in values.get('defaults', {}).items():
+        profile.defaults[int(attribute)] = int(value)
+    return profile
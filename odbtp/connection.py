@@ -4,34 +4,258 @@ from ctypes import *
 
 from odbtp.errors import *
 from odbtp.types import *
+from odbtp.types import _DbApiTypeObject
 from odbtp.constants import *
+from odbtp import capabilities
+from odbtp import endpoints
+from odbtp import metrics
+from odbtp import reserved as reservations
+from odbtp.sql import fingerprint, expand_lists, is_dml, is_query, \
+    encode_sql
+from odbtp.spill import SpilledRows, estimate_size
+from odbtp.rows import DecodePlan, LazyRow, BUFFER_PADDING
+from odbtp.converters import ConverterRegistry
+
+# This must follow the odbtp.types import, which exports datetime.time.
+import os
+import sys
+import time
+import threading
+import weakref
+import Queue
 
 odb = cdll.LoadLibrary('libodbtp.so')
 odb.odbWinsockStartup()
 
-def connect(connect_string, server, port=2799):
-    return Connection(connect_string, server, port)
+_CONNECT_SECONDS = metrics.registry.histogram(
+    'odbtp_connect_seconds',
+    'Time taken to log in to an ODBTP server.',
+    ('server',)
+    )
+_RECONNECTS = metrics.registry.counter(
+    'odbtp_reconnects_total',
+    'Logins made again after the connection to a server was lost.',
+    ('server',)
+    )
+_QUERY_SECONDS = metrics.registry.histogram(
+    'odbtp_query_seconds',
+    'Time taken to execute statements, by statement fingerprint.',
+    ('fingerprint',)
+    )
+
+def connect(connect_string, server, port=2799, **options):
+    """Return a new Connection. See Connection for the arguments.
+    
+    The server can also be a list of servers to choose from, as described
+    in odbtp.endpoints. The connection is then made to the first one that
+    can be reached.
+    """
+    if isinstance(server, list):
+        return endpoints.connect_any(
+            lambda host, port: Connection(
+                connect_string,
+                host,
+                port,
+                **options
+                ),
+            server,
+            port
+            )
+    return Connection(connect_string, server, port, **options)
+
+# The ODB_TXN_* constants that can be used as transaction isolation levels.
+ISOLATION_LEVELS = (
+    ODB_TXN_READUNCOMMITTED,
+    ODB_TXN_READCOMMITTED,
+    ODB_TXN_REPEATABLEREAD,
+    ODB_TXN_SERIALIZABLE,
+    ODB_TXN_DEFAULT,
+    )
+
+# Attribute settings negotiated by each connection profile. The lean profile
+# cuts down on the data sent with each result: column information is limited
+# to what is needed for the mandatory description fields, and the server
+# trims the padding from CHAR data and sends variable length data at its
+# actual size rather than the declared size of its column.
+PROFILES = {
+    'default': {
+        ODB_ATTR_FULLCOLINFO: 1,
+        },
+    'lean': {
+        ODB_ATTR_FULLCOLINFO: 0,
+        ODB_ATTR_RIGHTTRIMTEXT: 1,
+        ODB_ATTR_VARDATASIZE: 1,
+        },
+    }
 
-class Connection:
+class Connection(object):
     """Object representing a connection to the ODBTP server.
+    
+    The isolation_level argument is one of the ODB_TXN_* constants listed in
+    ISOLATION_LEVELS, and is used for every transaction unless overridden
+    by begin(). If autocommit is true, each operation is committed by the
+    database as soon as it completes. Both can also be changed later using
+    the attributes of the same names.
+    
+    The profile argument names one of the PROFILES, which decide how much
+    information the server sends along with each result. With the lean
+    profile, full column information is only requested once the extended
+    fields of a cursor's description are actually used.
+    
+    The memory_budget argument is the default for the memory_budget
+    attribute of the connection's cursors (see Cursor.fetchall). The
+    row_cache_size argument limits the number of rows that the ODBTP client
+    library keeps in its own row cache; it defaults to 1000, and 0 means no
+    limit. The lazy_rows argument is the default for the lazy_rows
+    attribute of cursors.
+    
+    The converters attribute is a ConverterRegistry (see odbtp.converters)
+    for changing how the values of result columns are converted to python
+    objects. Each cursor has a registry of its own, which falls back on the
+    connection's.
+    
+    If native_parameters is true, date, time and Decimal parameters are
+    sent to the server in binary form rather than as text (see
+    odbtp.types.get_db_api_type). It is off by default, since it changes
+    what the server receives, and some drivers do not handle it.
+    
+    If use_unicode is true, the server is told to expect SQL text in UTF-8
+    and to send character columns as unicode, which are then returned as
+    unicode objects. Otherwise unicode columns are returned as UTF-8 strs,
+    and SQL text should be ASCII. Unicode operations are sent as UTF-8, and
+    unicode parameters are bound as SQL_WVARCHAR, either way.
+    
+    With write_behind set, INSERT, UPDATE, DELETE and MERGE statements run
+    with execute() are not sent straight away. They are queued, along with
+    their parameters, and later sent to the server together by flush(), as
+    one prepared batch whose parameters are bound in order. This happens on
+    commit(), before any other statement is executed, once
+    max_pending_writes statements are queued, and when a statement is
+    queued max_write_delay seconds or more after the oldest one. Queued
+    statements are dropped by rollback(). The database must accept batches
+    of statements, as with Cursor.execute_batch(), and as many parameters
+    in one batch as the queued statements have between them.
+    
+    Connections can be made before a process forks, as by pre-fork servers.
+    The handles a child process inherits share their sockets with the
+    parent's, so the child never uses them, logs out with them or frees
+    them. Instead, the connection logs in again the first time it is used
+    in the child, and cursors made before the fork drop their result sets.
+    Closing a connection in the child before it is used again makes no
+    contact with the server.
+    
+    If a retry_policy is given (see odbtp.resilience), a connection that
+    the server drops is logged in to again when a statement fails because
+    of it, and the cached procedures are prepared again. The statement is
+    then run again if no transaction was open and it is either a query
+    (see odbtp.sql.is_query) or was marked idempotent, as with
+    Cursor.execute(operation, parameters, idempotent=True), unless the
+    connection was lost while flushing the statements queued by
+    write-behind mode, which are then lost. Otherwise the error is raised,
+    and the connection is ready for the next statement.
+    
+    Query handles are recycled: when a cursor is closed, its handle is kept
+    for the next cursor that needs one, up to max_idle_handles of them. The
+    handle_stats attribute is a dictionary counting the handles that were
+    'allocated', 'reused' and 'freed'.
+    
+    Counts of the rows and bytes received are kept in the stats attribute,
+    which is a dictionary with the keys 'queries', 'rows', 'bytes' and
+    'bytes_saved'. The last is the padding that the server trimmed from
+    CHAR data before sending it. It is not counted with use_unicode, since
+    CHAR columns then arrive as wide characters, whose size in bytes the
+    column size does not give. Cursors keep the same counts for their
+    current result set, except for 'queries'.
+    
+    What the connection learns about the server and data source is kept in
+    a capability profile (see odbtp.capabilities), which later connections
+    reuse to save round trips. The capability_cache argument selects the
+    CapabilityCache to use; it defaults to the shared in-memory cache, and
+    None disables caching. The time taken to connect, in seconds, is kept
+    in the connect_time attribute.
+    
+    If reserved is true, the connection is a reserved one, which close()
+    detaches from rather than disconnecting, so that the server keeps the
+    database connection open for a later login. The registry argument is
+    the odbtp.reserved.ReservationRegistry through which the IDs of
+    detached connections are passed on; it defaults to the one returned by
+    odbtp.reserved.get_default_registry(). A free reserved connection for
+    the same server, port and connect string is reattached to if there is
+    one, and a new one is made otherwise. The connection_id attribute is
+    the ID of the server-side connection, and the reattached attribute
+    says whether it was an existing one.
     """
-    def __init__(self, connect_string, server, port=2799):
+    def __init__(self, connect_string, server, port=2799,
+            capability_cache=capabilities.default_cache,
+            isolation_level=ODB_TXN_SERIALIZABLE, autocommit=False,
+            profile='default', memory_budget=None, row_cache_size=1000,
+            max_idle_handles=8, reserved=False, registry=None,
+            lazy_rows=False, native_parameters=False, write_behind=False,
+            max_pending_writes=100, max_write_delay=1.0, use_unicode=False,
+            retry_policy=None):
+        started = time.time()
         self.open = False
-        self.handle = odb.odbAllocate(None)
-        if not self.handle:
-            raise get_exception(self.handle)
-        if not odb.odbLogin(
-                self.handle,
-                server,
-                port,
-                ODB_LOGIN_SINGLE,
-                connect_string
-                ):
-            raise get_exception(self.handle)
-        self.driver = self._get_driver()
+        if isolation_level not in ISOLATION_LEVELS:
+            raise ProgrammingError('Illegal isolation level.')
+        if not PROFILES.has_key(profile):
+            raise ProgrammingError('Unknown connection profile %s.' % profile)
+        self.server = server
+        self.port = port
+        self._connect_string = connect_string
+        self._pid = os.getpid()
+        self._generation = 0
+        self.reserved = reserved
+        self.reattached = False
+        self.profile = profile
+        self.memory_budget = memory_budget
+        self.lazy_rows = lazy_rows
+        self.native_parameters = native_parameters
+        self.use_unicode = use_unicode
+        self.retry_policy = retry_policy
+        self.write_behind = write_behind
+        self.max_pending_writes = max_pending_writes
+        self.max_write_delay = max_write_delay
+        self.flushed_rowcounts = None
+        self._pending_writes = []
+        self._pending_since = None
+        self.converters = ConverterRegistry()
+        self.row_cache_size = row_cache_size
+        self.max_idle_handles = max_idle_handles
+        self.handle_stats = {'allocated': 0, 'reused': 0, 'freed': 0}
+        self._idle_handles = []
+        self._busy_handles = {}
+        self._prefetcher = None
+        self._attributes = {}
+        self.stats = {'queries': 0, 'rows': 0, 'bytes': 0, 'bytes_saved': 0}
+        self._isolation_level = isolation_level
+        self._autocommit = autocommit
+        self._saved_isolation_level = None
+        if reserved:
+            if registry is None:
+                registry = reservations.get_default_registry()
+            self._registry = registry
+            self._login_reserved()
+        else:
+            self._login(ODB_LOGIN_SINGLE, connect_string)
+            self.connection_id = None
+        self.capabilities = capabilities.get_profile(
+            self.handle,
+            server,
+            port,
+            connect_string,
+            capability_cache,
+            self.reattached
+            )
+        self.driver = self.capabilities.driver_name
         self._set_attributes()
         self.open = True
-        self.committed = False
+        self.committed = True
+        self._procedures = {}
+        self.connect_time = time.time() - started
+        _CONNECT_SECONDS.observe(
+            self.connect_time,
+            ('%s:%d' % (server, port),)
+            )
     
     def __del__(self):
         """Clean up if the user doesn't close the connection
@@ -39,7 +263,7 @@ class Connection:
         if self.open:
             self.close()
     
-    def close(self):
+    def close(self, disconnect=False):
         """Close the connection now.
         
         The connection will be unusable from this point forward; an Error
@@ -47,14 +271,47 @@ class Connection:
         with the connection. The same applies to all cursor objects trying
         to use the connection.  Note that closing a connection without
         committing the changes first will cause an implicit rollback to be
-        performed.
+        performed, unless the connection is in autocommit mode.
+        
+        A reserved connection is detached from and left for a later login,
+        unless disconnect is true.
         """
+        self._check_process()
+        if self.open and self.handle is None:
+            # The handles were inherited from a parent process, and have
+            # been abandoned. There is nothing to log out of.
+            self.open = False
+            return
         self._assert_connection_is_open()
-        if not self.committed:
+        if self._autocommit:
+            self._flush_writes()
+        self._pause_prefetch()
+        if not self.committed and not self._autocommit:
             self.rollback()
         self.open = False
-        if not odb.odbLogout(self.handle, True):
+        detach = self.reserved and not disconnect
+        if not odb.odbLogout(self.handle, not detach):
             raise get_exception(self.handle)
+        if detach:
+            self._registry.checkin(
+                self.server,
+                self.port,
+                self._connect_string,
+                self.connection_id
+                )
+        elif self.reserved:
+            self._registry.discard(
+                self.server,
+                self.port,
+                self._connect_string,
+                self.connection_id
+                )
+        for procedure in self._procedures.values():
+            self._free_query_handle(procedure.handle)
+        self._procedures = {}
+        for handle in self._idle_handles:
+            self._free_query_handle(handle)
+        self._idle_handles = []
         odb.odbFree(self.handle)
         del self.handle
         
@@ -62,12 +319,18 @@ class Connection:
         """Commit any pending transaction to the database.
         
         Note that some databases or ODBC drivers do not support transactions,
-        and that this method will have no effect in those cases.
+        and that this method will have no effect in those cases. It also has
+        no effect in autocommit mode.
         """
         self._assert_connection_is_open()
+        self._flush_writes()
+        if self._autocommit:
+            return
+        self._pause_prefetch()
         if not odb.odbCommit(self.handle):
             raise get_exception(self.handle)
         self.committed = True
+        self._end_transaction()
     
     def rollback(self):
         """Restore database to the start of any pending transaction.
@@ -75,33 +338,495 @@ class Connection:
         Closing a connection without committing the changes first will
         cause an implicit rollback to be performed.
         Note that some databases or ODBC drivers do not support transactions,
-        and that this method will have no effect in those cases.
+        and that this method will have no effect in those cases. It also has
+        no effect in autocommit mode.
+        
+        Statements queued by write-behind mode are dropped, except in
+        autocommit mode.
         """
         self._assert_connection_is_open()
+        if self._autocommit:
+            return
+        self._discard_writes()
+        self._pause_prefetch()
         if not odb.odbRollback(self.handle):
             raise get_exception(self.handle)
+        self._end_transaction()
     
     def cursor(self):
         """Return a new Cursor Object using the connection.
         """
         self._assert_connection_is_open()
-        cursorhandle = odb.odbAllocate(self.handle)
-        if not cursorhandle:
-            raise get_exception(self.handle)
         return Cursor(self)
     
+    def flush(self):
+        """Send the statements queued in write-behind mode to the server.
+        
+        Returns a list of the row counts of the statements, in the order
+        they were queued, which is also kept in the flushed_rowcounts
+        attribute. The rowcount attribute of each cursor that queued a
+        statement is set to the count of its last one. Counts the server
+        did not report, as with SET NOCOUNT ON, are -1.
+        
+        If a statement fails, the error is raised with the index of the
+        statement in its statement_index attribute, the statement itself in
+        its statement attribute, and the counts of the statements before it
+        in its rowcounts attribute. Those statements have been run: in
+        autocommit mode they are committed, and otherwise they are part of
+        the pending transaction, which is left for the caller to roll back.
+        """
+        self._assert_connection_is_open()
+        return self._flush_writes()
+    
+    ########### Transaction control that is not part of the spec ###########
+    
+    def _get_isolation_level(self):
+        return self._isolation_level
+    
+    def _set_isolation_level(self, isolation_level):
+        self._assert_connection_is_open()
+        if isolation_level not in ISOLATION_LEVELS:
+            raise ProgrammingError('Illegal isolation level.')
+        self._assert_transactions_are_supported()
+        if not self._autocommit:
+            self._set_attribute(ODB_ATTR_TRANSACTIONS, isolation_level)
+        self._isolation_level = isolation_level
+        self._saved_isolation_level = None
+    
+    isolation_level = property(
+        _get_isolation_level,
+        _set_isolation_level,
+        doc="""The transaction isolation level, as an ODB_TXN_* constant.
+        
+        This should only be changed when no transaction is pending, since
+        many drivers refuse to change it in the middle of a transaction.
+        """
+        )
+    
+    def _get_autocommit(self):
+        return self._autocommit
+    
+    def _set_autocommit(self, autocommit):
+        self._assert_connection_is_open()
+        autocommit = bool(autocommit)
+        if autocommit == self._autocommit:
+            return
+        self._assert_transactions_are_supported()
+        self._flush_writes()
+        if autocommit:
+            # Switching to autocommit mode commits any pending transaction.
+            self._set_attribute(ODB_ATTR_TRANSACTIONS, ODB_TXN_NONE)
+            self.committed = True
+        else:
+            self._set_attribute(ODB_ATTR_TRANSACTIONS, self._isolation_level)
+        self._autocommit = autocommit
+    
+    autocommit = property(
+        _get_autocommit,
+        _set_autocommit,
+        doc="""Whether operations are committed as soon as they complete.
+        
+        In autocommit mode, commit() and rollback() do nothing, and closing
+        the connection does not perform an implicit rollback.
+        """
+        )
+    
+    def begin(self, isolation_level):
+        """Use a different isolation level until the current transaction ends.
+        
+        This is meant to be called when no transaction is pending. The
+        previous isolation level is restored by the next commit() or
+        rollback().
+        """
+        self._assert_connection_is_open()
+        if self._autocommit:
+            raise ProgrammingError(
+                'Cannot begin a transaction in autocommit mode.'
+                )
+        previous = self._saved_isolation_level
+        if previous is None:
+            previous = self._isolation_level
+        self._set_isolation_level(isolation_level)
+        self._saved_isolation_level = previous
+    
     ############## Helper methods that are not part of the spec #############
     
+    def _assert_transactions_are_supported(self):
+        """Raise an error if the driver does not support transactions.
+        """
+        if not self.capabilities.supports_transactions():
+            raise NotSupportedError(
+                'The driver does not support transactions.'
+                )
+    
+    def _end_transaction(self):
+        """Restore the isolation level overridden by begin(), if any.
+        """
+        if self._saved_isolation_level is not None:
+            self._set_isolation_level(self._saved_isolation_level)
+    
+    def _login(self, login_type, connect_string):
+        """Allocate the connection handle and log in with it.
+        """
+        self.handle = odb.odbAllocate(None)
+        if not self.handle:
+            raise get_exception(self.handle)
+        if not odb.odbLogin(
+                self.handle,
+                self.server,
+                self.port,
+                login_type,
+                connect_string
+                ):
+            # Free the handle, since failed logins are retried on other
+            # servers when several are given.
+            error = get_exception(self.handle)
+            odb.odbFree(self.handle)
+            self.handle = None
+            raise error
+    
+    def _login_reserved(self):
+        """Reattach to a free reserved connection from the registry, or log
+        in to a new one if there is none.
+        """
+        key = (self.server, self.port, self._connect_string)
+        while True:
+            connection_id = self._registry.checkout(*key)
+            if connection_id is None:
+                break
+            entry = key + (connection_id,)
+            try:
+                self._login(ODB_LOGIN_RESERVED, connection_id)
+            except Error, e:
+                # The server may have been restarted, or have timed the
+                # connection out. Unreachable servers are left for the
+                # next attempt, since their connections may still exist.
+                if e.odbtp_error in endpoints.FAILOVER_ERRORS:
+                    self._registry.checkin(*entry)
+                    raise
+                self._registry.discard(*entry)
+                continue
+            self.connection_id = connection_id
+            self.reattached = True
+            return
+        self._login(ODB_LOGIN_RESERVED, self._connect_string)
+        self.reattached = False
+        odb.odbGetConnectionId.restype = c_char_p
+        self.connection_id = odb.odbGetConnectionId(self.handle)
+        self._registry.attach(
+            self.server,
+            self.port,
+            self._connect_string,
+            self.connection_id
+            )
+    
     def _assert_connection_is_open(self):
         """Raise an error if the connection is no longer open.
+        
+        In a process forked since the connection was last used, this logs
+        in again first.
         """
         if not self.open:
             raise InterfaceError('The connection has been closed.')
+        self._check_process()
+        if self.handle is None:
+            self._restore_login()
+    
+    def _check_process(self):
+        """Abandon the handles of the connection if they were inherited
+        from another process.
+        
+        They are neither logged out of nor freed, since the client library
+        would act on the socket shared with the parent.
+        """
+        pid = os.getpid()
+        if pid == self._pid or not self.open:
+            return
+        self._pid = pid
+        self._abandon_handles()
+    
+    def _abandon_handles(self):
+        """Forget the handles of the connection and everything that was
+        tied to its session.
+        
+        The generation is moved on so that cursors know to abandon their
+        handles too.
+        """
+        self._generation += 1
+        self.handle = None
+        self._idle_handles = []
+        self._busy_handles = {}
+        self._procedures = {}
+        self._prefetcher = None
+        self._discard_writes()
+        if self._saved_isolation_level is not None:
+            self._isolation_level = self._saved_isolation_level
+            self._saved_isolation_level = None
+        self.committed = True
+    
+    def _reconnect(self):
+        """Log in again after the connection to the server was lost.
+        
+        The procedures that were cached are prepared again. Cursors prepare
+        their statements again when they are next used.
+        
+        The session is gone, so the old handles are freed, which only
+        releases their memory in the client library. If the login or the
+        preparation of the procedures fails, the handle attribute is None.
+        """
+        self._pause_prefetch()
+        procnames = self._procedures.keys()
+        self._drop_session()
+        self._restore_login()
+        _RECONNECTS.inc(('%s:%d' % (self.server, self.port),))
+        try:
+            for procname in procnames:
+                self._release_procedure(self._get_procedure(procname))
+        except:
+            exc_info = self._abort_login()
+            raise exc_info[0], exc_info[1], exc_info[2]
+    
+    def _drop_session(self, logout=False):
+        """Free the connection handle and every query handle, leaving the
+        handle attribute None so that the next use logs in again.
+        
+        With logout set, the session is ended first, since it is still
+        alive on the server.
+        """
+        handle = self.handle
+        query_handles = self._idle_handles + self._busy_handles.keys()
+        if self.reserved and handle is not None:
+            self._registry.discard(
+                self.server,
+                self.port,
+                self._connect_string,
+                self.connection_id
+                )
+        self._abandon_handles()
+        for query_handle in query_handles:
+            self._free_query_handle(query_handle)
+        if handle is not None:
+            if logout:
+                odb.odbLogout(handle, True)
+            odb.odbFree(handle)
     
-    def _get_driver(self):
-        driver_buffer = c_char_p(' ' * 50)
-        odb.odbGetAttrText(self.handle, ODB_ATTR_DRIVERNAME, driver_buffer, 50)
-        return driver_buffer.value
+    def _abort_login(self):
+        """Drop a session that could not be set up after logging in, and
+        return the exception being handled.
+        
+        Errors are marked so that Cursor._run() reports them rather than
+        the error that caused the login.
+        """
+        exc_info = sys.exc_info()
+        if isinstance(exc_info[1], Error):
+            exc_info[1]._after_login = True
+        try:
+            self._drop_session(True)
+        except Error:
+            pass
+        return exc_info
+    
+    def _restore_login(self):
+        """Log in again after the handles were abandoned, through the
+        retry policy if there is one.
+        """
+        if self.retry_policy is None:
+            self._login_again()
+        else:
+            self.retry_policy.login(self.server, self.port, self._login_again)
+    
+    def _login_again(self):
+        """Log in again with the same settings, after a fork or a lost
+        connection.
+        
+        If the login fails, or the attributes cannot be set afterwards, the
+        connection stays open and the login is tried again the next time
+        the connection is used.
+        """
+        started = time.time()
+        if self.reserved:
+            self._login_reserved()
+        else:
+            self._login(ODB_LOGIN_SINGLE, self._connect_string)
+        self._attributes = {}
+        try:
+            self._set_attributes()
+        except:
+            exc_info = self._abort_login()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        _CONNECT_SECONDS.observe(
+            time.time() - started,
+            ('%s:%d' % (self.server, self.port),)
+            )
+    
+    def _pause_prefetch(self):
+        """Stop any cursor's background fetching, so that the connection
+        can be used for another request.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.pause()
+            self._prefetcher = None
+    
+    def _queue_write(self, cursor, operation, parameters):
+        """Queue a statement for the next flush, flushing now if one of
+        the thresholds has been reached.
+        """
+        now = time.time()
+        if not self._pending_writes:
+            self._pending_since = now
+        self._pending_writes.append(
+            (operation, tuple(parameters), weakref.ref(cursor))
+            )
+        self.committed = False
+        if len(self._pending_writes) >= self.max_pending_writes or \
+                self.max_write_delay is not None and \
+                now - self._pending_since >= self.max_write_delay:
+            self._flush_writes()
+    
+    def _discard_writes(self):
+        self._pending_writes = []
+        self._pending_since = None
+    
+    def _flush_writes(self):
+        """Send any queued statements as one batch. See flush().
+        """
+        writes = self._pending_writes
+        if not writes:
+            return []
+        self._discard_writes()
+        self._pause_prefetch()
+        
+        batch = ';\n'.join([
+            encode_sql(operation) for operation, parameters, cursor_ref
+            in writes
+            ])
+        parameters = []
+        for operation, statement_parameters, cursor_ref in writes:
+            parameters.extend(statement_parameters)
+        rowcounts = []
+        # The parameters are bound through a cursor of its own, which is
+        # only used for its handle.
+        cursor = Cursor(self)
+        try:
+            cursor._ensure_handle()
+            handle = cursor.handle
+            started = time.time()
+            if parameters:
+                failed = not odb.odbPrepare(handle, batch)
+                if not failed:
+                    cursor._bind_parameters(parameters)
+                    failed = not odb.odbExecute(handle, None)
+            else:
+                failed = not odb.odbExecute(handle, batch)
+            while not failed:
+                rowcounts.append(odb.odbGetRowCount(handle))
+                if len(rowcounts) == len(writes):
+                    break
+                failed = not odb.odbFetchNextResult(handle)
+                if not failed and odb.odbNoData(handle):
+                    break
+            if failed:
+                error = get_exception(handle)
+                index = len(rowcounts)
+                error.statement_index = index
+                error.statement = writes[index][0]
+                error.rowcounts = rowcounts
+                raise error
+            _QUERY_SECONDS.observe(
+                time.time() - started,
+                (fingerprint(writes[0][0]),)
+                )
+        except:
+            # Closing the cursor may fail too if the connection was lost,
+            # but the error to report is the first one. It is marked so
+            # that Cursor._run() does not hide it by running the statement
+            # that flushed the queue again, since the queue is gone.
+            exc_info = sys.exc_info()
+            if isinstance(exc_info[1], Error):
+                exc_info[1]._from_flush = True
+            try:
+                cursor.close()
+            except Error:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        cursor.close()
+        
+        rowcounts.extend([-1] * (len(writes) - len(rowcounts)))
+        for (operation, parameters, cursor_ref), rowcount in \
+                zip(writes, rowcounts):
+            cursor = cursor_ref()
+            if cursor is not None:
+                cursor.rowcount = rowcount
+        self.stats['queries'] += len(writes)
+        self.flushed_rowcounts = rowcounts
+        return rowcounts
+    
+    def _allocate_query_handle(self):
+        """Return a query handle, reusing an idle one if there is one.
+        """
+        self._assert_connection_is_open()
+        if self._idle_handles:
+            self.handle_stats['reused'] += 1
+            handle = self._idle_handles.pop()
+        else:
+            handle = odb.odbAllocate(self.handle)
+            if not handle:
+                raise get_exception(self.handle)
+            self.handle_stats['allocated'] += 1
+        # Handles in use are tracked so that they can be freed when the
+        # session is lost, since their cursors only forget them.
+        self._busy_handles[handle] = True
+        return handle
+    
+    def _release_query_handle(self, handle):
+        """Take back a query handle obtained from _allocate_query_handle().
+        
+        The query left on the handle is dropped, so that its result set,
+        bound parameters and statement do not carry over to the next user.
+        The handle is then kept for reuse unless there are enough idle
+        handles already. Handles released after the connection is closed
+        were already freed along with the connection.
+        """
+        if not self.open:
+            return
+        self._pause_prefetch()
+        if not odb.odbDropQry(handle):
+            raise get_exception(handle)
+        self._busy_handles.pop(handle, None)
+        if len(self._idle_handles) < self.max_idle_handles:
+            self._idle_handles.append(handle)
+            return
+        self._free_query_handle(handle)
+    
+    def _free_query_handle(self, handle):
+        self._busy_handles.pop(handle, None)
+        odb.odbFree(handle)
+        self.handle_stats['freed'] += 1
+    
+    def _get_procedure(self, procname):
+        """Return a prepared procedure for the exclusive use of a cursor.
+        
+        Procedures are prepared once and then cached, so that later calls
+        can skip the preparation round trip. If the cached procedure is
+        already in use by another cursor, a separate uncached one is
+        prepared instead. Either way, the cursor must hand the procedure
+        back with _release_procedure() when done.
+        """
+        procedure = self._procedures.get(procname)
+        if procedure is None or procedure.in_use:
+            procedure = _Procedure(self, procname)
+            if not self._procedures.has_key(procname):
+                procedure.cached = True
+                self._procedures[procname] = procedure
+        procedure.in_use = True
+        return procedure
+    
+    def _release_procedure(self, procedure):
+        """Take back a procedure obtained from _get_procedure().
+        """
+        procedure.in_use = False
+        if not procedure.cached:
+            self._release_query_handle(procedure.handle)
     
     def _set_attributes(self):
         """Send attribute settings to the ODBTP server.
@@ -109,23 +834,306 @@ class Connection:
         Some of these may be driver dependent. This method is for internal
         use only and may change or disappear in future versions without notice.
         """
-        if not odb.odbLoadDataTypes(self.handle):
-            raise get_exception(self.handle)
-        if not odb.odbSetAttrLong(self.handle, ODB_ATTR_DESCRIBEPARAMS, 0):
-            raise get_exception(self.handle)
-        if not odb.odbSetAttrLong(self.handle, ODB_ATTR_FULLCOLINFO, 1):
-            raise get_exception(self.handle)
-        if not odb.odbUseRowCache(self.handle, True, 0):
+        if self.capabilities.needs_data_types():
+            if not odb.odbLoadDataTypes(self.handle):
+                raise get_exception(self.handle)
+        self._set_initial_attribute(ODB_ATTR_DESCRIBEPARAMS, 0)
+        self._set_initial_attribute(ODB_ATTR_CACHEPROCS, 1)
+        for attribute, value in PROFILES[self.profile].items():
+            self._set_initial_attribute(attribute, value)
+        if self.use_unicode:
+            self._set_initial_attribute(ODB_ATTR_UNICODESQL, 1)
+            self._set_initial_attribute(ODB_ATTR_MAPCHARTOWCHAR, 1)
+        if not odb.odbUseRowCache(self.handle, True, self.row_cache_size):
             raise get_exception(self.handle)
         
-        if self.driver not in (ODB_DRIVER_FOXPRO, ODB_DRIVER_JET):
+        if self.capabilities.supports_transactions():
             # Enable transactions unless the driver is known to lack support.
-            if not odb.odbSetAttrLong(
-                    self.handle,
-                    ODB_ATTR_TRANSACTIONS,
-                    ODB_TXN_SERIALIZABLE
-                    ):
-                raise get_exception(self.handle)
+            if self._autocommit:
+                transactions = ODB_TXN_NONE
+            else:
+                transactions = self._isolation_level
+            self._set_initial_attribute(ODB_ATTR_TRANSACTIONS, transactions)
+        
+        if self.reattached:
+            # The previous user of the reserved connection may have changed
+            # the attributes left alone above, so put them back to their
+            # values after a fresh login, or find out what they are.
+            for attribute in capabilities.TUNED_ATTRIBUTES:
+                if self._attributes.has_key(attribute):
+                    continue
+                value = self.capabilities.defaults.get(attribute)
+                if value is None:
+                    self._attributes[attribute] = \
+                        capabilities.get_attribute_long(self.handle, attribute)
+                else:
+                    self._set_attribute(attribute, value)
+    
+    def _set_initial_attribute(self, attribute, value):
+        """Set a numeric attribute on the server right after login.
+        
+        The round trip is skipped if the capability profile shows that
+        the attribute already has the value after a fresh login. It is
+        never skipped after reattaching to a reserved connection, which
+        keeps the attributes of its previous user.
+        """
+        if self.reattached or \
+                self.capabilities.defaults.get(attribute) != value:
+            self._set_attribute(attribute, value)
+        else:
+            self._attributes[attribute] = value
+    
+    def _set_attribute(self, attribute, value):
+        """Set a numeric attribute on the server.
+        """
+        self._pause_prefetch()
+        if not odb.odbSetAttrLong(self.handle, attribute, value):
+            raise get_exception(self.handle)
+        self._attributes[attribute] = value
+    
+    def _get_attribute(self, attribute):
+        """Return the value of a numeric attribute as far as it is known.
+        """
+        value = self._attributes.get(attribute)
+        if value is None:
+            value = self.capabilities.defaults.get(attribute)
+        return value
+    
+    def _request_full_column_info(self):
+        """Ask for full column information with all results from now on.
+        
+        This is used by profiles that leave it off until it is needed.
+        """
+        if self.open and not self._get_attribute(ODB_ATTR_FULLCOLINFO):
+            self._set_attribute(ODB_ATTR_FULLCOLINFO, 1)
+
+class _Procedure:
+    """A prepared stored procedure along with its parameter information.
+    
+    This is for internal use only. Each procedure has a query handle of its
+    own, which a cursor borrows while it calls the procedure.
+    """
+    def __init__(self, connection, procname):
+        self.name = procname
+        self.cached = False
+        self.in_use = False
+        self.handle = connection._allocate_query_handle()
+        if not odb.odbPrepareProc(self.handle, encode_sql(procname)):
+            error = get_exception(self.handle)
+            connection._release_query_handle(self.handle)
+            raise error
+        
+        # The parameters that take a value from the caller, in order, plus
+        # the subset of those and the return value that send values back.
+        self.arguments = []
+        self.inputs = []
+        self.outputs = []
+        self.return_value = None
+        for number in range(1, odb.odbGetTotalParams(self.handle)+1):
+            param_type = odb.odbParamType(self.handle, number)
+            if param_type & ODB_PARAM_RETURNVAL == ODB_PARAM_RETURNVAL:
+                self.return_value = number
+                continue
+            self.arguments.append(number)
+            if param_type & ODB_PARAM_INPUT:
+                self.inputs.append(number)
+            if param_type & ODB_PARAM_OUTPUT:
+                self.outputs.append(number)
+
+class _ResultSet:
+    """Information shared by the column descriptions of one result set.
+    
+    This is for internal use only. The current attribute is cleared once
+    the cursor moves on, after which the server's column information is no
+    longer available.
+    """
+    def __init__(self, connection, handle):
+        self.connection = connection
+        self.handle = handle
+        self.current = True
+        self.full_column_info = connection._get_attribute(ODB_ATTR_FULLCOLINFO)
+    
+    def get_column_info(self, column, type_code):
+        """Return the extended description fields for a column.
+        
+        These are (display_size, internal_size, precision, scale, null_ok).
+        """
+        if not self.current:
+            return (None, None, None, None, None)
+        
+        self.connection._pause_prefetch()
+        size = odb.odbColSize(self.handle, column)
+        if type_code == NUMBER:
+            precision = size
+            scale = odb.odbColDecimalDigits(self.handle, column)
+        else:
+            precision = None
+            scale = None
+        
+        if self.full_column_info:
+            flags = odb.odbColFlags(self.handle, column)
+            null_ok = not (flags & ODB_COLINFO_NOTNULL)
+        else:
+            # Nullability is only sent with full column info, so it is
+            # unknown for this result. Ask for it with later results.
+            null_ok = None
+            self.connection._request_full_column_info()
+        
+        return (size, size, precision, scale, null_ok)
+
+# Kinds of items queued by a _Prefetcher.
+_ROWS = 0
+_DONE = 1
+_ERROR = 2
+
+class _Prefetcher:
+    """A thread that fetches rows for a cursor ahead of time.
+    
+    This is for internal use only. Rows are fetched in batches and queued,
+    up to a number of batches, while the consumer works on earlier rows.
+    The thread only holds a weak reference to the cursor between batches,
+    so that a cursor that is thrown away can still be collected.
+    """
+    def __init__(self, cursor, batch_size, depth):
+        self.batch_size = batch_size
+        self.rows = []
+        self.finished = False
+        self._queue = Queue.Queue(depth)
+        self._unqueued = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(weakref.ref(cursor),)
+            )
+        self._thread.setDaemon(True)
+        self._thread.start()
+    
+    def take(self, size):
+        """Return up to size prefetched rows, waiting for them if need be.
+        
+        Fewer rows are returned once the result set is exhausted, or when
+        the thread has been paused and every row it queued has been taken.
+        If the thread ran into an error, it is raised here.
+        """
+        while len(self.rows) < size and not self.finished:
+            try:
+                kind, data = self._queue.get(True, 0.1)
+            except Queue.Empty:
+                if self._thread.isAlive() or not self._queue.empty():
+                    continue
+                if not self._unqueued:
+                    break
+                kind, data = self._unqueued.pop(0)
+            if kind == _ROWS:
+                self.rows.extend(data)
+            elif kind == _DONE:
+                self.finished = True
+            else:
+                self.finished = True
+                raise data[0], data[1], data[2]
+        
+        rows = self.rows[:size]
+        del self.rows[:size]
+        return rows
+    
+    def pause(self):
+        """Stop fetching, and wait for the thread to finish.
+        
+        Rows that have already been queued can still be taken. When the
+        thread pauses itself, as when it drops the last reference to its
+        cursor, it cannot wait for itself, and stops after its current
+        batch instead.
+        """
+        self._stop.set()
+        if threading.currentThread() is not self._thread:
+            self._thread.join()
+    
+    def _run(self, cursor_ref):
+        while not self._stop.isSet():
+            cursor = cursor_ref()
+            if cursor is None:
+                return
+            try:
+                rows = cursor._fetch_rows(self.batch_size)
+                del cursor
+            except:
+                # The traceback keeps this frame, which must not keep the
+                # cursor alive.
+                del cursor
+                self._put((_ERROR, sys.exc_info()))
+                return
+            if not self._put((_ROWS, rows)):
+                return
+            if len(rows) < self.batch_size:
+                self._put((_DONE, None))
+                return
+    
+    def _put(self, item):
+        """Queue an item, waiting while the queue is full.
+        
+        If the thread is paused first, the item is kept aside to be taken
+        after the queue, and False is returned.
+        """
+        while not self._stop.isSet():
+            try:
+                self._queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        self._unqueued.append(item)
+        return False
+
+class ColumnDescription(object):
+    """The description of one column of a result set.
+    
+    This behaves like the 7-item sequence required by the spec: (name,
+    type_code, display_size, internal_size, precision, scale, null_ok).
+    The last five items are looked up from the server's column information
+    the first time one of them is used. They are None if the cursor has
+    moved on to another result set by then.
+    """
+    def __init__(self, result_set, column, name, type_code):
+        self._result_set = result_set
+        self._column = column
+        self._info = None
+        self.name = name
+        self.type_code = type_code
+    
+    def __len__(self):
+        return 7
+    
+    def __getitem__(self, index):
+        if index == 0:
+            return self.name
+        elif index == 1:
+            return self.type_code
+        return self._as_tuple()[index]
+    
+    def __iter__(self):
+        return iter(self._as_tuple())
+    
+    def __eq__(self, other):
+        try:
+            return self._as_tuple() == tuple(other)
+        except TypeError:
+            return False
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash(self._as_tuple())
+    
+    def __repr__(self):
+        return repr(self._as_tuple())
+    
+    def _as_tuple(self):
+        if self._info is None:
+            self._info = self._result_set.get_column_info(
+                self._column,
+                self.type_code
+                )
+        return (self.name, self.type_code) + self._info
 
 class Cursor:
     """Object that manages the context of an operation.
@@ -133,20 +1141,65 @@ class Cursor:
     Cursors created from the same connection are not isolated. That is, any
     changes done to the database by a cursor are immediately visible by
     other cursors created from the same connection.
+    
+    A cursor gets a query handle from its connection the first time it is
+    used to execute an operation, and gives it back when closed.
+    
+    Setting the prefetch attribute to a number of batches turns on background
+    fetching. After each execution, a thread fetches batches of arraysize
+    rows (at least 20) into a queue holding up to that many batches, so that
+    the next rows are on their way while the current ones are processed.
+    Using any other cursor of the same connection stops the background
+    fetching, since the connection can only handle one request at a time.
+    
+    A list or tuple can be passed to execute() as the value of a single
+    parameter, as in "WHERE id IN (?)". It is expanded into one marker per
+    value (see odbtp.sql.expand_lists), rounded up to a power of two. A list
+    of more than max_list_size values is split into chunks that are executed
+    one after the other, and the rows of all the chunks are merged. The
+    merged rows are not sorted as a whole, and aggregates are computed per
+    chunk, so long lists are best used to filter plain queries.
+    
+    If the lazy_rows attribute is set, rows are fetched as LazyRow objects
+    (see odbtp.rows), which keep the raw data sent by the server and only
+    convert each value when it is first read. This saves time when only a
+    few of many columns are used.
+    
+    The converters attribute is a ConverterRegistry (see odbtp.converters)
+    for this cursor's result columns, which falls back on the connection's.
     """
     def __init__(self, connection):
         self.connection = connection
-        self.handle = odb.odbAllocate(connection.handle)
-        if not self.handle:
-            raise get_exception(connection.handle)
+        self._generation = connection._generation
+        self.handle = None
         self.open = True
         self.arraysize = 1
+        self.memory_budget = connection.memory_budget
+        self.lazy_rows = connection.lazy_rows
+        self.converters = ConverterRegistry(connection.converters)
         
         # The following are set to real values after execution.
         self.description = None
         self.prepared_operation = None
         self.input_sizes = ()
         self.rowcount = -1
+        self.stats = {'rows': 0, 'bytes': 0, 'bytes_saved': 0}
+        self._result_set = None
+        self._padded_columns = None
+        self._decode_plan = None
+        self._cached_description = None
+        self.prefetch = 0
+        self._prefetcher = None
+        self.max_list_size = 256
+        self._merged_rows = None
+        self._merged_index = 0
+        
+        # The following are set by callproc().
+        self.procparams = None
+        self.return_value = None
+        self._procedure = None
+        self._own_handle = None
+        self._outputs_pending = False
     
     def __iter__(self):
         """Allow users to iterate over the cursor to fetch rows.
@@ -162,54 +1215,145 @@ class Cursor:
     def close(self):
         """Close the cursor.
         """
-        if not odb.odbDropQry(self.handle):
-            raise get_exception(self.handle)
-        odb.odbFree(self.handle)
+        self._check_generation()
+        self._end_result_set()
+        self.connection._pause_prefetch()
+        self._release_procedure()
         self.open = False
+        if self.handle is not None:
+            handle, self.handle = self.handle, None
+            self.connection._release_query_handle(handle)
     
-    def callproc(self, procname, parameters=()):
+    def callproc(self, procname, parameters=(), idempotent=False):
         """Call a stored database procedure with the given name.
         
         The sequence of parameters must contain one entry for each argument
-        that the procedure expects.
+        that the procedure expects. The values of pure output parameters are
+        ignored and may be None.
+        
+        Returns a copy of the parameters in which output and input/output
+        parameters have been replaced by the values the procedure sent back.
+        The procedure's return value, if it has one, is put in the
+        return_value attribute. If the procedure produces a result set,
+        output values cannot be retrieved until all result sets have been
+        read with nextset(), so the input parameters are returned and
+        the procparams and return_value attributes are updated later.
+        
+        Prepared procedures are cached by the connection, so calling the
+        same procedure again only sends the new parameter values.
+        
+        See execute() for idempotent.
         """
+        return self._run(
+            self._callproc,
+            (procname, parameters),
+            None,
+            idempotent
+            )
+    
+    def _callproc(self, procname, parameters):
+        self._assert_cursor_is_open()
+        self.connection._flush_writes()
+        self._end_result_set()
+        self.connection._pause_prefetch()
         self.input_sizes = ()
         self.prepared_operation = None
         
-        if not odb.odbPrepareProc(procname):
-            self.connection.rollback()
-            raise get_exception(self.handle)
+        self._use_procedure(procname)
+        procedure = self._procedure
+        if len(parameters) != len(procedure.arguments):
+            raise ProgrammingError(
+                'Procedure %s takes %d parameters (%d given).' % (
+                    procname, len(procedure.arguments), len(parameters)
+                    )
+                )
         
-        for value in parameters:
-            db_api_type = get_db_api_type(self, value)
+        for number, value in zip(procedure.arguments, parameters):
+            if number not in procedure.inputs:
+                continue
+            db_api_type = get_db_api_type(self, value, False)
             # Called procedure parameters are automatically bound, so
             # we can set them without binding.
+            final = (number == procedure.inputs[-1])
+            db_api_type.use_column(self, number, final)
             db_api_type.set_parameter(value)
         
-        if not odb.odbExecute(self.handle, None):
-                self.connection.rollback()
-                raise get_exception(self.handle)
+        self._execute(None, '{call %s}' % procname)
         
-        self._update_description()
-        self.rowcount = odb.odbGetRowCount(self.handle)
+        self._start_result_set()
         self.connection.committed = False
+        
+        self.procparams = list(parameters)
+        self.return_value = None
+        self._outputs_pending = bool(
+            procedure.outputs or procedure.return_value
+            )
+        if not self.description:
+            # Without a result set to read, the procedure is finished with.
+            if self._outputs_pending:
+                self._get_output_parameters()
+            self._release_procedure()
+        return self.procparams
     
-    def execute(self, operation, parameters=()):
+    def execute(self, operation, parameters=(), idempotent=False):
         """Prepare and execute a database operation (query or command).
         
         Parameters may be provided as a sequence and will be bound to
         variables in the operation. Variables are specified using the
         qmark notation.
+        
+        If the connection is in write-behind mode, statements that change
+        data are queued rather than executed (see Connection). The rowcount
+        attribute is then -1 until the queue is flushed.
+        
+        Set idempotent if running the operation twice has the same effect
+        as running it once, so that it can be run again after a lost
+        connection (see Connection).
         """
-        self.executemany(operation, (parameters,))
-        return self
+        return self._run(
+            self._execute_operation,
+            (operation, parameters),
+            operation,
+            idempotent
+            )
     
-    def executemany(self, operation, seq_of_parameters):
+    def executemany(self, operation, seq_of_parameters, idempotent=False):
         """Prepare a database operation (query or command) and then
         execute it against all parameter sequences found in the
         sequence seq_of_parameters.
+        
+        See execute() for idempotent.
         """
+        return self._run(
+            self._executemany,
+            (operation, seq_of_parameters),
+            operation,
+            idempotent
+            )
+    
+    def _execute_operation(self, operation, parameters):
+        if self.connection.write_behind and self._queue_write(
+                operation,
+                parameters
+                ):
+            return self
+        expansions = expand_lists(operation, parameters, self.max_list_size)
+        if expansions is None:
+            self._executemany(operation, (parameters,))
+        elif len(expansions) == 1:
+            operation, parameters = expansions[0]
+            self._executemany(operation, (parameters,))
+        else:
+            self._execute_chunks(expansions)
+        return self
+    
+    def _executemany(self, operation, seq_of_parameters):
         self._assert_cursor_is_open()
+        self.connection._flush_writes()
+        self._end_result_set()
+        self.connection._pause_prefetch()
+        self._release_procedure()
+        self._ensure_handle()
         
         try:
             total_cols = len(seq_of_parameters[0])
@@ -222,23 +1366,45 @@ class Cursor:
         for parameters in seq_of_parameters:
             if self.input_sizes:
                 bound_parameters = map(None, self.input_sizes, parameters)
+                for db_api_type, value in bound_parameters:
+                    db_api_type.set_parameter(value)
             else:
-                bound_parameters = []
-                for index, value in enumerate(parameters):
-                    col_number = index + 1
-                    db_api_type = get_db_api_type(self, value)
-                    db_api_type.bind_to_column(self, col_number, total_cols)
-                    bound_parameters.append((db_api_type, value))
-            
-            for db_api_type, value in bound_parameters:
-                db_api_type.set_parameter(value)
+                self._bind_parameters(parameters)
             
-            if not odb.odbExecute(self.handle, None):
-                self.connection.rollback()
-                raise get_exception(self.handle)
+            self._execute(None, operation)
             
-        self._update_description()
-        self.rowcount = odb.odbGetRowCount(self.handle)
+        self._start_result_set(operation)
+        self.connection.committed = False
+        return self
+    
+    def execute_batch(self, operations):
+        """Execute a sequence of operations in a single round trip.
+        
+        The operations are sent to the server together as one batch of
+        statements, so they cannot use parameters. The cursor is left on
+        the result of the first operation. Use nextset() or resultsets()
+        to move on to the results of the later ones.
+        
+        Note that not all ODBC drivers accept batches of statements.
+        """
+        self._assert_cursor_is_open()
+        if not operations:
+            raise InterfaceError(
+                'Operations are required for .execute_batch()'
+                )
+        self.connection._flush_writes()
+        self._end_result_set()
+        self.connection._pause_prefetch()
+        self._release_procedure()
+        self._ensure_handle()
+        
+        self.input_sizes = ()
+        self.prepared_operation = None
+        
+        batch = ';\n'.join([encode_sql(operation) for operation in operations])
+        self._execute(batch, batch)
+        
+        self._start_result_set()
         self.connection.committed = False
         return self
     
@@ -260,44 +1426,50 @@ class Cursor:
         more rows are available.
         """
         self._assert_cursor_is_open()
+        if self.description is None:
+            raise InterfaceError('There is no result set to fetch from.')
         if size == None:
             size = self.arraysize
         
-        rows = []
-        while len(rows) < size:
-            if not odb.odbFetchRow(self.handle):
-                raise get_exception(self.handle)
-            if odb.odbNoData(self.handle):
-                break
-            
-            row = []
-            for column in range(1, len(self.description)+1):
-                if odb.odbColTruncated(self.handle, column):
-                    msg = 'Column %d was truncated. Actual size is %d.' % (
-                        column, odb.odbColActualLen(self.handle, column)
-                        )
-                    raise Warning(msg)
-                
-                data_address = odb.odbColData(self.handle, column)
-                data_length = odb.odbColDataLen(self.handle, column)
-                data_type = self.description[column - 1][1]
-                row.append(get_data(data_address, data_type, data_length))
-            rows.append(tuple(row))
-    
-        return rows
+        if self._merged_rows is not None:
+            start = self._merged_index
+            self._merged_index = min(start + size, len(self._merged_rows))
+            return self._merged_rows[start:self._merged_index]
+        
+        if self._prefetcher is not None:
+            rows = self._prefetcher.take(size)
+            if len(rows) == size or self._prefetcher.finished:
+                return rows
+            # Background fetching was stopped so that the connection could
+            # be used for something else. Carry on without it.
+            self._prefetcher = None
+            return rows + self.fetchmany(size - len(rows))
+        
+        self.connection._pause_prefetch()
+        return self._fetch_rows(size)
     
     def fetchall(self):
         """Fetch all remaining rows of a query result.
         
         Returns a list of tuples. Note that the cursor's arraysize
         attribute can affect the performance of this operation.
+        
+        If the cursor's memory_budget attribute is set to a number of bytes,
+        and the rows grow beyond that size, the rows are moved to a temporary
+        file and a SpilledRows sequence (see odbtp.spill) is returned
+        instead of a list. It should be closed when no longer needed.
         """
         rows = []
+        used = 0
         # We'll default to 20 rows at a time, but if the user has set
         # arraysize even larger, then we'll use that setting.
         size = max(20, self.arraysize)
         while True:
             new_rows = self.fetchmany(size)
+            if self.memory_budget is not None and isinstance(rows, list):
+                used += estimate_size(new_rows)
+                if used > self.memory_budget:
+                    rows = SpilledRows(rows)
             rows.extend(new_rows)
             if len(new_rows) < size:
                 # All rows have been retrieved
@@ -319,11 +1491,43 @@ class Cursor:
             return result[0]
     
     def nextset(self):
-        """Switch to the next result set, if there is one.
+        """Skip to the next result set, discarding any unfetched rows.
+        
+        Returns True if there is another result set, in which case the
+        description and rowcount attributes are updated to describe it.
+        Otherwise, returns None and leaves the cursor without a result set.
         """
         self._assert_cursor_is_open()
+        if self.handle is None:
+            return None
+        self._end_result_set()
+        self.connection._pause_prefetch()
         if not odb.odbFetchNextResult(self.handle):
+            self.connection.rollback()
             raise get_exception(self.handle)
+        
+        if odb.odbNoData(self.handle):
+            self._end_result_set()
+            self.description = None
+            self.rowcount = -1
+            if self._outputs_pending:
+                self._get_output_parameters()
+            self._release_procedure()
+            return None
+        
+        self._start_result_set()
+        return True
+    
+    def resultsets(self):
+        """Iterate over the current result set and all of those after it.
+        
+        The cursor itself is returned for each result set, so that rows can
+        be fetched from each set in the usual way before moving on.
+        """
+        self._assert_cursor_is_open()
+        yield self
+        while self.nextset():
+            yield self
     
     def setinputsizes(self, *sizes):
         """This can be used to predefine an operation's parameter information.
@@ -346,7 +1550,7 @@ class Cursor:
             sizes = sizes[0]
         
         for item in sizes:
-            if not isinstance(item, DbApiTypeObject):
+            if not isinstance(item, _DbApiTypeObject):
                 raise InterfaceError('Input sizes must use Type Objects.')
         
         self.input_sizes = tuple(sizes)
@@ -365,6 +1569,346 @@ class Cursor:
         """
         if not self.open or not self.connection.open: 
             raise InterfaceError('Cursor or connection has been closed.')
+        self._check_generation()
+    
+    def _check_generation(self):
+        """Abandon the cursor's handles and result set if the connection
+        has abandoned its own handles since they were obtained, after a
+        fork.
+        """
+        connection = self.connection
+        connection._check_process()
+        if self._generation == connection._generation:
+            return
+        self._generation = connection._generation
+        self.handle = None
+        self._procedure = None
+        self._own_handle = None
+        self._outputs_pending = False
+        self._prefetcher = None
+        self._result_set = None
+        self._cached_description = None
+        self._merged_rows = None
+        self.prepared_operation = None
+        self.description = None
+        self.rowcount = -1
+    
+    def _run(self, method, arguments, operation, idempotent):
+        """Call method(*arguments), logging in again if the connection is
+        lost, and calling it again if that is safe (see Connection).
+        """
+        connection = self.connection
+        policy = connection.retry_policy
+        if policy is None:
+            return method(*arguments)
+        attempts = 1
+        while True:
+            repeatable = (connection._autocommit or connection.committed) \
+                and (idempotent or operation is not None
+                    and is_query(operation))
+            try:
+                return method(*arguments)
+            except Error:
+                error = sys.exc_info()
+                if not connection.open \
+                        or not policy.is_transport_error(error[1]):
+                    raise
+            try:
+                connection._reconnect()
+            except Error, e:
+                if getattr(e, '_after_login', False):
+                    # The login worked, but setting up the session did not.
+                    raise
+                # The login is tried again when the connection is next used.
+                raise error[0], error[1], error[2]
+            # A failed flush of write-behind statements has lost them, which
+            # running the statement again would hide.
+            if not repeatable or attempts >= policy.max_attempts \
+                    or getattr(error[1], '_from_flush', False):
+                raise error[0], error[1], error[2]
+            attempts += 1
+    
+    def _bind_parameters(self, parameters):
+        """Bind and set the parameters of the prepared operation from the
+        types of their values.
+        """
+        native = self.connection.native_parameters
+        total_cols = len(parameters)
+        bound_parameters = []
+        for index, value in enumerate(parameters):
+            db_api_type = get_db_api_type(self, value, native)
+            db_api_type.bind_to_column(self, index + 1, total_cols)
+            bound_parameters.append((db_api_type, value))
+        
+        for db_api_type, value in bound_parameters:
+            db_api_type.set_parameter(value)
+    
+    def _ensure_handle(self):
+        """Get a query handle from the connection if there is none yet.
+        """
+        if self.handle is None:
+            self.handle = self.connection._allocate_query_handle()
+    
+    def _queue_write(self, operation, parameters):
+        """Queue an operation with the connection's write-behind queue.
+        
+        Returns False, leaving the operation to be executed normally, if it
+        is not a statement that can be queued.
+        """
+        self._assert_cursor_is_open()
+        if not is_dml(operation):
+            return False
+        expansions = expand_lists(operation, parameters, self.max_list_size)
+        if expansions is None:
+            expansions = [(operation, parameters)]
+        
+        self._end_result_set()
+        self._release_procedure()
+        self.description = None
+        self.rowcount = -1
+        for expanded, values in expansions:
+            self.connection._queue_write(self, expanded, values)
+        return True
+    
+    def _execute_chunks(self, expansions):
+        """Execute each of a list of (operation, parameters) pairs, and
+        merge their rows and row counts.
+        
+        The merged rows are kept within the memory budget like those of
+        fetchall(): once they grow beyond it, they are moved to a
+        SpilledRows sequence, and later chunks are added to it.
+        """
+        rows = []
+        used = 0
+        rowcount = 0
+        for operation, parameters in expansions:
+            self._executemany(operation, (parameters,))
+            if self.description is not None:
+                chunk_rows = self.fetchall()
+                if isinstance(chunk_rows, SpilledRows):
+                    if not rows:
+                        rows = chunk_rows
+                    else:
+                        if isinstance(rows, list):
+                            rows = SpilledRows(rows)
+                        rows.extend(chunk_rows)
+                        chunk_rows.close()
+                else:
+                    if self.memory_budget is not None and \
+                            isinstance(rows, list):
+                        used += estimate_size(chunk_rows)
+                        if used > self.memory_budget:
+                            rows = SpilledRows(rows)
+                    rows.extend(chunk_rows)
+            if rowcount >= 0 and self.rowcount >= 0:
+                rowcount += self.rowcount
+            else:
+                rowcount = -1
+        self.rowcount = rowcount
+        if self.description is not None:
+            self._merged_rows = rows
+    
+    def _execute(self, sql, operation):
+        """Execute sql, or the prepared statement if it is None, and time
+        it under the fingerprint of operation.
+        """
+        started = time.time()
+        if sql is not None:
+            sql = encode_sql(sql)
+        if not odb.odbExecute(self.handle, sql):
+            self.connection.rollback()
+            raise get_exception(self.handle)
+        elapsed = time.time() - started
+        _QUERY_SECONDS.observe(elapsed, (fingerprint(operation),))
+    
+    def _fetch_rows(self, size):
+        """Fetch and convert up to size rows from the server.
+        
+        This does the work of fetchmany(), and is also run by the thread
+        of a _Prefetcher.
+        """
+        if self._padded_columns is None:
+            self._padded_columns = self._get_padded_columns()
+        if self._decode_plan is None:
+            self._decode_plan = DecodePlan(
+                self.description,
+                self.converters
+                )
+        if self.lazy_rows:
+            return self._fetch_lazy_rows(size)
+        converters = self._decode_plan.converters
+        
+        rows = []
+        received = 0
+        while len(rows) < size:
+            if not odb.odbFetchRow(self.handle):
+                raise get_exception(self.handle)
+            if odb.odbNoData(self.handle):
+                break
+            
+            row = []
+            lengths = []
+            for column in range(1, len(self.description)+1):
+                if odb.odbColTruncated(self.handle, column):
+                    msg = 'Column %d was truncated. Actual size is %d.' % (
+                        column, odb.odbColActualLen(self.handle, column)
+                        )
+                    raise Warning(msg)
+                
+                data_address = odb.odbColData(self.handle, column)
+                if data_address:
+                    data_length = odb.odbColDataLen(self.handle, column)
+                    row.append(converters[column - 1](
+                        data_address,
+                        data_length
+                        ))
+                    lengths.append(data_length)
+                    received += data_length
+                else:
+                    row.append(None)
+                    lengths.append(-1)
+            rows.append(tuple(row))
+            
+            for column, column_size in self._padded_columns:
+                length = lengths[column - 1]
+                if length >= 0:
+                    self._count_stat('bytes_saved', column_size - length)
+        
+        self._count_stat('rows', len(rows))
+        self._count_stat('bytes', received)
+        return rows
+    
+    def _fetch_lazy_rows(self, size):
+        """Fetch up to size rows from the server as LazyRow objects.
+        
+        The data of each row is copied into a single buffer, and converted
+        later by the row itself.
+        """
+        plan = self._decode_plan
+        rows = []
+        received = 0
+        while len(rows) < size:
+            if not odb.odbFetchRow(self.handle):
+                raise get_exception(self.handle)
+            if odb.odbNoData(self.handle):
+                break
+            
+            values = []
+            layout = []
+            row_length = 0
+            for column in range(1, len(self.description)+1):
+                if odb.odbColTruncated(self.handle, column):
+                    msg = 'Column %d was truncated. Actual size is %d.' % (
+                        column, odb.odbColActualLen(self.handle, column)
+                        )
+                    raise Warning(msg)
+                
+                data_address = odb.odbColData(self.handle, column)
+                if data_address:
+                    data_length = odb.odbColDataLen(self.handle, column)
+                    values.append((data_address, row_length, data_length))
+                    layout.append(row_length)
+                    layout.append(data_length)
+                    row_length += data_length
+                else:
+                    layout.append(0)
+                    layout.append(-1)
+            
+            data_buffer = create_string_buffer(row_length + BUFFER_PADDING)
+            base = addressof(data_buffer)
+            for data_address, offset, data_length in values:
+                memmove(base + offset, data_address, data_length)
+            received += row_length
+            rows.append(LazyRow(plan, data_buffer, tuple(layout)))
+            
+            for column, column_size in self._padded_columns:
+                length = layout[2 * column - 1]
+                if length >= 0:
+                    self._count_stat('bytes_saved', column_size - length)
+        
+        self._count_stat('rows', len(rows))
+        self._count_stat('bytes', received)
+        return rows
+    
+    def _start_result_set(self, operation=None):
+        """Set up the cursor for a new result set.
+        
+        This is for internal use only, to be run after each execution, and
+        after moving to another result set.
+        
+        If the result comes from executing a prepared operation, pass the
+        operation. The description is then kept, and reused as long as the
+        same operation is executed again, instead of being rebuilt.
+        """
+        self._end_result_set()
+        cached = self._cached_description
+        if operation is not None and cached is not None \
+                and cached[0] == operation \
+                and cached[1].full_column_info == \
+                    self.connection._get_attribute(ODB_ATTR_FULLCOLINFO):
+            self._result_set = cached[1]
+            self._result_set.current = True
+            self.description = cached[2]
+        else:
+            self._result_set = _ResultSet(self.connection, self.handle)
+            self._update_description()
+            if operation is not None:
+                self._cached_description = (
+                    operation,
+                    self._result_set,
+                    self.description
+                    )
+        self.rowcount = odb.odbGetRowCount(self.handle)
+        self.stats = {'rows': 0, 'bytes': 0, 'bytes_saved': 0}
+        self.connection.stats['queries'] += 1
+        self._padded_columns = None
+        self._decode_plan = None
+        
+        if self.prefetch and self.description is not None:
+            self._prefetcher = _Prefetcher(
+                self,
+                max(20, self.arraysize),
+                self.prefetch
+                )
+            self.connection._prefetcher = self._prefetcher
+    
+    def _end_result_set(self):
+        """Stop work on the last result set and mark its column info as gone.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.pause()
+            self._prefetcher = None
+        if isinstance(self._merged_rows, SpilledRows):
+            self._merged_rows.close()
+        self._merged_rows = None
+        self._merged_index = 0
+        if self._result_set is not None:
+            self._result_set.current = False
+            self._result_set = None
+    
+    def _get_padded_columns(self):
+        """Return (column, size) pairs for CHAR columns the server trims.
+        
+        The size of these columns is used to count how many bytes of
+        padding were saved. Only fixed length SQL_CHAR columns are padded;
+        VARCHAR columns, which are also ODB_CHAR, are not. With use_unicode,
+        CHAR columns arrive as ODB_WCHAR and are left out (see Connection).
+        """
+        if not self.connection._get_attribute(ODB_ATTR_RIGHTTRIMTEXT):
+            return ()
+        padded_columns = []
+        for column, description in enumerate(self.description or ()):
+            if description.type_code == ODB_CHAR and \
+                    odb.odbColSqlType(self.handle, column + 1) == SQL_CHAR:
+                size = odb.odbColSize(self.handle, column + 1)
+                padded_columns.append((column + 1, size))
+        return padded_columns
+    
+    def _count_stat(self, key, amount):
+        """Add to a statistic for both the cursor and the connection.
+        """
+        self.stats[key] += amount
+        self.connection.stats[key] += amount
     
     def _update_description(self):
         """Update the description attribute.
@@ -376,27 +1920,88 @@ class Cursor:
         Each of these sequences contains information describing one result
         column: (name, type_code, display_size, internal_size, precision,
         scale, null_ok). The first two items (name and type_code) are
-        mandatory, the other five are optional and are set to None in this
-        implementation of the standard.
+        mandatory, the other five are optional. Here, they are only looked
+        up when first used (see ColumnDescription).
+        
+        The description is None for operations that do not return rows.
         """
         odb.odbColName.restype = c_char_p
         num_columns = odb.odbGetTotalCols(self.handle)
+        if not num_columns:
+            self.description = None
+            return
         description = []
         for column in range(1, num_columns+1):
-            col_description = (
+            col_description = ColumnDescription(
+                self._result_set,
+                column,
                 odb.odbColName(self.handle, column),
-                get_odb_type(self.handle, column),
-                None, None, None, None, None
+                get_odb_type(
+                    self.handle,
+                    column,
+                    self.connection.use_unicode
+                    )
                 )
             description.append(col_description)
         self.description = description
     
+    def _use_procedure(self, procname):
+        """Borrow a prepared procedure from the connection.
+        
+        The cursor's own query handle is set aside while the procedure's
+        handle is in use, so that results can be fetched in the usual way.
+        """
+        self._release_procedure()
+        self._procedure = self.connection._get_procedure(procname)
+        self._own_handle = self.handle
+        self.handle = self._procedure.handle
+    
+    def _release_procedure(self):
+        """Give back any procedure borrowed with _use_procedure().
+        """
+        if self._procedure is None:
+            return
+        self.connection._release_procedure(self._procedure)
+        self.handle = self._own_handle
+        self._procedure = None
+        self._own_handle = None
+        self._outputs_pending = False
+    
+    def _get_output_parameters(self):
+        """Retrieve the output parameters and return value of a procedure.
+        
+        This is for internal use only, to be run after callproc() once
+        the procedure has no more results pending.
+        """
+        self._outputs_pending = False
+        procedure = self._procedure
+        if not odb.odbGetOutputParams(self.handle):
+            raise get_exception(self.handle)
+        
+        for index, number in enumerate(procedure.arguments):
+            if number in procedure.outputs:
+                self.procparams[index] = self._get_parameter_data(number)
+        if procedure.return_value:
+            self.return_value = self._get_parameter_data(
+                procedure.return_value
+                )
+    
+    def _get_parameter_data(self, number):
+        """Return the value of a parameter as a python type.
+        """
+        return get_data(
+            odb.odbParamData(self.handle, number),
+            odb.odbParamDataType(self.handle, number),
+            odb.odbParamDataLen(self.handle, number)
+            )
+    
     def _prepare_operation(self, operation, total_cols):
         """Prepare an operation with the ODBTP server.
         
         This also pre-binds any parameter info supplied by .setinputsizes()
         """
-        if not odb.odbPrepare(self.handle, operation):
+        self._cached_description = None
+        if not odb.odbPrepare(self.handle, encode_sql(operation)):
             self.connection.rollback()
             raise get_exception(self.handle)
         
@@ -0,0 +1,133 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Choose how the values of result columns are converted to python.
+
+By default, each ODB type is converted as listed in
+odbtp.types.ODB_TO_PYTHON. Every connection and cursor has a
+ConverterRegistry in its converters attribute, where other converters can
+be set for an ODB type, or for a single column by name or index:
+    
+    from odbtp import converters
+    from odbtp.constants import ODB_NUMERIC
+    
+    connection.converters.register(ODB_NUMERIC, converters.numeric_as_float)
+    cursor = connection.cursor()
+    cursor.converters.register_column('Created', converters.datetime_as_epoch)
+
+A converter is a function taking the address and length of the data of a
+value, and returning the python value. It is never called for nulls. The
+converter of each column is looked up once, when a result set starts, so
+registering converters adds nothing to the cost of converting each value.
+Changes only take effect from the next result set.
+
+The converters in this module skip the more costly parts of the default
+conversions, for code that does not need Decimal or datetime objects.
+"""
+
+import calendar
+
+from ctypes import *
+
+from odbtp.types import ODB_TO_PYTHON, _TIMESTAMP
+
+class ConverterRegistry:
+    """The converters set for a connection or cursor.
+    
+    A cursor's registry has the registry of its connection as its parent.
+    The converter of a column is the first one found in this order: one set
+    for the column in this registry, then in each parent; one set for the
+    column's type in this registry, then in each parent; and finally the
+    default for the type.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._types = {}
+        self._columns = {}
+    
+    def register(self, odb_type, converter):
+        """Use a converter for all columns of an ODB type.
+        """
+        self._types[odb_type] = converter
+    
+    def register_column(self, column, converter):
+        """Use a converter for a column, given by name or by index (counting
+        from 0).
+        """
+        self._columns[column] = converter
+    
+    def unregister(self, odb_type):
+        """Stop using the converter set for an ODB type, if any.
+        """
+        self._types.pop(odb_type, None)
+    
+    def unregister_column(self, column):
+        """Stop using the converter set for a column, if any.
+        """
+        self._columns.pop(column, None)
+    
+    def get(self, index, name, odb_type):
+        """Return the converter for a column, or None if there is none.
+        """
+        registry = self
+        while registry is not None:
+            columns = registry._columns
+            if columns:
+                if columns.has_key(index):
+                    return columns[index]
+                if columns.has_key(name):
+                    return columns[name]
+            registry = registry.parent
+        registry = self
+        while registry is not None:
+            if registry._types.has_key(odb_type):
+                return registry._types[odb_type]
+            registry = registry.parent
+        return ODB_TO_PYTHON.get(odb_type)
+
+########################## Built-in fast converters ##########################
+
+def raw_bytes(address, length):
+    """Return the data as the server sent it, as a str.
+    """
+    return string_at(address, length)
+
+def numeric_as_float(address, length):
+    """Return ODB_NUMERIC data as a float rather than a Decimal.
+    """
+    return float(string_at(address, length))
+
+def numeric_as_string(address, length):
+    """Return ODB_NUMERIC data as the decimal string sent by the server.
+    """
+    return string_at(address, length)
+
+def wchar_as_utf8(address, length):
+    """Return ODB_WCHAR data as the UTF-8 str sent by the server, rather
+    than as unicode.
+    """
+    return string_at(address, length)
+
+def date_as_string(address, length):
+    """Return ODB_DATE data as a 'YYYY-MM-DD' string.
+    """
+    return string_at(address, length)
+
+def time_as_string(address, length):
+    """Return ODB_TIME data as a 'HH:MM:SS' string.
+    """
+    return string_at(address, length)
+
+def datetime_as_epoch(address, length):
+    """Return ODB_DATETIME data as an int counting seconds since the epoch.
+    
+    The timestamp is taken to be in UTC, and fractions of a second are
+    dropped.
+    """
+    fields = _TIMESTAMP.unpack(string_at(address, _TIMESTAMP.size))
+    return calendar.timegm(fields[:6])
+
+def datetime_as_tuple(address, length):
+    """Return ODB_DATETIME data as a (year, month, day, hour, minute,
+    second, fraction) tuple, where the fraction is in nanoseconds.
+    """
+    return _TIMESTAMP.unpack(string_at(address, _TIMESTAMP.size))
@@ -0,0 +1,231 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Spread connections over several ODBTP gateway servers.
+
+connect() accepts a list of servers in place of a single one. Each item
+is a host name, a (host, port) pair, or a (host, port, weight) triple:
+    
+    connection = connect('DSN=ORDERS', [
+        ('gateway-1', 2799, 2),
+        ('gateway-2', 2799, 1),
+        'gateway-3',
+        ])
+
+Servers are tried one at a time until a login succeeds. The order is
+random, but favours servers with a higher weight, a better record of
+successful logins and faster logins. A server whose login fails with a
+connection error is ejected for a while, and tried last until then. Once
+that time is up, a single login is allowed through to probe it; if that
+fails too, it is ejected for twice as long, up to max_eject_time. If the
+probe is not made, because another server was logged in to first, another
+one is allowed through after eject_time seconds.
+
+What is known about each server is kept in a HealthRegistry, shared by
+every connection in the process.
+"""
+
+import time
+import random
+
+from odbtp.errors import *
+from odbtp.constants import *
+from odbtp.metrics import _ProcessLock
+
+# Login errors that mean a server is unreachable, rather than that the
+# login itself was refused.
+FAILOVER_ERRORS = (
+    ODBTPERR_CONNECT,
+    ODBTPERR_HOSTRESOLVE,
+    ODBTPERR_TIMEOUTCONN,
+    ODBTPERR_READ,
+    ODBTPERR_SEND,
+    ODBTPERR_TIMEOUTREAD,
+    ODBTPERR_TIMEOUTSEND,
+    ODBTPERR_DISCONNECTED,
+    )
+
+class EndpointHealth:
+    """What is known about one server.
+    
+    latency is a moving average of the time taken to log in, in seconds,
+    or None if no login has succeeded yet. health is a moving average of
+    the outcome of logins, from 0 (all failed) to 1 (all succeeded).
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.latency = None
+        self.health = 1.0
+        self.ejections = 0
+        self.ejected_until = None
+    
+    def __repr__(self):
+        return '<EndpointHealth %s:%d health=%.2f latency=%s>' % (
+            self.host, self.port, self.health, self.latency
+            )
+
+class HealthRegistry:
+    """The health of each server that connections have been made to.
+    
+    smoothing is the weight given to each new observation in the moving
+    averages. An unreachable server is ejected for eject_time seconds the
+    first time, doubling each time after that up to max_eject_time.
+    """
+    def __init__(self, smoothing=0.3, eject_time=5.0, max_eject_time=60.0):
+        self.smoothing = smoothing
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self._endpoints = {}
+        self._lock = _ProcessLock()
+    
+    def get(self, host, port):
+        """Return the EndpointHealth of a server, creating it if need be.
+        """
+        self._lock.acquire()
+        try:
+            return self._get(host, port)
+        finally:
+            self._lock.release()
+    
+    def plan(self, servers, port=2799, rng=random):
+        """Return the order in which to try a list of servers.
+        
+        The result is a list of EndpointHealth objects. Servers that are
+        available are picked by weighted random choice first; ejected
+        servers follow, those due back soonest first.
+        """
+        now = time.time()
+        available = []
+        ejected = []
+        self._lock.acquire()
+        try:
+            for host, server_port, weight in _parse_servers(servers, port):
+                endpoint = self._get(host, server_port)
+                if endpoint.ejected_until is None:
+                    available.append((endpoint, weight))
+                elif endpoint.ejected_until <= now:
+                    # Let this login through as a probe, and keep the
+                    # server out of other plans while it is made.
+                    endpoint.ejected_until = now + self.eject_time
+                    available.append((endpoint, weight))
+                else:
+                    ejected.append((endpoint.ejected_until, endpoint))
+            latencies = [
+                endpoint.latency for endpoint, weight in available
+                if endpoint.latency is not None
+                ]
+        finally:
+            self._lock.release()
+        
+        # Servers without a latency yet are assumed to be as fast as the
+        # fastest known one, so that they get tried.
+        if latencies:
+            default_latency = min(latencies)
+        else:
+            default_latency = 1.0
+        scored = []
+        for endpoint, weight in available:
+            latency = endpoint.latency
+            if latency is None:
+                latency = default_latency
+            score = weight * max(endpoint.health, 0.01) / max(latency, 0.001)
+            scored.append([score, endpoint])
+        
+        order = []
+        while scored:
+            total = sum([score for score, endpoint in scored])
+            point = rng.random() * total
+            for index, (score, endpoint) in enumerate(scored):
+                point -= score
+                if point < 0:
+                    break
+            order.append(scored.pop(index)[1])
+        ejected.sort()
+        order.extend([endpoint for until, endpoint in ejected])
+        return order
+    
+    def succeeded(self, endpoint, latency):
+        """Record a successful login, which took latency seconds.
+        """
+        self._lock.acquire()
+        try:
+            alpha = self.smoothing
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += alpha * (latency - endpoint.latency)
+            endpoint.health += alpha * (1.0 - endpoint.health)
+            endpoint.ejections = 0
+            endpoint.ejected_until = None
+        finally:
+            self._lock.release()
+    
+    def failed(self, endpoint):
+        """Record a login that failed because the server was unreachable,
+        and eject the server.
+        """
+        self._lock.acquire()
+        try:
+            endpoint.health -= self.smoothing * endpoint.health
+            endpoint.ejections += 1
+            eject_time = min(
+                self.eject_time * 2 ** (endpoint.ejections - 1),
+                self.max_eject_time
+                )
+            endpoint.ejected_until = time.time() + eject_time
+        finally:
+            self._lock.release()
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _get(self, host, port):
+        key = (host, port)
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = EndpointHealth(host, port)
+            self._endpoints[key] = endpoint
+        return endpoint
+
+default_registry = HealthRegistry()
+
+def connect_any(factory, servers, port=2799, registry=None):
+    """Call factory(host, port) for the servers in the order given by the
+    registry's plan, until one call succeeds, and return its result.
+    
+    A call that fails with one of the FAILOVER_ERRORS ejects the server
+    and moves on to the next one. Other errors are raised immediately. If
+    every server fails, the last error is raised.
+    """
+    if registry is None:
+        registry = default_registry
+    order = registry.plan(servers, port)
+    if not order:
+        raise ProgrammingError('At least one server is required.')
+    for endpoint in order:
+        started = time.time()
+        try:
+            result = factory(endpoint.host, endpoint.port)
+        except Error, e:
+            if getattr(e, 'odbtp_error', None) not in FAILOVER_ERRORS:
+                raise
+            registry.failed(endpoint)
+            error = e
+            continue
+        registry.succeeded(endpoint, time.time() - started)
+        return result
+    raise error
+
+def _parse_servers(servers, port):
+    """Return (host, port, weight) triples for a list of servers.
+    """
+    parsed = []
+    for server in servers:
+        if isinstance(server, basestring):
+            parsed.append((server, port, 1))
+        elif len(server) == 2:
+            parsed.append((server[0], server[1], 1))
+        elif len(server) == 3:
+            parsed.append(tuple(server))
+        else:
+            raise ProgrammingError('Bad server description %r.' % (server,))
+    return parsed
@@ -12,9 +12,23 @@ from ctypes import *
 import exceptions
 
 from odbtp.constants import *
+from odbtp import constants as _constants
+from odbtp import metrics as _metrics
 
 odb = cdll.LoadLibrary('libodbtp.so')
 
+_ERRORS_TOTAL = _metrics.registry.counter(
+    'odbtp_errors_total',
+    'Errors reported by the ODBTP client library.',
+    ('code',)
+    )
+
+# Maps ODBTPERR_* codes to their names, which label odbtp_errors_total.
+_ERROR_NAMES = dict(
+    (value, name) for name, value in vars(_constants).items()
+    if name.startswith('ODBTPERR_')
+    )
+
 class Warning(exceptions.StandardError):
     """Exception raised for important warnings, such as data truncations
     while inserting, etc.
@@ -83,13 +97,24 @@ class NotSupportedError(DatabaseError):
 def get_exception(handle):
     """Return an appropriate instance of one of the DB API error classes.
     
-    This is accomplished by examining the ODBTP and ODBC error codes.
+    This is accomplished by examining the ODBTP and ODBC error codes. The
+    ODBTPERR_* code is kept in the odbtp_error attribute of the exception,
+    and counted in the odbtp_errors_total metric.
     """
     odbtp_error = odb.odbGetError(handle)
+    error = _make_exception(handle, odbtp_error)
+    error.odbtp_error = odbtp_error
+    _ERRORS_TOTAL.inc((_ERROR_NAMES.get(odbtp_error, str(odbtp_error)),))
+    return error
+
+def _make_exception(handle, odbtp_error):
     if odbtp_error == ODBTPERR_NONE:
         return Error('Unknown error.')
     elif ODBTP_ERRORS.has_key(odbtp_error):
-        return ODBTP_ERRORS[odbtp_error]
+        # Copy the shared instance, so that raising it never leaks state
+        # (such as the odbtp_error attribute) between errors.
+        error = ODBTP_ERRORS[odbtp_error]
+        return error.__class__(*error.args)
     elif odbtp_error == ODBTPERR_SERVER:
         odb.odbGetErrorText.restype = c_char_p
         odbc_error = odb.odbGetErrorText(handle).strip()
@@ -0,0 +1,601 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""A load generator for soak testing ODBTP servers and this package.
+
+Run it as:
+    
+    python -m odbtp.loadgen [options] WORKLOAD
+
+where WORKLOAD is a JSON file describing the load. For example:
+    
+    {
+        "connect_string": "DSN=WAREHOUSE",
+        "server": "gateway",
+        "port": 2799,
+        "options": {"autocommit": true},
+        "concurrency": 8,
+        "duration": 300,
+        "think_time": [0.0, 0.05],
+        "statements": [
+            {
+                "name": "order lookup",
+                "sql": "SELECT * FROM \\"Orders\\" WHERE \\"OrderId\\" = ?",
+                "weight": 9,
+                "parameters": [{"type": "int", "min": 1, "max": 100000}]
+            },
+            {
+                "name": "new order",
+                "sql": "INSERT INTO \\"Orders\\" VALUES (?, ?, ?)",
+                "weight": 1,
+                "parameters": [
+                    {"type": "sequence", "start": 200000},
+                    {"type": "string", "min_length": 5, "max_length": 20},
+                    {"type": "date", "start": "2010-01-01", "days": 365}
+                ]
+            }
+        ]
+    }
+
+Each of the concurrency workers logs in with odbtp.connect(), using the
+options as keyword arguments, then runs statements picked at random in
+proportion to their weights until duration seconds have passed, pausing
+for think_time seconds (or a random time in a [min, max] range) between
+them. The rows of every result set are fetched. Unless a statement sets
+"commit" to false, the connection is committed after it. A statement that
+sets "rows" to a number is run with executemany() on that many sets of
+parameters at once, and each batch counts as one execution.
+
+For example, to compare sending dates and decimals as text with sending
+them in binary form (see odbtp.types.get_db_api_type), run a workload of
+batched inserts twice, with "native_parameters" set to false and to true
+in its options. This package does not ship measurements of its own; the
+difference depends on the driver and the network, so measure it against
+the servers in use:
+    
+    {
+        "connect_string": "DSN=WAREHOUSE",
+        "server": "gateway",
+        "options": {"native_parameters": true},
+        "duration": 60,
+        "statements": [
+            {
+                "name": "load readings",
+                "sql": "INSERT INTO \\"Readings\\" VALUES (?, ?, ?, ?)",
+                "rows": 500,
+                "parameters": [
+                    {"type": "timestamp", "start": "2010-01-01",
+                        "days": 365},
+                    {"type": "date", "start": "2010-01-01", "days": 365},
+                    {"type": "timestamp", "start": "2010-01-01",
+                        "days": 365},
+                    {"type": "decimal", "min": 0, "max": 1000,
+                        "scale": 2}
+                ]
+            }
+        ]
+    }
+
+The server, port, connect string, concurrency and duration can be
+overridden on the command line, so the same workload can be pointed at a
+local stand-in server before a production gateway. The report gives the
+throughput, the 50th, 95th and 99th percentile latencies, the client CPU
+time per execution and the errors per statement, and the CPU time used by
+the client process over the whole run. CPU time per statement is measured
+with the calling thread's CPU clock, which is only available on Linux.
+
+These parameter generators are available:
+    
+    {"type": "int", "min": 1, "max": 10}        A random integer.
+    {"type": "float", "min": 0, "max": 1}       A random float.
+    {"type": "choice", "values": [...]}         One of the values.
+    {"type": "string", "length": 8}             Random letters and digits,
+                                                or use min_length and
+                                                max_length.
+    {"type": "sequence", "start": 1, "step": 1} Consecutive integers,
+                                                shared by all workers.
+    {"type": "date", "start": "2010-01-01",     A random date in the days
+        "days": 365}                            from start.
+    {"type": "timestamp",                       A random timestamp, to the
+        "start": "2010-01-01", "days": 365}     millisecond, in the days
+                                                from start.
+    {"type": "decimal", "min": 0, "max": 100,   A random Decimal with scale
+        "scale": 2}                             digits after the point.
+    {"type": "const", "value": ...}             Always the same value.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import string
+import bisect
+import datetime
+import optparse
+import decimal
+import threading
+import itertools
+from ctypes import *
+from ctypes.util import find_library
+
+import odbtp
+from odbtp.metrics import Histogram
+
+# Latency buckets from 0.1 milliseconds to two minutes, each 10% wider than
+# the last, so that percentiles are estimated to within about 5%.
+LATENCY_BUCKETS = tuple([0.0001 * 1.1 ** n for n in range(147)])
+
+# The name under which logins are reported.
+CONNECT = '(connect)'
+
+class Workload:
+    """A parsed workload description. See the module documentation.
+    """
+    def __init__(self, description):
+        description = _to_str(description)
+        try:
+            self.connect_string = description['connect_string']
+            self.server = description['server']
+            self.port = description.get('port', 2799)
+            self.options = description.get('options', {})
+            self.concurrency = description.get('concurrency', 1)
+            self.duration = description.get('duration', 60)
+            self.think_time = description.get('think_time', 0)
+            self.statements = [
+                Statement(**statement)
+                for statement in description['statements']
+                ]
+        except (KeyError, TypeError), e:
+            raise odbtp.ProgrammingError('Invalid workload: %s' % e)
+        if not self.statements:
+            raise odbtp.ProgrammingError('A workload needs statements.')
+        self._weights = []
+        total = 0
+        for statement in self.statements:
+            total += statement.weight
+            self._weights.append(total)
+    
+    def choose(self, rng):
+        """Pick a statement at random in proportion to the weights.
+        """
+        point = rng.random() * self._weights[-1]
+        return self.statements[bisect.bisect_right(self._weights, point)]
+    
+    def think(self, rng):
+        """Return a think time in seconds.
+        """
+        if isinstance(self.think_time, (list, tuple)):
+            return rng.uniform(*self.think_time)
+        return self.think_time
+
+class Statement:
+    """One kind of statement in a workload.
+    """
+    def __init__(self, name, sql, weight=1, parameters=(), commit=True,
+            rows=0):
+        self.name = name
+        self.sql = sql
+        self.weight = weight
+        self.generators = [make_generator(spec) for spec in parameters]
+        self.commit = commit
+        self.rows = rows
+    
+    def parameters(self, rng):
+        """Return a new tuple of parameters for the statement.
+        """
+        return tuple([generator(rng) for generator in self.generators])
+    
+    def arguments(self, rng):
+        """Return new parameters for one run of the statement: a tuple, or
+        a list of rows tuples for a batch.
+        """
+        if self.rows:
+            return [self.parameters(rng) for row in xrange(self.rows)]
+        return self.parameters(rng)
+    
+    def run(self, cursor, arguments):
+        """Execute the statement with arguments from arguments().
+        """
+        if self.rows:
+            cursor.executemany(self.sql, arguments)
+        else:
+            cursor.execute(self.sql, arguments)
+
+class Report:
+    """The results of a run, per statement name.
+    
+    counts, errors and cpu_by_statement map statement names to the number
+    of successful executions, the number of failures and the client CPU
+    seconds used by the worker threads running them, including failures.
+    cpu_by_statement is empty if the thread CPU clock is not available.
+    latencies maps the names to Histograms of the latencies of the
+    successful executions. error_messages counts the distinct errors.
+    elapsed and cpu are the seconds taken by the whole run, and the CPU
+    seconds used by the whole client process meanwhile.
+    """
+    def __init__(self):
+        self.elapsed = 0.0
+        self.cpu = 0.0
+        self.counts = {}
+        self.errors = {}
+        self.cpu_by_statement = {}
+        self.error_messages = {}
+        self.latencies = Histogram(
+            'latency',
+            'Statement latency.',
+            ('statement',),
+            buckets=LATENCY_BUCKETS
+            )
+        self._lock = threading.Lock()
+    
+    def record(self, name, latency, error=None, cpu=None):
+        """Record one execution of a statement, and the CPU seconds its
+        thread used, if known.
+        """
+        self._lock.acquire()
+        try:
+            if cpu is not None:
+                self.cpu_by_statement[name] = (
+                    self.cpu_by_statement.get(name, 0.0) + cpu
+                    )
+            if error is None:
+                self.counts[name] = self.counts.get(name, 0) + 1
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+                message = '%s: %s' % (error.__class__.__name__, error)
+                self.error_messages[message] = (
+                    self.error_messages.get(message, 0) + 1
+                    )
+        finally:
+            self._lock.release()
+        if error is None:
+            self.latencies.observe(latency, (name,))
+    
+    def summary(self):
+        """Return a list of dictionaries, one per statement name, holding
+        its 'name', 'count', 'errors', 'throughput' (per second), 'p50',
+        'p95' and 'p99' latencies, and 'cpu' seconds per execution, which
+        is None if it was not measured.
+        """
+        names = dict.fromkeys(self.counts.keys() + self.errors.keys()).keys()
+        names.sort()
+        rows = []
+        for name in names:
+            count = self.counts.get(name, 0)
+            errors = self.errors.get(name, 0)
+            row = {
+                'name': name,
+                'count': count,
+                'errors': errors,
+                'throughput': count / max(self.elapsed, 1e-9),
+                'cpu': None,
+                }
+            if self.cpu_by_statement.has_key(name):
+                row['cpu'] = self.cpu_by_statement[name] / (count + errors)
+            for key, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+                row[key] = self.latencies.quantile(q, (name,))
+            rows.append(row)
+        return rows
+    
+    def format(self):
+        """Return the report as a text table.
+        """
+        lines = [
+            '%-24s %8s %7s %9s %9s %9s %9s %9s' % (
+                'statement', 'count', 'errors', 'per sec',
+                'p50 ms', 'p95 ms', 'p99 ms', 'cpu ms',
+                ),
+            ]
+        for row in self.summary():
+            times = []
+            for key, format in (('p50', '%.2f'), ('p95', '%.2f'),
+                    ('p99', '%.2f'), ('cpu', '%.3f')):
+                if row[key] is None:
+                    times.append('-')
+                else:
+                    times.append(format % (row[key] * 1000))
+            lines.append('%-24s %8d %7d %9.1f %9s %9s %9s %9s' % (
+                row['name'][:24], row['count'], row['errors'],
+                row['throughput'], times[0], times[1], times[2], times[3],
+                ))
+        executions = sum(self.counts.values()) + sum(self.errors.values())
+        lines.append('')
+        lines.append(
+            '%.1f seconds elapsed, %.2f seconds of client process CPU '
+            '(%.3f ms per execution).' % (
+                self.elapsed,
+                self.cpu,
+                self.cpu * 1000 / max(executions, 1),
+                )
+            )
+        if self.error_messages:
+            lines.append('')
+            lines.append('Errors:')
+            messages = self.error_messages.items()
+            messages.sort()
+            for message, count in messages:
+                lines.append('%8d  %s' % (count, message))
+        return '\n'.join(lines)
+
+def make_generator(spec):
+    """Return a function of a random.Random instance that produces values
+    according to a parameter generator description.
+    """
+    kind = spec.get('type')
+    if kind == 'int':
+        low, high = spec['min'], spec['max']
+        return lambda rng: rng.randint(low, high)
+    elif kind == 'float':
+        low, high = spec['min'], spec['max']
+        return lambda rng: rng.uniform(low, high)
+    elif kind == 'choice':
+        values = spec['values']
+        return lambda rng: rng.choice(values)
+    elif kind == 'string':
+        low = spec.get('min_length', spec.get('length', 8))
+        high = spec.get('max_length', spec.get('length', 8))
+        chars = string.ascii_letters + string.digits
+        return lambda rng: ''.join(
+            [rng.choice(chars) for i in xrange(rng.randint(low, high))]
+            )
+    elif kind == 'sequence':
+        start = spec.get('start', 1)
+        step = spec.get('step', 1)
+        counter = itertools.count()
+        lock = threading.Lock()
+        def next_value(rng):
+            lock.acquire()
+            try:
+                return start + counter.next() * step
+            finally:
+                lock.release()
+        return next_value
+    elif kind == 'date':
+        start = datetime.datetime.strptime(spec['start'], '%Y-%m-%d').date()
+        days = spec.get('days', 365)
+        return lambda rng: start + datetime.timedelta(rng.randrange(days))
+    elif kind == 'timestamp':
+        start = datetime.datetime.strptime(spec['start'], '%Y-%m-%d')
+        milliseconds = spec.get('days', 365) * 86400000
+        return lambda rng: start + datetime.timedelta(
+            milliseconds=rng.randrange(milliseconds)
+            )
+    elif kind == 'decimal':
+        low, high = spec['min'], spec['max']
+        scale = spec.get('scale', 2)
+        quantum = decimal.Decimal(1).scaleb(-scale)
+        return lambda rng: decimal.Decimal(
+            repr(rng.uniform(low, high))
+            ).quantize(quantum)
+    elif kind == 'const':
+        value = spec.get('value')
+        return lambda rng: value
+    raise odbtp.ProgrammingError('Unknown parameter generator %r.' % kind)
+
+def run(workload, seed=None):
+    """Run a workload and return a Report.
+    """
+    report = Report()
+    deadline = time.time() + workload.duration
+    threads = []
+    start_cpu = _cpu_time()
+    started = time.time()
+    for number in range(workload.concurrency):
+        if seed is None:
+            rng = random.Random()
+        else:
+            rng = random.Random(seed + number)
+        thread = threading.Thread(
+            target=_work,
+            args=(workload, report, deadline, rng)
+            )
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.isAlive():
+            thread.join(1)
+    report.elapsed = time.time() - started
+    report.cpu = _cpu_time() - start_cpu
+    return report
+
+def main(argv=None):
+    """Run the load generator from the command line.
+    """
+    parser = optparse.OptionParser(
+        usage='python -m odbtp.loadgen [options] WORKLOAD'
+        )
+    parser.add_option('-s', '--server', help='override the server')
+    parser.add_option('-p', '--port', type='int', help='override the port')
+    parser.add_option('-c', '--connect-string', dest='connect_string',
+        help='override the connect string')
+    parser.add_option('-n', '--concurrency', type='int',
+        help='override the number of workers')
+    parser.add_option('-d', '--duration', type='float',
+        help='override the duration in seconds')
+    parser.add_option('--seed', type='int',
+        help='seed the random choices, for repeatable runs')
+    parser.add_option('--json', action='store_true',
+        help='print the report as JSON')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('exactly one workload file is required')
+    
+    stream = open(args[0])
+    try:
+        workload = Workload(json.load(stream))
+    finally:
+        stream.close()
+    for name in ('server', 'port', 'connect_string', 'concurrency',
+            'duration'):
+        value = getattr(options, name)
+        if value is not None:
+            setattr(workload, name, value)
+    
+    report = run(workload, options.seed)
+    if options.json:
+        print json.dumps({
+            'elapsed': report.elapsed,
+            'cpu': report.cpu,
+            'statements': report.summary(),
+            'errors': report.error_messages,
+            }, indent=2)
+    else:
+        print report.format()
+    if report.errors:
+        return 1
+    return 0
+
+def _work(workload, report, deadline, rng):
+    """Run statements on one connection until the deadline.
+    """
+    connection = None
+    while time.time() < deadline:
+        if connection is None:
+            connection = _connect(workload, report)
+            if connection is None:
+                time.sleep(min(1.0, max(0, deadline - time.time())))
+                continue
+        
+        statement = workload.choose(rng)
+        arguments = statement.arguments(rng)
+        started = time.time()
+        start_cpu = _thread_cpu_time()
+        try:
+            cursor = connection.cursor()
+            try:
+                statement.run(cursor, arguments)
+                while cursor.description is not None:
+                    cursor.fetchall()
+                    if not cursor.nextset():
+                        break
+            finally:
+                cursor.close()
+            if statement.commit:
+                connection.commit()
+        except odbtp.Error, e:
+            report.record(statement.name, time.time() - started, e,
+                _cpu_since(start_cpu))
+            connection = _recover(connection)
+        else:
+            report.record(statement.name, time.time() - started, None,
+                _cpu_since(start_cpu))
+        
+        pause = min(workload.think(rng), deadline - time.time())
+        if pause > 0:
+            time.sleep(pause)
+    
+    if connection is not None and connection.open:
+        try:
+            connection.close()
+        except odbtp.Error:
+            pass
+
+def _connect(workload, report):
+    """Log in, recording the time taken under CONNECT. Returns None if the
+    login failed.
+    """
+    started = time.time()
+    start_cpu = _thread_cpu_time()
+    try:
+        connection = odbtp.connect(
+            workload.connect_string,
+            workload.server,
+            workload.port,
+            **workload.options
+            )
+    except odbtp.Error, e:
+        report.record(CONNECT, time.time() - started, e,
+            _cpu_since(start_cpu))
+        return None
+    report.record(CONNECT, time.time() - started, None,
+        _cpu_since(start_cpu))
+    return connection
+
+def _recover(connection):
+    """Roll back after an error. Returns the connection if it can still be
+    used, or None if a new one is needed.
+    """
+    try:
+        connection.rollback()
+        return connection
+    except odbtp.Error:
+        pass
+    try:
+        if connection.open:
+            connection.close()
+    except odbtp.Error:
+        pass
+    return None
+
+def _cpu_time():
+    """Return the user and system CPU time used by the process so far,
+    by every thread.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+class _Timespec(Structure):
+    _fields_ = [('tv_sec', c_long), ('tv_nsec', c_long)]
+
+# The Linux clock that measures the CPU time of the calling thread.
+_CLOCK_THREAD_CPUTIME_ID = 3
+
+def _load_clock_gettime():
+    """Return the C library's clock_gettime() function, or None if the
+    thread CPU clock cannot be used.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    # Older C libraries keep clock_gettime() in librt.
+    for name in ('c', 'rt'):
+        path = find_library(name)
+        if path is None:
+            continue
+        try:
+            function = CDLL(path).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        function.argtypes = [c_int, POINTER(_Timespec)]
+        function.restype = c_int
+        return function
+    return None
+
+_clock_gettime = _load_clock_gettime()
+
+def _thread_cpu_time():
+    """Return the CPU time used by the calling thread so far, or None if
+    it cannot be measured.
+    """
+    if _clock_gettime is None:
+        return None
+    value = _Timespec()
+    if _clock_gettime(_CLOCK_THREAD_CPUTIME_ID, byref(value)) != 0:
+        return None
+    return value.tv_sec + value.tv_nsec * 1e-9
+
+def _cpu_since(start):
+    """Return the CPU seconds used by the calling thread since start, a
+    value returned by _thread_cpu_time(), or None.
+    """
+    if start is None:
+        return None
+    end = _thread_cpu_time()
+    if end is None:
+        return None
+    return end - start
+
+def _to_str(value):
+    """Convert the unicode strings produced by the json module into plain
+    strings, recursively.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_to_str(item) for item in value]
+    elif isinstance(value, dict):
+        return dict([(_to_str(k), _to_str(v)) for k, v in value.items()])
+    return value
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,417 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Counters and histograms describing the work done by this package.
+
+The package records the following metrics in the default registry:
+    
+    odbtp_connect_seconds       Time taken to log in, by server.
+    odbtp_query_seconds         Time taken to execute statements, by the
+                                fingerprint of the statement (see
+                                odbtp.sql.fingerprint).
+    odbtp_errors_total          Errors reported by the client library, by
+                                ODBTPERR_* code.
+    odbtp_pool_size             Connections each pool may hold.
+    odbtp_pool_in_use           Connections checked out of each pool.
+    odbtp_pool_waiting          Threads waiting for a pooled connection.
+    odbtp_pool_wait_seconds     Time spent waiting in acquire().
+    odbtp_pool_timeouts_total   Calls to acquire() that timed out.
+
+Histograms use a fixed set of buckets, so recording a value only costs a
+binary search and a few additions. Use snapshot() to read the metrics from
+python, or render() to get them in the Prometheus text exposition format,
+which a host application can serve from its own HTTP endpoint.
+"""
+
+import os
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the default histogram buckets.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    )
+
+# Label values used for series beyond a metric's max_series.
+OVERFLOW_LABEL = 'other'
+
+_INFINITY = float('inf')
+
+class _ProcessLock:
+    """A lock that a forked child process replaces with a new one.
+    
+    This is for internal use only. A lock that another thread held when
+    the process forked stays locked in the child, where no thread is left
+    to release it.
+    """
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._lock = threading.Lock()
+        self._lock.acquire()
+    
+    def release(self):
+        self._lock.release()
+
+class _Metric:
+    """The base class of the metric types. This is for internal use only.
+    
+    Each metric holds one series of values per distinct tuple of label
+    values. To keep memory bounded when label values are not under the
+    control of the application, at most max_series series are kept; values
+    for any further label tuples are all recorded under OVERFLOW_LABEL.
+    """
+    kind = None
+    
+    def __init__(self, name, help, labelnames=(), max_series=1000):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._series = {}
+        self._lock = _ProcessLock()
+    
+    def reset(self):
+        """Forget every recorded value.
+        """
+        self._lock.acquire()
+        try:
+            self._series = {}
+        finally:
+            self._lock.release()
+    
+    def _get_series(self, labels):
+        """Return the series for a tuple of label values, creating it if
+        need be. The caller must hold the lock.
+        """
+        series = self._series.get(labels)
+        if series is None:
+            if len(labels) != len(self.labelnames):
+                raise ValueError('%s takes the labels %s, not %r.' % (
+                    self.name, self.labelnames, labels
+                    ))
+            if len(self._series) >= self.max_series:
+                labels = (OVERFLOW_LABEL,) * len(labels)
+                series = self._series.get(labels)
+            if series is None:
+                series = self._new_series()
+                self._series[labels] = series
+        return series
+
+class Counter(_Metric):
+    """A value that only goes up, such as a number of errors.
+    """
+    kind = 'counter'
+    
+    def inc(self, labels=(), amount=1):
+        """Add amount to the series with the given label values.
+        """
+        self._lock.acquire()
+        try:
+            self._get_series(labels)[0] += amount
+        finally:
+            self._lock.release()
+    
+    def get(self, labels=()):
+        """Return the value of a series, or 0 if nothing was recorded.
+        """
+        series = self._series.get(labels)
+        if series is None:
+            return 0
+        return series[0]
+    
+    def _new_series(self):
+        return [0]
+    
+    def _snapshot(self, series):
+        return series[0]
+
+class Gauge(Counter):
+    """A value that can go up and down, such as a number of connections.
+    """
+    kind = 'gauge'
+    
+    def dec(self, labels=(), amount=1):
+        """Subtract amount from the series with the given label values.
+        """
+        self.inc(labels, -amount)
+    
+    def set(self, value, labels=()):
+        """Replace the value of the series with the given label values.
+        """
+        self._lock.acquire()
+        try:
+            self._get_series(labels)[0] = value
+        finally:
+            self._lock.release()
+
+class Histogram(_Metric):
+    """The distribution of a measured value, such as a latency.
+    
+    Values are counted in buckets with the given upper bounds, plus one
+    more for values above the last bound. The sum of the values is kept
+    as well, so the mean can be worked out.
+    """
+    kind = 'histogram'
+    
+    def __init__(self, name, help, labelnames=(), max_series=1000,
+            buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, labelnames, max_series)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value, labels=()):
+        """Record a value in the series with the given label values.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        self._lock.acquire()
+        try:
+            series = self._get_series(labels)
+            series[0][index] += 1
+            series[1] += value
+        finally:
+            self._lock.release()
+    
+    def get(self, labels=()):
+        """Return a dictionary describing a series, or None if nothing was
+        recorded. See Registry.snapshot() for its contents.
+        """
+        self._lock.acquire()
+        try:
+            series = self._series.get(labels)
+            if series is None:
+                return None
+            return self._snapshot(series)
+        finally:
+            self._lock.release()
+    
+    def quantile(self, q, labels=()):
+        """Estimate the value below which a fraction q of the values fall.
+        
+        The estimate interpolates within the bucket holding the quantile,
+        so it is only as precise as the buckets are narrow. None is
+        returned if nothing was recorded, and the last bucket bound if the
+        quantile lies above it.
+        """
+        summary = self.get(labels)
+        if summary is None or not summary['count']:
+            return None
+        return _estimate_quantile(
+            self.buckets,
+            summary['counts'],
+            summary['count'],
+            q
+            )
+    
+    def _new_series(self):
+        return [[0] * (len(self.buckets) + 1), 0.0]
+    
+    def _snapshot(self, series):
+        counts, total = series
+        count = sum(counts)
+        summary = {
+            'buckets': self.buckets,
+            'counts': tuple(counts),
+            'count': count,
+            'sum': total,
+            }
+        for key, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            if count:
+                summary[key] = _estimate_quantile(
+                    self.buckets,
+                    counts,
+                    count,
+                    q
+                    )
+            else:
+                summary[key] = None
+        return summary
+
+class Registry:
+    """A named collection of metrics.
+    
+    Metrics are created through the registry, and asking for a metric that
+    already exists returns the existing one, so several modules or several
+    instances of a class can share a metric.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = _ProcessLock()
+    
+    def counter(self, name, help, labelnames=(), max_series=1000):
+        """Return the counter with the given name, creating it if need be.
+        """
+        return self._get(Counter, name, help, labelnames, max_series)
+    
+    def gauge(self, name, help, labelnames=(), max_series=1000):
+        """Return the gauge with the given name, creating it if need be.
+        """
+        return self._get(Gauge, name, help, labelnames, max_series)
+    
+    def histogram(self, name, help, labelnames=(), max_series=1000,
+            buckets=DEFAULT_BUCKETS):
+        """Return the histogram with the given name, creating it if need be.
+        """
+        return self._get(
+            Histogram,
+            name,
+            help,
+            labelnames,
+            max_series,
+            buckets
+            )
+    
+    def get(self, name):
+        """Return the metric with the given name, or None.
+        """
+        return self._metrics.get(name)
+    
+    def reset(self):
+        """Forget the values recorded by every metric.
+        """
+        for metric in self._metrics.values():
+            metric.reset()
+    
+    def snapshot(self):
+        """Return the current values of every metric.
+        
+        The result is a dictionary mapping metric names to dictionaries
+        with the keys 'type', 'help', 'labelnames' and 'values'. The values
+        map tuples of label values to numbers for counters and gauges. For
+        histograms they map to dictionaries holding the bucket bounds
+        ('buckets'), the number of values in each bucket including the one
+        above the last bound ('counts'), the 'count' and 'sum' of all the
+        values, and estimates of the 'p50', 'p95' and 'p99' quantiles.
+        """
+        result = {}
+        for name, metric in self._metrics.items():
+            metric._lock.acquire()
+            try:
+                values = {}
+                for labels, series in metric._series.items():
+                    values[labels] = metric._snapshot(series)
+            finally:
+                metric._lock.release()
+            result[name] = {
+                'type': metric.kind,
+                'help': metric.help,
+                'labelnames': metric.labelnames,
+                'values': values,
+                }
+        return result
+    
+    def render(self):
+        """Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        snapshot = self.snapshot()
+        names = snapshot.keys()
+        names.sort()
+        for name in names:
+            metric = snapshot[name]
+            lines.append('# HELP %s %s' % (name, _escape_help(metric['help'])))
+            lines.append('# TYPE %s %s' % (name, metric['type']))
+            labelnames = metric['labelnames']
+            series = metric['values'].items()
+            series.sort()
+            for labels, value in series:
+                pairs = zip(labelnames, labels)
+                if metric['type'] != 'histogram':
+                    lines.append('%s%s %s' % (
+                        name, _format_labels(pairs), _format_value(value)
+                        ))
+                    continue
+                
+                cumulative = 0
+                bounds = value['buckets'] + (None,)
+                for bound, count in zip(bounds, value['counts']):
+                    cumulative += count
+                    if bound is None:
+                        le = '+Inf'
+                    else:
+                        le = _format_value(bound)
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(pairs + [('le', le)]), cumulative
+                        ))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(pairs), _format_value(value['sum'])
+                    ))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(pairs), value['count']
+                    ))
+        lines.append('')
+        return '\n'.join(lines)
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _get(self, metric_class, name, *args):
+        self._lock.acquire()
+        try:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError('Metric %s is a %s.' % (name, metric.kind))
+            return metric
+        finally:
+            self._lock.release()
+
+registry = Registry()
+
+def snapshot():
+    """Return the current values of the default registry's metrics.
+    """
+    return registry.snapshot()
+
+def render():
+    """Return the default registry's metrics in the Prometheus text format.
+    """
+    return registry.render()
+
+def _estimate_quantile(buckets, counts, count, q):
+    """Interpolate a quantile from bucket counts.
+    """
+    rank = q * count
+    seen = 0
+    lower = 0.0
+    for index, bucket_count in enumerate(counts):
+        if index == len(buckets):
+            return buckets[-1]
+        upper = buckets[index]
+        if bucket_count and seen + bucket_count >= rank:
+            return lower + (upper - lower) * (rank - seen) / bucket_count
+        seen += bucket_count
+        lower = upper
+    return buckets[-1]
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    formatted = []
+    for name, value in pairs:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = str(value).replace('\\', '\\\\')
+        value = value.replace('"', '\\"').replace('\n', '\\n')
+        formatted.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(formatted)
+
+def _format_value(value):
+    if isinstance(value, float):
+        # The exposition format spells the special values its own way.
+        if value != value:
+            return 'NaN'
+        elif value == _INFINITY:
+            return '+Inf'
+        elif value == -_INFINITY:
+            return '-Inf'
+        return repr(value)
+    return str(value)
@@ -0,0 +1,326 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Run one query as several partitions in parallel over pooled connections.
+
+A single ODBTP connection can only have one request in flight at a time,
+so large extracts are bound by the latency of each round trip. This module
+splits a query into partitions, runs each partition on its own connection
+from a ConnectionPool, and merges the rows back into a single stream.
+
+The blocking libodbtp calls release the GIL while they wait on the
+network, so plain threads are enough to keep several connections busy.
+
+Example:
+    
+    pool = ConnectionPool('DSN=WAREHOUSE', 'gateway', size=4)
+    reader = read(pool, 'SELECT * FROM "Orders"', Modulo('"OrderId"', 8))
+    for row in reader:
+        handle(row)
+    for timing in reader.timings:
+        print timing
+"""
+
+import sys
+import time
+import threading
+import Queue
+
+from odbtp.errors import *
+
+_ROWS = 0
+_DONE = 1
+_ERROR = 2
+
+class KeyRanges:
+    """Partition a query on ranges of values in a column.
+    
+    The boundaries must be sorted and unique. They split the column into
+    half-open ranges, with an open-ended range before the first boundary
+    and after the last one so that no rows are missed. For example,
+    boundaries of (100, 200) produce three partitions: below 100, from 100
+    up to 200, and 200 or more.
+    """
+    def __init__(self, column, boundaries):
+        if not boundaries:
+            raise ProgrammingError('At least one boundary is required.')
+        boundaries = tuple(boundaries)
+        for low, high in zip(boundaries[:-1], boundaries[1:]):
+            if not low < high:
+                raise ProgrammingError(
+                    'The boundaries must be sorted and unique.'
+                    )
+        self.column = column
+        self.boundaries = boundaries
+    
+    def partitions(self):
+        """Return a list of (condition, parameters) pairs, one per partition.
+        """
+        column = self.column
+        bounds = self.boundaries
+        parts = [('%s < ?' % column, (bounds[0],))]
+        for low, high in zip(bounds[:-1], bounds[1:]):
+            condition = '%s >= ? AND %s < ?' % (column, column)
+            parts.append((condition, (low, high)))
+        parts.append(('%s >= ?' % column, (bounds[-1],)))
+        return parts
+
+class Modulo:
+    """Partition a query on the remainder of an integer column.
+    
+    The ODBC MOD and ABS scalar function escapes are used so that the
+    condition works with any driver that supports them. The remainder is
+    taken of the absolute value, since most databases give negative
+    remainders for negative values. Rows where the column is NULL do not
+    belong to any partition.
+    """
+    def __init__(self, column, count):
+        if count < 1:
+            raise ProgrammingError('At least one partition is required.')
+        self.column = column
+        self.count = count
+    
+    def partitions(self):
+        """Return a list of (condition, parameters) pairs, one per partition.
+        """
+        condition = '{fn MOD({fn ABS(%s)}, %d)} = %%d' % (
+            self.column,
+            self.count
+            )
+        return [(condition % remainder, ()) for remainder in range(self.count)]
+
+class PartitionTiming:
+    """Timing information gathered while reading one partition.
+    
+    All times are in seconds. wait is the time spent waiting for a pooled
+    connection, execute is the time taken by the execute() call, and fetch
+    is the time spent fetching rows, including any time spent blocked
+    because the consumer had not caught up yet.
+    """
+    def __init__(self, index, condition):
+        self.index = index
+        self.condition = condition
+        self.rows = 0
+        self.wait = None
+        self.execute = None
+        self.fetch = None
+        self.elapsed = None
+    
+    def __repr__(self):
+        return '<PartitionTiming %d (%s): %d rows in %s seconds>' % (
+            self.index, self.condition, self.rows, self.elapsed
+            )
+
+class ParallelReader:
+    """An iterator over the merged rows of a partitioned query.
+    
+    With ordered set, rows are returned partition by partition in the order
+    the partitioning produced them. Otherwise rows are returned as soon as
+    any partition delivers them. Each partition may hold at most max_batches
+    undelivered batches of batch_size rows, after which its worker waits
+    for the consumer to catch up while keeping its connection.
+    
+    Partitions take their connections from the pool in order, so that a
+    partition is never left waiting for a connection held by a later one
+    that is waiting for it to be consumed.
+    """
+    def __init__(self, pool, operation, partitioning, parameters=(),
+            ordered=True, batch_size=100, max_batches=4, workers=None):
+        self.pool = pool
+        self.operation = operation
+        self.parameters = tuple(parameters)
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.description = None
+        
+        self._partitions = partitioning.partitions()
+        self.timings = [
+            PartitionTiming(index, condition)
+            for index, (condition, params) in enumerate(self._partitions)
+            ]
+        
+        if ordered:
+            self._queues = [
+                Queue.Queue(max_batches) for partition in self._partitions
+                ]
+        else:
+            shared_queue = Queue.Queue(max_batches * len(self._partitions))
+            self._queues = [shared_queue] * len(self._partitions)
+        
+        self._pending = Queue.Queue()
+        for index in range(len(self._partitions)):
+            self._pending.put(index)
+        
+        self._stop = threading.Event()
+        self._acquiring = threading.Lock()
+        self._rows = self._merge()
+        
+        if workers is None:
+            workers = pool.size
+        self._threads = []
+        for number in range(min(workers, len(self._partitions))):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        return self._rows.next()
+    
+    def close(self):
+        """Stop reading, and wait for the worker threads to finish.
+        
+        This is done automatically once all rows have been read or an
+        error has been raised.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _merge(self):
+        """Generate rows from the worker queues until every partition is done.
+        """
+        remaining = len(self._partitions)
+        try:
+            if self.ordered:
+                queues = self._queues
+            else:
+                queues = self._queues[:1] * remaining
+            for queue in queues:
+                while True:
+                    kind, index, data = queue.get()
+                    if kind == _ROWS:
+                        for row in data:
+                            yield row
+                    elif kind == _DONE:
+                        break
+                    else:
+                        raise data[0], data[1], data[2]
+        finally:
+            self.close()
+    
+    def _work(self):
+        """Run partitions from the pending queue until none are left.
+        """
+        while not self._stop.isSet():
+            connection = None
+            self._acquiring.acquire()
+            try:
+                try:
+                    index = self._pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    connection = self._acquire(index)
+                except:
+                    error = sys.exc_info()
+            finally:
+                self._acquiring.release()
+            
+            if connection is None:
+                if not self._stop.isSet():
+                    self._put(index, (_ERROR, index, error))
+                return
+            try:
+                finished = self._read_partition(index, connection)
+            except:
+                self._put(index, (_ERROR, index, sys.exc_info()))
+                return
+            if not finished:
+                return
+            self._put(index, (_DONE, index, None))
+    
+    def _acquire(self, index):
+        """Return a pooled connection for a partition, or None if reading
+        was stopped while waiting for one.
+        """
+        start = time.time()
+        try:
+            connection = self.pool.acquire(cancel=self._stop)
+        except OperationalError:
+            if self._stop.isSet():
+                return None
+            raise
+        self.timings[index].wait = time.time() - start
+        return connection
+    
+    def _read_partition(self, index, connection):
+        """Execute one partition on a pooled connection and queue its
+        rows. The connection is released afterwards.
+        
+        Returns False if reading was stopped before all rows were queued.
+        """
+        condition, params = self._partitions[index]
+        timing = self.timings[index]
+        operation = 'SELECT * FROM (%s) odbtp_partition WHERE %s' % (
+            self.operation,
+            condition
+            )
+        
+        start = time.time()
+        try:
+            cursor = connection.cursor()
+            try:
+                started = time.time()
+                cursor.execute(operation, self.parameters + params)
+                timing.execute = time.time() - started
+                if self.description is None:
+                    self.description = cursor.description
+                
+                started = time.time()
+                while True:
+                    rows = cursor.fetchmany(self.batch_size)
+                    if rows:
+                        timing.rows += len(rows)
+                        if not self._put(index, (_ROWS, index, rows)):
+                            return False
+                    if len(rows) < self.batch_size:
+                        break
+                timing.fetch = time.time() - started
+            finally:
+                cursor.close()
+        finally:
+            self.pool.release(connection)
+        timing.elapsed = timing.wait + time.time() - start
+        return True
+    
+    def _put(self, index, item):
+        """Queue an item for the consumer, waiting while the queue is full.
+        
+        Returns False if reading is stopped before the item could be queued.
+        """
+        queue = self._queues[index]
+        while not self._stop.isSet():
+            try:
+                queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+def read(pool, operation, partitioning, parameters=(), ordered=True,
+        batch_size=100, max_batches=4, workers=None):
+    """Run a query as partitions on pooled connections and merge the rows.
+    
+    The operation is wrapped as a derived table and filtered by the
+    conditions of the partitioning, which must be a KeyRanges or Modulo
+    instance (or anything else with a partitions() method returning a
+    list of (condition, parameters) pairs). Up to workers partitions are
+    run at once; by default this is the size of the pool.
+    
+    Returns a ParallelReader, which is iterated over to get the rows.
+    """
+    return ParallelReader(
+        pool,
+        operation,
+        partitioning,
+        parameters,
+        ordered,
+        batch_size,
+        max_batches,
+        workers
+        )
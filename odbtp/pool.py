@@ -0,0 +1,211 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""A pool of ODBTP connections that can be shared between threads.
+
+The DB API threadsafety level of this package is 1, meaning connections
+may not be shared between threads. A pool hands each thread a connection
+of its own for as long as it needs one, and keeps connections logged in
+between uses so that threads do not pay the login cost every time.
+
+A pool can be created and filled before a process forks. In each child,
+the pool makes itself a new lock, and its connections log in again the
+first time they are used (see odbtp.connection.Connection).
+"""
+
+import os
+import threading
+import time
+
+from odbtp.errors import *
+from odbtp.connection import connect
+from odbtp import metrics
+
+_POOL_SIZE = metrics.registry.gauge(
+    'odbtp_pool_size',
+    'Connections that each pool may hold.',
+    ('pool',)
+    )
+_POOL_IN_USE = metrics.registry.gauge(
+    'odbtp_pool_in_use',
+    'Connections checked out of each pool.',
+    ('pool',)
+    )
+_POOL_WAITING = metrics.registry.gauge(
+    'odbtp_pool_waiting',
+    'Threads waiting for a pooled connection.',
+    ('pool',)
+    )
+_POOL_WAIT_SECONDS = metrics.registry.histogram(
+    'odbtp_pool_wait_seconds',
+    'Time spent waiting for a pooled connection.',
+    ('pool',)
+    )
+_POOL_TIMEOUTS = metrics.registry.counter(
+    'odbtp_pool_timeouts_total',
+    'Requests for a pooled connection that timed out.',
+    ('pool',)
+    )
+
+# How often, in seconds, a cancellable wait checks whether it was cancelled.
+_CANCEL_CHECK = 0.1
+
+class ConnectionPool:
+    """A bounded set of connections to a single ODBTP server.
+    
+    Connections are created lazily, up to size of them. Threads that ask
+    for a connection when all of them are in use wait until another
+    thread releases one.
+    
+    The pool's use is recorded in the odbtp_pool_* metrics (see
+    odbtp.metrics), labelled with "server:port". Pools for the same server
+    and port add up.
+    """
+    def __init__(self, connect_string, server, port=2799, size=4, **options):
+        if size < 1:
+            raise ProgrammingError('A pool must hold at least one connection.')
+        self.connect_string = connect_string
+        self.server = server
+        self.port = port
+        self.size = size
+        self.options = options
+        self.open = True
+        self._idle = []
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+        self._labels = ('%s:%d' % (server, port),)
+        _POOL_SIZE.inc(self._labels, size)
+    
+    def acquire(self, timeout=None, cancel=None):
+        """Return a connection for the exclusive use of the calling thread.
+        
+        If every connection is in use, wait for one to be released. An
+        OperationalError is raised if timeout seconds pass first, or if
+        cancel, a threading.Event, is set while waiting.
+        """
+        started = time.time()
+        self._check_process()
+        self._condition.acquire()
+        try:
+            self._assert_pool_is_open()
+            if not self._idle and self._in_use >= self.size:
+                self._wait(started, timeout, cancel)
+            self._in_use += 1
+            _POOL_IN_USE.inc(self._labels)
+            _POOL_WAIT_SECONDS.observe(time.time() - started, self._labels)
+            if self._idle:
+                return self._idle.pop()
+        finally:
+            self._condition.release()
+        
+        # Log in outside of the lock so that other threads are not held up
+        # by the round trips.
+        try:
+            return connect(
+                self.connect_string,
+                self.server,
+                self.port,
+                **self.options
+                )
+        except:
+            self._condition.acquire()
+            try:
+                self._in_use -= 1
+                _POOL_IN_USE.dec(self._labels)
+                self._condition.notify()
+            finally:
+                self._condition.release()
+            raise
+    
+    def release(self, connection):
+        """Return a connection obtained from acquire() to the pool.
+        
+        The caller is responsible for committing or rolling back any work
+        done on the connection before releasing it. Connections that have
+        been closed are discarded rather than reused.
+        """
+        self._check_process()
+        self._condition.acquire()
+        try:
+            if self._in_use > 0:
+                # Connections checked out before a fork are not counted.
+                self._in_use -= 1
+                _POOL_IN_USE.dec(self._labels)
+            if self.open and connection.open:
+                self._idle.append(connection)
+                connection = None
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        
+        if connection is not None and connection.open:
+            # The pool was closed while the connection was checked out.
+            connection.close()
+    
+    def close(self):
+        """Close every idle connection and refuse any further requests.
+        
+        Connections that are checked out are closed when released.
+        """
+        self._check_process()
+        self._condition.acquire()
+        try:
+            if self.open:
+                _POOL_SIZE.dec(self._labels, self.size)
+            self.open = False
+            idle, self._idle = self._idle, []
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        
+        for connection in idle:
+            connection.close()
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _check_process(self):
+        """Start afresh in a forked process.
+        
+        The lock may have been held by another thread of the parent at the
+        time of the fork, and the connections that were checked out belong
+        to the parent.
+        """
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._condition = threading.Condition()
+            _POOL_IN_USE.dec(self._labels, self._in_use)
+            self._in_use = 0
+    
+    def _assert_pool_is_open(self):
+        if not self.open:
+            raise InterfaceError('The connection pool has been closed.')
+    
+    def _wait(self, started, timeout, cancel=None):
+        """Wait until a connection can be handed out. The caller must hold
+        the lock.
+        """
+        _POOL_WAITING.inc(self._labels)
+        try:
+            while not self._idle and self._in_use >= self.size:
+                if cancel is not None and cancel.isSet():
+                    raise OperationalError(
+                        'The request for a pooled connection was cancelled.'
+                        )
+                if timeout is None:
+                    remaining = None
+                else:
+                    remaining = started + timeout - time.time()
+                    if remaining <= 0:
+                        _POOL_TIMEOUTS.inc(self._labels)
+                        raise OperationalError(
+                            'Timed out waiting for a pooled connection.'
+                            )
+                if cancel is not None:
+                    # Nothing notifies the condition when cancel is set, so
+                    # check it now and then.
+                    remaining = min(remaining or _CANCEL_CHECK, _CANCEL_CHECK)
+                self._condition.wait(remaining)
+                self._assert_pool_is_open()
+        finally:
+            _POOL_WAITING.dec(self._labels)
@@ -0,0 +1,201 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""A registry of reserved connections that processes can pass on.
+
+A reserved connection stays open on the ODBTP server when the client logs
+out without disconnecting, and can be logged back in to with its
+connection ID. Short-lived processes, such as CGI scripts or pre-forked
+workers, can then skip connecting to the database each time they start.
+
+Connections made with reserved=True (see odbtp.connection.Connection) use
+a ReservationRegistry to find the ID of a detached connection for the same
+server, port and connect string. When they are closed, they detach and
+hand their ID back to the registry for the next process.
+
+The registry is a small JSON file, locked with fcntl while it is read and
+updated so that several processes can share it. It is only readable by
+its owner, and is refused if it belongs to another user. Connect strings
+are only stored as hashes, since they may contain a password. IDs held by
+processes that no longer exist are handed out again.
+"""
+
+import os
+import stat
+import errno
+import json
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from odbtp.errors import *
+
+class ReservationRegistry:
+    """A file-backed record of reserved connection IDs.
+    
+    For each data source, the file lists the IDs of its reserved
+    connections, along with the process ID of the process using each one,
+    or null for connections that are detached and free to use.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+    
+    def checkout(self, server, port, connect_string):
+        """Return the ID of a free reserved connection, marking it as used
+        by this process, or None if there is none.
+        """
+        def take(entries):
+            for entry in entries:
+                if entry[1] is None or not _process_exists(entry[1]):
+                    entry[1] = os.getpid()
+                    return str(entry[0])
+            return None
+        return self._update(server, port, connect_string, take)
+    
+    def attach(self, server, port, connect_string, connection_id):
+        """Record that this process is using a reserved connection.
+        """
+        def add(entries):
+            _remove(entries, connection_id)
+            entries.append([connection_id, os.getpid()])
+        self._update(server, port, connect_string, add)
+    
+    def checkin(self, server, port, connect_string, connection_id):
+        """Record that a reserved connection has been detached and is free.
+        """
+        def release(entries):
+            _remove(entries, connection_id)
+            entries.append([connection_id, None])
+        self._update(server, port, connect_string, release)
+    
+    def discard(self, server, port, connect_string, connection_id):
+        """Forget a reserved connection, which has been disconnected or
+        could not be logged in to.
+        """
+        def remove(entries):
+            _remove(entries, connection_id)
+        self._update(server, port, connect_string, remove)
+    
+    def entries(self, server, port, connect_string):
+        """Return a list of (connection ID, process ID) pairs for a data
+        source. The process ID is None for free connections.
+        """
+        def copy(entries):
+            return [(str(entry[0]), entry[1]) for entry in entries]
+        return self._update(server, port, connect_string, copy)
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _update(self, server, port, connect_string, change):
+        """Call change() with the list of entries for a data source while
+        holding the file lock, save any changes, and return its result.
+        """
+        key = '%s:%s:%s' % (server, port, sha1(connect_string).hexdigest())
+        stream = self._open()
+        try:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+            stream.seek(0)
+            text = stream.read()
+            if text.strip():
+                try:
+                    data = json.loads(text)
+                except ValueError:
+                    raise InterfaceError(
+                        'The reserved connection registry %s is corrupt.'
+                        % self.filename
+                        )
+            else:
+                data = {}
+            entries = data.setdefault(key, [])
+            result = change(entries)
+            if not entries:
+                del data[key]
+            stream.seek(0)
+            stream.truncate()
+            stream.write(json.dumps(data))
+            stream.flush()
+        finally:
+            stream.close()
+        return result
+    
+    def _open(self):
+        """Open the file for reading and writing, creating it if need be.
+        
+        Symbolic links are not followed, and files owned by other users
+        are refused, so that nobody else can plant or read the IDs.
+        """
+        _assert_locking_is_supported()
+        descriptor = os.open(
+            self.filename,
+            os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+            0600
+            )
+        try:
+            if os.fstat(descriptor).st_uid != os.getuid():
+                raise InterfaceError(
+                    'The reserved connection registry %s belongs to '
+                    'another user.' % self.filename
+                    )
+            return os.fdopen(descriptor, 'r+')
+        except:
+            os.close(descriptor)
+            raise
+
+_default_registry = None
+
+def get_default_registry():
+    """Return the registry used when none is given, which is shared by
+    every process of the same user.
+    
+    It is kept in a directory of the temporary directory that only the
+    user can enter. InterfaceError is raised if that directory exists but
+    belongs to someone else or is open to others.
+    """
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = ReservationRegistry(os.path.join(
+            _get_private_directory(),
+            'reserved.json'
+            ))
+    return _default_registry
+
+def _get_private_directory():
+    _assert_locking_is_supported()
+    directory = os.path.join(
+        tempfile.gettempdir(),
+        'odbtp-%d' % os.getuid()
+        )
+    try:
+        os.mkdir(directory, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+            or info.st_mode & 077:
+        raise InterfaceError(
+            'The directory %s is not private to the current user.'
+            % directory
+            )
+    return directory
+
+def _assert_locking_is_supported():
+    if fcntl is None:
+        raise NotSupportedError(
+            'The reserved connection registry needs fcntl locking.'
+            )
+
+def _remove(entries, connection_id):
+    entries[:] = [entry for entry in entries if entry[0] != connection_id]
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
@@ -0,0 +1,186 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Recover from connections lost to the ODBTP server.
+
+A connection made with a retry_policy (see odbtp.connection.Connection)
+does not stay dead when the server drops it. When a statement fails with
+one of the TRANSPORT_ERRORS, the connection logs in again, and the
+statement is run again if that is safe:
+    
+    from odbtp import resilience
+    
+    connection = connect('DSN=ORDERS', 'gateway-1',
+        retry_policy=resilience.default_policy)
+    cursor = connection.cursor()
+    cursor.execute('SELECT * FROM "Orders"')
+    cursor.execute('UPDATE "Stock" SET "Count" = 0 WHERE "Id" = ?', (7,),
+        idempotent=True)
+
+Logins are tried up to max_attempts times, sleeping between attempts for
+a random time of up to base_delay seconds, doubled after each attempt up
+to max_delay, so that clients that lost their connections together do not
+come back together. A CircuitBreaker for each server stops logins to a
+server that keeps failing for a while, rather than have every client keep
+trying it.
+
+Share one RetryPolicy between connections so that they share breakers.
+"""
+
+import time
+import random
+
+from odbtp.errors import *
+from odbtp.constants import *
+from odbtp.endpoints import FAILOVER_ERRORS
+from odbtp.metrics import _ProcessLock
+
+# Errors that mean the connection to the server was lost.
+TRANSPORT_ERRORS = (
+    ODBTPERR_DISCONNECTED,
+    ODBTPERR_READ,
+    ODBTPERR_TIMEOUTREAD,
+    ODBTPERR_SEND,
+    ODBTPERR_TIMEOUTSEND,
+    )
+
+class CircuitBreaker:
+    """Stops logins to a server after repeated failures.
+    
+    Once failure_threshold logins in a row have failed, the breaker opens,
+    and logins are refused with OperationalError for reset_time seconds.
+    A single login is then let through. If it succeeds, the breaker
+    closes; if it fails, the breaker opens again.
+    """
+    def __init__(self, failure_threshold=5, reset_time=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = _ProcessLock()
+    
+    def before_login(self):
+        """Raise OperationalError if logins are not allowed now.
+        """
+        self._lock.acquire()
+        try:
+            if self.opened_at is None:
+                return
+            if self._probing or time.time() < self.opened_at + self.reset_time:
+                raise OperationalError(
+                    'Logins are suspended after %d failures.' % self.failures
+                    )
+            self._probing = True
+        finally:
+            self._lock.release()
+    
+    def succeeded(self):
+        """Record a successful login, closing the breaker.
+        """
+        self._lock.acquire()
+        try:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+        finally:
+            self._lock.release()
+    
+    def failed(self):
+        """Record a failed login.
+        """
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+        finally:
+            self._lock.release()
+    
+    def aborted(self):
+        """Record a login that failed for a reason that says nothing
+        about the server, letting the next login probe it instead.
+        """
+        self._lock.acquire()
+        try:
+            self._probing = False
+        finally:
+            self._lock.release()
+
+class RetryPolicy:
+    """How connections recover when their connection to the server is lost.
+    
+    Only logins that fail with one of the endpoints.FAILOVER_ERRORS are
+    tried again, and count against the breaker. Other login errors, such
+    as a refused password, are raised at once.
+    """
+    def __init__(self, max_attempts=3, base_delay=0.1, max_delay=5.0,
+            failure_threshold=5, reset_time=30.0, rng=random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+        self.rng = rng
+        self._breakers = {}
+        self._lock = _ProcessLock()
+    
+    def get_breaker(self, server, port):
+        """Return the CircuitBreaker of a server, creating it if need be.
+        """
+        self._lock.acquire()
+        try:
+            key = (server, port)
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    self.failure_threshold,
+                    self.reset_time
+                    )
+                self._breakers[key] = breaker
+            return breaker
+        finally:
+            self._lock.release()
+    
+    def is_transport_error(self, error):
+        """Return True if the error means the connection was lost.
+        """
+        return getattr(error, 'odbtp_error', None) in TRANSPORT_ERRORS
+    
+    def get_delay(self, attempt):
+        """Return the time to sleep for after a number of failed attempts.
+        """
+        limit = min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+        return self.rng.uniform(0, limit)
+    
+    def login(self, server, port, login):
+        """Call login() until it succeeds, and return its result.
+        
+        The last error is raised after max_attempts failed attempts, and
+        OperationalError is raised if the server's breaker is open.
+        """
+        breaker = self.get_breaker(server, port)
+        attempt = 0
+        while True:
+            breaker.before_login()
+            try:
+                result = login()
+            except Error, e:
+                if getattr(e, 'odbtp_error', None) not in FAILOVER_ERRORS:
+                    breaker.aborted()
+                    raise
+                breaker.failed()
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                time.sleep(self.get_delay(attempt))
+                continue
+            except:
+                # Whatever the error, it must not leave a probe pending, or
+                # the breaker would refuse logins for good.
+                breaker.aborted()
+                raise
+            breaker.succeeded()
+            return result
+
+default_policy = RetryPolicy()
@@ -0,0 +1,539 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""A cache of query results shared by all the processes of a host.
+
+Worker processes that run the same queries, such as lookups of small
+reference tables, can share the results through a SharedResultCache rather
+than each fetching and keeping its own copy:
+    
+    from odbtp.resultcache import SharedResultCache
+    
+    cache = SharedResultCache('/dev/shm/odbtp-results', ttl=300)
+    rows = cache.fetchall(cursor, 'SELECT * FROM "Regions"')
+
+Results are stored in a memory-mapped file, in the compact form provided by
+odbtp.rowcodec. The rows returned are views on that file, so the processes
+share one copy of the data, and each row is decoded when it is read. A view
+can be read until its result is evicted from the cache or replaced, after
+which it raises InterfaceError; fetch the result again rather than keep
+the rows for long. Results whose values have no compact form, such as the
+objects made by some converters, are not cached: their rows are returned
+as a list.
+
+When a result is missing or has expired, one process runs the query while
+the others that need it wait, and then read the result it stored. When the
+file is full, expired results are dropped first, then the ones closest to
+expiring.
+
+Results are looked up by the server, port and connect string of the
+connection, the operation and the parameters. They must not depend on
+anything else, such as temporary tables or uncommitted changes.
+"""
+
+import os
+import mmap
+import time
+import struct
+import threading
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from odbtp.errors import *
+from odbtp.rowcodec import encode_row, decode_row
+
+# The file starts with a header, followed by a table of slots describing
+# the results, and then by the data of the results. The header holds the
+# number of slots and the size of the data area. Each slot holds the hash
+# of a result's key, the offset and length of its data, and the time at
+# which it expires. Unused slots have a length of 0, and the slots in use
+# come first, in the order of their data.
+_MAGIC = 'ODBTPRC1'
+_HEADER = struct.Struct('<8sIQ')
+_SLOT = struct.Struct('<20sQQd')
+_EMPTY_SLOT = _SLOT.pack('', 0, 0, 0.0)
+
+_OFFSET = struct.Struct('<I')
+_BUCKET = struct.Struct('<H')
+
+# Keys are spread over this many byte-range locks in the lock file, which
+# serialize the fetching of results.
+_LOCK_BUCKETS = 4096
+
+if fcntl is None:
+    _LOCK_SH = _LOCK_EX = _LOCK_UN = None
+else:
+    _LOCK_SH = fcntl.LOCK_SH
+    _LOCK_EX = fcntl.LOCK_EX
+    _LOCK_UN = fcntl.LOCK_UN
+
+# Text mode would mangle the file on Windows.
+_OPEN_FLAGS = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+
+class SharedResultCache:
+    """A result cache kept in a file shared by several processes.
+    
+    The file is created with room for size bytes of results and for the
+    given number of results, unless it already exists, in which case its
+    own limits are used. A file under /dev/shm keeps the results in memory
+    only. A second file, with '.lock' added to the name, holds the locks.
+    
+    Results are kept for ttl seconds unless another time is given when
+    they are fetched. The hits and misses attributes count the lookups made
+    by this object.
+    
+    A cache can be shared by the threads of a process, and can be created
+    before a process forks. Where the fcntl module is not available, as on
+    Windows, the files are not locked, and a cache file must only be used
+    by one process at a time.
+    """
+    def __init__(self, filename, size=16 * 1024 * 1024, slots=1024, ttl=300):
+        self.filename = filename
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._map = None
+        self._descriptor = None
+        self._lock_descriptor = None
+        self._open(size, slots)
+    
+    def fetchall(self, cursor, operation, parameters=(), ttl=None):
+        """Return the rows of a query, from the cache if possible.
+        
+        Otherwise the query is run with cursor.execute() and its rows are
+        fetched with cursor.fetchall(), and then stored for ttl seconds.
+        The rows are returned as CachedRows, unless they could not be
+        encoded for the cache, or are too large for it.
+        """
+        key = _make_key(cursor.connection, operation, parameters)
+        rows = self._view(key)
+        hit = rows is not None
+        if rows is None:
+            self._lock_key(key)
+            try:
+                # Another process may have stored it in the meantime.
+                rows = self._view(key)
+                if rows is None:
+                    rows = self._fetch(cursor, key, operation, parameters,
+                        ttl)
+            finally:
+                self._unlock_key(key)
+        self._lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+        return rows
+    
+    def invalidate(self, connection=None, operation=None, parameters=()):
+        """Forget cached results.
+        
+        With no arguments, every result is removed. Otherwise only the
+        result of the given query is removed.
+        """
+        if connection is None:
+            self._rewrite(lambda slots: [])
+        else:
+            key = _make_key(connection, operation, parameters)
+            self._rewrite(
+                lambda slots: [slot for slot in slots if slot[0] != key]
+                )
+    
+    def close(self):
+        """Close the cache file. The results stay in it for other
+        processes.
+        
+        The cache can no longer be used afterwards.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._descriptor is not None:
+            os.close(self._descriptor)
+            os.close(self._lock_descriptor)
+            self._descriptor = None
+            self._lock_descriptor = None
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _open(self, size, slots):
+        """Open the cache file and the lock file, creating them if needed.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._descriptor = os.open(self.filename, _OPEN_FLAGS, 0600)
+        self._lock_descriptor = os.open(
+            self.filename + '.lock',
+            _OPEN_FLAGS,
+            0600
+            )
+        _flock(self._descriptor, _LOCK_EX)
+        try:
+            header = os.read(self._descriptor, _HEADER.size)
+            if not header:
+                capacity = size
+                # Writing the last byte extends the file, where
+                # os.ftruncate() is not available.
+                os.lseek(
+                    self._descriptor,
+                    _HEADER.size + slots * _SLOT.size + capacity - 1,
+                    os.SEEK_SET
+                    )
+                os.write(self._descriptor, '\0')
+                os.lseek(self._descriptor, 0, os.SEEK_SET)
+                os.write(self._descriptor, _HEADER.pack(_MAGIC, slots, size))
+            elif len(header) < _HEADER.size or not header.startswith(_MAGIC):
+                raise InterfaceError(
+                    '%s is not a result cache file.' % self.filename
+                    )
+            else:
+                magic, slots, capacity = _HEADER.unpack(header)
+            self._slots = slots
+            self._capacity = capacity
+            self._data_start = _HEADER.size + slots * _SLOT.size
+            self._map = mmap.mmap(
+                self._descriptor,
+                self._data_start + capacity
+                )
+        finally:
+            _flock(self._descriptor, _LOCK_UN)
+    
+    def _check_process(self):
+        """Reopen the files in a forked process.
+        
+        File locks taken with flock() belong to the open file, which a child
+        shares with its parent, so it needs a file of its own.
+        """
+        if self._map is None:
+            raise InterfaceError('The result cache has been closed.')
+        if self._pid != os.getpid():
+            os.close(self._descriptor)
+            os.close(self._lock_descriptor)
+            self._map.close()
+            self._open(self._capacity, self._slots)
+    
+    def _acquire(self, operation):
+        self._check_process()
+        self._lock.acquire()
+        try:
+            _flock(self._descriptor, operation)
+        except:
+            self._lock.release()
+            raise
+    
+    def _release(self):
+        _flock(self._descriptor, _LOCK_UN)
+        self._lock.release()
+    
+    def _lock_key(self, key):
+        """Wait until no other thread or process is fetching a result with
+        the same lock bucket as key, and then take the lock.
+        """
+        bucket = _BUCKET.unpack_from(key)[0] % _LOCK_BUCKETS
+        self._check_process()
+        self._lock.acquire()
+        try:
+            lock = self._key_locks.get(bucket)
+            if lock is None:
+                lock = self._key_locks[bucket] = threading.Lock()
+        finally:
+            self._lock.release()
+        lock.acquire()
+        try:
+            _lockf(self._lock_descriptor, _LOCK_EX, bucket)
+        except:
+            lock.release()
+            raise
+    
+    def _unlock_key(self, key):
+        bucket = _BUCKET.unpack_from(key)[0] % _LOCK_BUCKETS
+        _lockf(self._lock_descriptor, _LOCK_UN, bucket)
+        self._key_locks[bucket].release()
+    
+    def _fetch(self, cursor, key, operation, parameters, ttl):
+        """Run a query and store its result. Returns a view on the stored
+        result, or the rows themselves if they could not be stored.
+        """
+        cursor.execute(operation, parameters)
+        description = cursor.description
+        rows = cursor.fetchall()
+        try:
+            data = _encode_result(description, rows)
+        except DataError:
+            return rows
+        if ttl is None:
+            ttl = self.ttl
+        self._write(key, data, time.time() + ttl)
+        view = self._view(key)
+        if view is None:
+            return _decode_result(_Buffer(data))
+        return view
+    
+    def _view(self, key):
+        """Return CachedRows viewing the data of a result, or None if it
+        is missing or has expired.
+        """
+        self._acquire(_LOCK_SH)
+        try:
+            position = self._find(key)
+            if position is None:
+                return None
+            key, offset, length, expires = _SLOT.unpack_from(
+                self._map,
+                position
+                )
+            if expires <= time.time():
+                return None
+        finally:
+            self._release()
+        try:
+            return _decode_result(
+                _View(self, key, position, length, expires)
+                )
+        except InterfaceError:
+            # It was removed in the meantime.
+            return None
+    
+    def _read(self, view, read):
+        """Call read() with the map and the position of the data of a
+        view, while holding the shared lock, and return its result.
+        
+        InterfaceError is raised if the result has been removed or replaced
+        since the view was made.
+        """
+        self._acquire(_LOCK_SH)
+        try:
+            position = view.position
+            if self._map[position:position+len(view.key)] != view.key:
+                position = self._find(view.key)
+            if position is not None:
+                key, offset, length, expires = _SLOT.unpack_from(
+                    self._map,
+                    position
+                    )
+                if length == view.length and expires == view.expires:
+                    view.position = position
+                    return read(self._map, self._data_start + offset)
+        finally:
+            self._release()
+        raise InterfaceError(
+            'The cached result is no longer in the cache. Fetch it again.'
+            )
+    
+    def _find(self, key):
+        """Return the position of the slot of a key, or None.
+        """
+        end = self._data_start
+        position = self._map.find(key, _HEADER.size, end)
+        while position >= 0:
+            if (position - _HEADER.size) % _SLOT.size == 0:
+                return position
+            position = self._map.find(key, position + 1, end)
+        return None
+    
+    def _write(self, key, data, expires):
+        """Store the data of a result, making room for it if needed.
+        
+        Data too large for the cache is not stored.
+        """
+        length = len(data)
+        if length > self._capacity:
+            return
+        def make_room(slots):
+            now = time.time()
+            slots = [slot for slot in slots if slot[0] != key
+                and slot[3] > now]
+            used = sum([slot[2] for slot in slots])
+            if len(slots) >= self._slots or used + length > self._capacity:
+                # Drop the results that are closest to expiring.
+                slots.sort(key=lambda slot: slot[3])
+                while slots and (len(slots) >= self._slots
+                        or used + length > self._capacity):
+                    used -= slots.pop(0)[2]
+                slots.sort(key=lambda slot: slot[1])
+            return slots
+        def store(offset):
+            start = self._data_start + offset
+            self._map[start:start+length] = data
+            return (key, offset, length, expires)
+        self._rewrite(make_room, store)
+    
+    def _rewrite(self, change, store=None):
+        """Replace the slot table while holding the file lock.
+        
+        change() is given the slots in use, as (key, offset, length,
+        expires) tuples in the order of their data, and returns those to
+        keep in the same order. Their data is moved together at the start
+        of the data area. store() is then called, if given, with the offset
+        of the free space after it, and returns a slot to add.
+        """
+        self._acquire(_LOCK_EX)
+        try:
+            slots = []
+            for index in xrange(self._slots):
+                slot = _SLOT.unpack_from(
+                    self._map,
+                    _HEADER.size + index * _SLOT.size
+                    )
+                if not slot[2]:
+                    break
+                slots.append(slot)
+            slots = change(slots)
+            kept = []
+            offset = 0
+            for key, old_offset, length, expires in slots:
+                if old_offset != offset:
+                    self._map.move(
+                        self._data_start + offset,
+                        self._data_start + old_offset,
+                        length
+                        )
+                kept.append((key, offset, length, expires))
+                offset += length
+            if store is not None:
+                kept.append(store(offset))
+            table = [_SLOT.pack(*slot) for slot in kept]
+            table.append(_EMPTY_SLOT * (self._slots - len(kept)))
+            self._map[_HEADER.size:self._data_start] = ''.join(table)
+        finally:
+            self._release()
+
+class _View:
+    """The data of a result stored in a SharedResultCache. This is for
+    internal use only.
+    
+    The slot position is only a hint, since the slots move when results
+    are removed. The length and expiry time tell the stored result apart
+    from a later one with the same key.
+    """
+    def __init__(self, cache, key, position, length, expires):
+        self.cache = cache
+        self.key = key
+        self.position = position
+        self.length = length
+        self.expires = expires
+    
+    def read(self, read):
+        return self.cache._read(self, read)
+
+class _Buffer:
+    """The data of a result that could not be stored, in memory. This is
+    for internal use only.
+    """
+    def __init__(self, data):
+        self.data = data
+    
+    def read(self, read):
+        return read(self.data, 0)
+
+class CachedRows(object):
+    """The rows of a result taken from a SharedResultCache.
+    
+    It supports len(), indexing, slicing and iteration like the list that
+    fetchall() normally returns. It holds no rows itself, but reads the
+    encoded data of the rows from the cache file, decoding a row each time
+    it is read. The description attribute holds the name and type code of
+    each column, in the form of a cursor's description.
+    """
+    def __init__(self, source, description, count, index_start, rows_start):
+        self.description = description
+        self._source = source
+        self._count = count
+        self._index_start = index_start
+        self._rows_start = rows_start
+    
+    def __len__(self):
+        return self._count
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('Row index out of range.')
+        def read(data, start):
+            offset, = _OFFSET.unpack_from(
+                data,
+                start + self._index_start + index * _OFFSET.size
+                )
+            return decode_row(data, start + self._rows_start + offset)[0]
+        return self._source.read(read)
+    
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self[index]
+    
+    def __repr__(self):
+        return '<CachedRows: %d rows>' % self._count
+
+def _flock(descriptor, operation):
+    if fcntl is not None:
+        fcntl.flock(descriptor, operation)
+
+def _lockf(descriptor, operation, offset):
+    """Lock or unlock one byte of a file.
+    """
+    if fcntl is not None:
+        fcntl.lockf(descriptor, operation, 1, offset)
+
+def _make_key(connection, operation, parameters):
+    return sha1(repr((
+        connection.server,
+        connection.port,
+        connection._connect_string,
+        operation,
+        tuple(parameters or ())
+        ))).digest()
+
+def _encode_result(description, rows):
+    """Return the data stored for a result: a row of the column names, a
+    row of their type codes, the number of rows, the offset of each row and
+    then the rows.
+    """
+    names = []
+    types = []
+    for column in description or ():
+        names.append(column[0])
+        types.append(column[1])
+    offsets = []
+    parts = []
+    size = 0
+    for row in rows:
+        data = encode_row(row)
+        offsets.append(_OFFSET.pack(size))
+        parts.append(data)
+        size += len(data)
+    return ''.join(
+        [encode_row(names), encode_row(types), _OFFSET.pack(len(offsets))]
+        + offsets
+        + parts
+        )
+
+def _decode_result(source):
+    """Return CachedRows reading the result from a _View or _Buffer.
+    """
+    def read(data, start):
+        names, offset = decode_row(data, start)
+        types, offset = decode_row(data, offset)
+        count, = _OFFSET.unpack_from(data, offset)
+        return names, types, count, offset + _OFFSET.size - start
+    names, types, count, index_start = source.read(read)
+    description = [(name, type_code, None, None, None, None, None)
+        for name, type_code in zip(names, types)]
+    return CachedRows(
+        source,
+        description,
+        count,
+        index_start,
+        index_start + count * _OFFSET.size
+        )
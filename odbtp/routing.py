@@ -0,0 +1,379 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Split reads and writes between a primary server and read replicas.
+
+A RoutingConnection holds a connection to the primary and one to each
+replica, and behaves like a single connection. Queries (see
+odbtp.sql.is_query) run outside of a transaction go to a replica. Anything
+else, and everything done once a transaction has started, goes to the
+primary:
+    
+    router = connect_routed(
+        'DSN=ORDERS',
+        'primary-gateway',
+        ['replica-1', 'replica-2'],
+        read_your_writes=2.0
+        )
+    cursor = router.cursor()
+    cursor.execute('SELECT * FROM "Orders" WHERE "OrderId" = ?', (42,))
+
+A transaction starts with begin(), or with the first statement that is not
+a query, and ends with commit() or rollback(). Since replicas usually lag
+behind the primary, read_your_writes can be set to a number of seconds
+during which queries keep going to the primary after changes have been
+committed, so that a client sees its own changes.
+"""
+
+import time
+
+from odbtp.errors import *
+from odbtp.connection import connect
+from odbtp.sql import is_query
+from odbtp import metrics
+
+# Ways of choosing a replica.
+ROUND_ROBIN = 'round-robin'
+LEAST_OUTSTANDING = 'least-outstanding'
+
+_ROUTED_TOTAL = metrics.registry.counter(
+    'odbtp_routed_statements_total',
+    'Statements sent by routing connections, by target.',
+    ('target',)
+    )
+
+class RoutingConnection:
+    """A connection that sends each statement to the primary or a replica.
+    
+    primary is a Connection to the primary server, and replicas is a list
+    of Connections to the replicas. The policy for choosing a replica is
+    ROUND_ROBIN, or LEAST_OUTSTANDING, which picks the replica with the
+    fewest cursors that still have rows to fetch from it.
+    
+    The connections in use are the primary and replicas attributes, and
+    each cursor's target attribute is the connection its last statement
+    was sent to.
+    """
+    def __init__(self, primary, replicas, policy=ROUND_ROBIN,
+            read_your_writes=0):
+        if policy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ProgrammingError('Unknown routing policy %s.' % policy)
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.read_your_writes = read_your_writes
+        self.open = True
+        self._in_transaction = False
+        self._changed = False
+        self._last_change = None
+        self._next_replica = 0
+        self._outstanding = [0] * len(self.replicas)
+    
+    def close(self):
+        """Close the primary and replica connections.
+        
+        As with a plain connection, uncommitted changes are rolled back.
+        """
+        self._assert_connection_is_open()
+        self.open = False
+        for connection in [self.primary] + self.replicas:
+            if connection.open:
+                connection.close()
+    
+    def commit(self):
+        """Commit the current transaction on the primary.
+        
+        The replicas are committed as well, which ends the read
+        transactions of any that are not in autocommit mode.
+        """
+        self._assert_connection_is_open()
+        self.primary.commit()
+        if self._changed:
+            self._last_change = time.time()
+        self._end_transaction()
+        for replica in self.replicas:
+            replica.commit()
+    
+    def rollback(self):
+        """Roll back the current transaction on the primary and replicas.
+        """
+        self._assert_connection_is_open()
+        self.primary.rollback()
+        self._end_transaction()
+        for replica in self.replicas:
+            replica.rollback()
+    
+    def cursor(self):
+        """Return a new RoutingCursor.
+        """
+        self._assert_connection_is_open()
+        return RoutingCursor(self)
+    
+    def begin(self, isolation_level=None):
+        """Start a transaction, sending everything to the primary until it
+        ends. An isolation level can be given as for Connection.begin().
+        """
+        self._assert_connection_is_open()
+        if isolation_level is not None:
+            self.primary.begin(isolation_level)
+        self._in_transaction = True
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _assert_connection_is_open(self):
+        if not self.open:
+            raise InterfaceError('The connection has been closed.')
+    
+    def _end_transaction(self):
+        self._in_transaction = False
+        self._changed = False
+    
+    def _route(self, operation):
+        """Return the index of the replica to run an operation on, or None
+        for the primary.
+        """
+        if not self.replicas or self._in_transaction:
+            return None
+        if operation is None or not is_query(operation):
+            return None
+        if self._last_change is not None and \
+                time.time() - self._last_change < self.read_your_writes:
+            return None
+        
+        if self.policy == LEAST_OUTSTANDING:
+            least = min(self._outstanding)
+            count = len(self.replicas)
+            for offset in range(count):
+                index = (self._next_replica + offset) % count
+                if self._outstanding[index] == least:
+                    break
+        else:
+            index = self._next_replica % len(self.replicas)
+        self._next_replica = index + 1
+        return index
+    
+    def _note_primary_use(self, operation):
+        """Record that an operation was sent to the primary.
+        """
+        if operation is not None and is_query(operation):
+            return
+        if self.primary.autocommit:
+            self._last_change = time.time()
+        else:
+            self._in_transaction = True
+            self._changed = True
+
+class RoutingCursor:
+    """A cursor that runs each statement on the connection chosen by its
+    RoutingConnection.
+    
+    It keeps a cursor of its own on each connection it uses, and otherwise
+    behaves like a plain Cursor. Only execute() can go to a replica;
+    executemany(), execute_batch() and callproc() always go to the primary.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.open = True
+        self.arraysize = 1
+        self.description = None
+        self.rowcount = -1
+        self.target = None
+        self._cursors = {}
+        self._cursor = None
+        self._replica = None
+        self._input_sizes = None
+    
+    def __iter__(self):
+        return self
+    
+    def close(self):
+        """Close the cursor and the cursors it holds on each connection.
+        """
+        self._assert_cursor_is_open()
+        self._release_replica()
+        self.open = False
+        for cursor in self._cursors.values():
+            if cursor.open and cursor.connection.open:
+                cursor.close()
+        self._cursors = {}
+        self._cursor = None
+    
+    def execute(self, operation, parameters=(), idempotent=False):
+        """Execute an operation on a replica or the primary.
+        """
+        self._use(operation).execute(operation, parameters, idempotent)
+        self._update()
+        return self
+    
+    def executemany(self, operation, seq_of_parameters, idempotent=False):
+        """Execute an operation on the primary for each set of parameters.
+        """
+        self._use(None).executemany(
+            operation,
+            seq_of_parameters,
+            idempotent
+            )
+        self._update()
+        return self
+    
+    def execute_batch(self, operations):
+        """Execute a batch of operations on the primary.
+        """
+        self._use(None).execute_batch(operations)
+        self._update()
+        return self
+    
+    def callproc(self, procname, parameters=(), idempotent=False):
+        """Call a stored procedure on the primary.
+        """
+        result = self._use(None).callproc(procname, parameters, idempotent)
+        self._update()
+        return result
+    
+    def fetchone(self):
+        """Fetch the next row, as for Cursor.fetchone().
+        """
+        rows = self.fetchmany(1)
+        if rows:
+            return rows[0]
+        return None
+    
+    def fetchmany(self, size=None):
+        """Fetch the next rows, as for Cursor.fetchmany().
+        """
+        if size is None:
+            size = self.arraysize
+        rows = self._get_cursor().fetchmany(size)
+        if len(rows) < size:
+            self._release_replica()
+        return rows
+    
+    def fetchall(self):
+        """Fetch all remaining rows, as for Cursor.fetchall().
+        """
+        rows = self._get_cursor().fetchall()
+        self._release_replica()
+        return rows
+    
+    def next(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration()
+        return row
+    
+    def nextset(self):
+        """Skip to the next result set, as for Cursor.nextset().
+        """
+        result = self._get_cursor().nextset()
+        self._update()
+        if not result:
+            self._release_replica()
+        return result
+    
+    def setinputsizes(self, *sizes):
+        """Predefine parameter information, as for Cursor.setinputsizes().
+        
+        The sizes are passed on to whichever cursor runs the next statement.
+        """
+        self._input_sizes = (sizes, {})
+    
+    def setoutputsize(self, size, column=None):
+        """Ignored."""
+        pass
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _assert_cursor_is_open(self):
+        if not self.open or not self.connection.open:
+            raise InterfaceError('Cursor or connection has been closed.')
+    
+    def _get_cursor(self):
+        self._assert_cursor_is_open()
+        if self._cursor is None:
+            raise InterfaceError('There is no result set to fetch from.')
+        return self._cursor
+    
+    def _use(self, operation):
+        """Choose the connection for an operation, and return this cursor's
+        cursor on it, ready to run the operation.
+        """
+        self._assert_cursor_is_open()
+        self._release_replica()
+        router = self.connection
+        replica = router._route(operation)
+        if replica is None:
+            connection = router.primary
+            router._note_primary_use(operation)
+            _ROUTED_TOTAL.inc(('primary',))
+        else:
+            connection = router.replicas[replica]
+            router._outstanding[replica] += 1
+            self._replica = replica
+            _ROUTED_TOTAL.inc(('replica',))
+        
+        cursor = self._cursors.get(replica)
+        if cursor is None:
+            cursor = connection.cursor()
+            self._cursors[replica] = cursor
+        cursor.arraysize = self.arraysize
+        if self._input_sizes is not None:
+            sizes, applied = self._input_sizes
+            if not applied.has_key(replica):
+                cursor.setinputsizes(*sizes)
+                applied[replica] = True
+        self._cursor = cursor
+        self.target = connection
+        return cursor
+    
+    def _update(self):
+        self.description = self._cursor.description
+        self.rowcount = self._cursor.rowcount
+        if self.description is None:
+            self._release_replica()
+    
+    def _release_replica(self):
+        """Stop counting this cursor as outstanding on its replica.
+        """
+        if self._replica is not None:
+            self.connection._outstanding[self._replica] -= 1
+            self._replica = None
+
+def connect_routed(connect_string, primary, replicas, port=2799,
+        policy=ROUND_ROBIN, read_your_writes=0, **options):
+    """Log in to a primary server and its replicas, and return a
+    RoutingConnection for them.
+    
+    The servers are given as host names, or as (host, port) pairs to use a
+    port other than the default. The options are passed on to connect().
+    Replica connections are made in autocommit mode unless the options say
+    otherwise, since they are only used to read outside of transactions.
+    """
+    primary_connection = connect(
+        connect_string,
+        *_endpoint(primary, port),
+        **options
+        )
+    replica_options = dict(options)
+    replica_options.setdefault('autocommit', True)
+    replica_connections = []
+    try:
+        for replica in replicas:
+            replica_connections.append(connect(
+                connect_string,
+                *_endpoint(replica, port),
+                **replica_options
+                ))
+    except:
+        for connection in [primary_connection] + replica_connections:
+            connection.close()
+        raise
+    return RoutingConnection(
+        primary_connection,
+        replica_connections,
+        policy,
+        read_your_writes
+        )
+
+def _endpoint(server, port):
+    if isinstance(server, tuple):
+        return server
+    return (server, port)
@@ -0,0 +1,182 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""A compact binary encoding for rows of python values.
+
+This is used to keep result rows outside of python objects, for example in
+temporary files. Each row starts with its number of values, and each value
+is written as a one byte tag followed by its data. The tags are the ODB type
+codes of the values' natural database types, so rows can be decoded without
+knowing anything about the result set they came from.
+"""
+
+import struct
+
+from datetime import date, time, datetime
+from decimal import Decimal
+
+from odbtp.errors import *
+from odbtp.constants import *
+from odbtp.types import Binary
+
+# Tag for None. No ODB type has this code.
+_NULL = 0
+
+_TAG = struct.Struct('<b')
+_COUNT = struct.Struct('<H')
+_LENGTH = struct.Struct('<I')
+_BIT = struct.Struct('<B')
+_BIGINT = struct.Struct('<q')
+_UBIGINT = struct.Struct('<Q')
+_DOUBLE = struct.Struct('<d')
+_DATE = struct.Struct('<HBB')
+_TIME = struct.Struct('<BBBI')
+_DATETIME = struct.Struct('<HBBBBBI')
+
+def encode_row(row):
+    """Return a string holding the encoded values of a row.
+    """
+    parts = [_COUNT.pack(len(row))]
+    append = parts.append
+    for value in row:
+        if value is None:
+            append(_TAG.pack(_NULL))
+            continue
+        encoder = _ENCODERS.get(type(value))
+        if encoder is None:
+            encoder = _find_encoder(value)
+        encoder(value, append)
+    return ''.join(parts)
+
+def decode_row(data, offset=0):
+    """Decode a row that starts at offset in a string or buffer.
+    
+    Returns the row as a tuple, and the offset just past its end.
+    """
+    count, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    row = []
+    append = row.append
+    for index in xrange(count):
+        tag, = _TAG.unpack_from(data, offset)
+        value, offset = _DECODERS[tag](data, offset + 1)
+        append(value)
+    return tuple(row), offset
+
+######################## Encoders for each value type ########################
+
+def _encode_text(tag, data, append):
+    append(_TAG.pack(tag))
+    append(_LENGTH.pack(len(data)))
+    append(data)
+
+def _encode_char(value, append):
+    _encode_text(ODB_CHAR, value, append)
+
+def _encode_binary(value, append):
+    _encode_text(ODB_BINARY, str(value), append)
+
+def _encode_wchar(value, append):
+    _encode_text(ODB_WCHAR, value.encode('utf-8'), append)
+
+def _encode_numeric(value, append):
+    _encode_text(ODB_NUMERIC, str(value), append)
+
+def _encode_bit(value, append):
+    append(_TAG.pack(ODB_BIT))
+    append(_BIT.pack(value))
+
+def _encode_int(value, append):
+    if -2**63 <= value < 2**63:
+        append(_TAG.pack(ODB_BIGINT))
+        append(_BIGINT.pack(value))
+    elif 0 <= value < 2**64:
+        append(_TAG.pack(ODB_UBIGINT))
+        append(_UBIGINT.pack(value))
+    else:
+        raise DataError('Integer %d is too large to encode.' % value)
+
+def _encode_double(value, append):
+    append(_TAG.pack(ODB_DOUBLE))
+    append(_DOUBLE.pack(value))
+
+def _encode_date(value, append):
+    append(_TAG.pack(ODB_DATE))
+    append(_DATE.pack(value.year, value.month, value.day))
+
+def _encode_time(value, append):
+    append(_TAG.pack(ODB_TIME))
+    append(_TIME.pack(value.hour, value.minute, value.second,
+        value.microsecond))
+
+def _encode_datetime(value, append):
+    append(_TAG.pack(ODB_DATETIME))
+    append(_DATETIME.pack(value.year, value.month, value.day, value.hour,
+        value.minute, value.second, value.microsecond))
+
+def _find_encoder(value):
+    """Return the encoder for a subclass of one of the supported types.
+    """
+    # Binary must be checked before str, and datetime before date.
+    for value_type, encoder in _ENCODER_ORDER:
+        if isinstance(value, value_type):
+            return encoder
+    raise DataError('Data type %s cannot be encoded.' % str(type(value)))
+
+_ENCODER_ORDER = (
+    (Binary, _encode_binary),
+    (str, _encode_char),
+    (unicode, _encode_wchar),
+    (bool, _encode_bit),
+    (int, _encode_int),
+    (long, _encode_int),
+    (float, _encode_double),
+    (Decimal, _encode_numeric),
+    (datetime, _encode_datetime),
+    (date, _encode_date),
+    (time, _encode_time),
+    )
+
+_ENCODERS = dict(_ENCODER_ORDER)
+
+######################## Decoders for each value type ########################
+
+def _decode_null(data, offset):
+    return None, offset
+
+def _decode_char(data, offset):
+    length, = _LENGTH.unpack_from(data, offset)
+    start = offset + _LENGTH.size
+    return data[start:start+length], start + length
+
+def _decode_binary(data, offset):
+    value, offset = _decode_char(data, offset)
+    return Binary(value), offset
+
+def _decode_wchar(data, offset):
+    value, offset = _decode_char(data, offset)
+    return value.decode('utf-8'), offset
+
+def _decode_numeric(data, offset):
+    value, offset = _decode_char(data, offset)
+    return Decimal(value), offset
+
+def _decode_struct(format, convert):
+    def decode(data, offset):
+        fields = format.unpack_from(data, offset)
+        return convert(*fields), offset + format.size
+    return decode
+
+_DECODERS = {
+    _NULL: _decode_null,
+    ODB_CHAR: _decode_char,
+    ODB_BINARY: _decode_binary,
+    ODB_WCHAR: _decode_wchar,
+    ODB_NUMERIC: _decode_numeric,
+    ODB_BIT: _decode_struct(_BIT, bool),
+    ODB_BIGINT: _decode_struct(_BIGINT, lambda value: value),
+    ODB_UBIGINT: _decode_struct(_UBIGINT, lambda value: value),
+    ODB_DOUBLE: _decode_struct(_DOUBLE, lambda value: value),
+    ODB_DATE: _decode_struct(_DATE, date),
+    ODB_TIME: _decode_struct(_TIME, time),
+    ODB_DATETIME: _decode_struct(_DATETIME, datetime),
+    }
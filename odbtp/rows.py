@@ -0,0 +1,193 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Result rows whose values are only converted when they are used.
+
+A cursor with lazy_rows set (see Cursor) returns LazyRow objects instead of
+tuples. Each one holds a copy of the raw data the server sent for the row,
+in a single buffer, and the DecodePlan of its result set. A value is
+converted to a python object the first time it is read, and kept for later
+reads. When only a few of many columns are used, this saves most of the
+work of converting rows:
+    
+    cursor.lazy_rows = True
+    cursor.execute('SELECT * FROM "Orders"')
+    for row in cursor:
+        print row[0], row['ShipCity']
+
+A LazyRow can be used wherever a tuple of the same values could, except
+that it is not an instance of tuple. Values can also be looked up by column
+name. Errors in converting a value are raised when it is read.
+"""
+
+from ctypes import *
+
+from odbtp.errors import *
+from odbtp.types import ODB_TO_PYTHON
+
+# Space left after the data of a row, since some conversions (such as that
+# of ODB_DATETIME) read a fixed size.
+BUFFER_PADDING = 16
+
+# Marks values that have not been converted yet.
+_PENDING = object()
+
+class DecodePlan:
+    """What is needed to convert the values of the rows of a result set.
+    
+    converters is a tuple holding, for each column, a function that takes
+    the address and length of a value's data and returns the value.
+    column_names is a tuple of the column names, and names maps them to
+    their index; where several columns have the same name, the first one
+    is used.
+    
+    The converters are looked up in a ConverterRegistry (see
+    odbtp.converters) if one is given, and are the defaults otherwise.
+    """
+    def __init__(self, description, registry=None):
+        converters = []
+        self.column_names = tuple([column[0] for column in description])
+        self.names = {}
+        for index, column in enumerate(description):
+            if registry is None:
+                converter = ODB_TO_PYTHON.get(column[1])
+            else:
+                converter = registry.get(index, column[0], column[1])
+            if converter is None:
+                converter = _make_unknown_converter(column[1])
+            converters.append(converter)
+            self.names.setdefault(column[0], index)
+        self.converters = tuple(converters)
+
+class LazyRow(object):
+    """A row of a result set, converting its values when first used.
+    
+    The data buffer holds the raw data of the row. layout is a flat tuple
+    of the offset and length of each value in the buffer, with a length of
+    -1 for nulls.
+    """
+    __slots__ = ('_plan', '_buffer', '_layout', '_values')
+    
+    def __init__(self, plan, data_buffer, layout):
+        self._plan = plan
+        self._buffer = data_buffer
+        self._layout = layout
+        self._values = None
+    
+    def __len__(self):
+        return len(self._layout) // 2
+    
+    def __getitem__(self, key):
+        if isinstance(key, (int, long)):
+            count = len(self._layout) // 2
+            if key < 0:
+                key += count
+            if not 0 <= key < count:
+                raise IndexError('row index out of range')
+            return self._get(key)
+        elif isinstance(key, slice):
+            indexes = xrange(*key.indices(len(self._layout) // 2))
+            return tuple([self._get(index) for index in indexes])
+        elif isinstance(key, basestring):
+            try:
+                return self._get(self._plan.names[key])
+            except KeyError:
+                raise KeyError('There is no column named %s.' % key)
+        raise TypeError('Row indices must be integers, slices or names.')
+    
+    def __iter__(self):
+        return iter(self._as_tuple())
+    
+    def __contains__(self, value):
+        return value in self._as_tuple()
+    
+    def __eq__(self, other):
+        return self._as_tuple() == _as_comparable(other)
+    
+    def __ne__(self, other):
+        return self._as_tuple() != _as_comparable(other)
+    
+    def __lt__(self, other):
+        return self._as_tuple() < _as_comparable(other)
+    
+    def __le__(self, other):
+        return self._as_tuple() <= _as_comparable(other)
+    
+    def __gt__(self, other):
+        return self._as_tuple() > _as_comparable(other)
+    
+    def __ge__(self, other):
+        return self._as_tuple() >= _as_comparable(other)
+    
+    def __hash__(self):
+        return hash(self._as_tuple())
+    
+    def __add__(self, other):
+        return self._as_tuple() + _as_comparable(other)
+    
+    def __radd__(self, other):
+        return _as_comparable(other) + self._as_tuple()
+    
+    def __repr__(self):
+        return repr(self._as_tuple())
+    
+    def __reduce__(self):
+        # The buffer cannot be pickled, so rows are pickled as tuples.
+        return (tuple, (self._as_tuple(),))
+    
+    def count(self, value):
+        return self._as_tuple().count(value)
+    
+    def index(self, value):
+        return self._as_tuple().index(value)
+    
+    def get(self, name, default=None):
+        """Return the value of the named column, or default if there is no
+        column of that name.
+        """
+        index = self._plan.names.get(name)
+        if index is None:
+            return default
+        return self._get(index)
+    
+    def keys(self):
+        """Return the column names, in order.
+        """
+        return list(self._plan.column_names)
+    
+    def raw_size(self):
+        """Return the size of the raw data held by the row, in bytes.
+        """
+        return sizeof(self._buffer)
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _get(self, index):
+        values = self._values
+        if values is None:
+            values = self._values = [_PENDING] * (len(self._layout) // 2)
+        value = values[index]
+        if value is _PENDING:
+            offset = self._layout[2 * index]
+            length = self._layout[2 * index + 1]
+            if length < 0:
+                value = None
+            else:
+                value = self._plan.converters[index](
+                    addressof(self._buffer) + offset,
+                    length
+                    )
+            values[index] = value
+        return value
+    
+    def _as_tuple(self):
+        return tuple([self._get(index) for index in xrange(len(self))])
+
+def _as_comparable(other):
+    if isinstance(other, LazyRow):
+        return other._as_tuple()
+    return other
+
+def _make_unknown_converter(data_type):
+    def convert(address, length):
+        raise DataError('Data type ID %d cannot be converted.' % data_type)
+    return convert
@@ -0,0 +1,124 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Result sets that are kept in a temporary file rather than in memory.
+
+A cursor with a memory budget (see Cursor.memory_budget) returns one of
+these from fetchall() once the rows it has fetched no longer fit in the
+budget. The rows are written to the file in the compact form provided by
+odbtp.rowcodec, and read back through a memory map only when they are used.
+"""
+
+import sys
+import mmap
+import tempfile
+from array import array
+
+from odbtp.errors import *
+from odbtp.rowcodec import encode_row, decode_row
+from odbtp.rows import LazyRow
+
+class SpilledRows(object):
+    """A sequence of rows stored in a temporary file.
+    
+    It supports len(), indexing, slicing and iteration like the list that
+    fetchall() normally returns. Only the offsets of the rows are kept in
+    memory. The file is deleted when the object is closed or garbage
+    collected.
+    """
+    def __init__(self, rows=()):
+        self._file = tempfile.TemporaryFile()
+        self._offsets = array('L')
+        self._size = 0
+        self._map = None
+        self._map_size = 0
+        self.extend(rows)
+    
+    def __len__(self):
+        return len(self._offsets)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Row index out of range.')
+        return decode_row(self._get_map(), self._offsets[index])[0]
+    
+    def __iter__(self):
+        data = self._get_map()
+        offset = 0
+        for index in xrange(len(self)):
+            row, offset = decode_row(data, offset)
+            yield row
+    
+    def __repr__(self):
+        return '<SpilledRows: %d rows>' % len(self)
+    
+    def append(self, row):
+        """Add a row to the end of the sequence.
+        """
+        self._assert_is_open()
+        data = encode_row(row)
+        self._file.write(data)
+        self._offsets.append(self._size)
+        self._size += len(data)
+    
+    def extend(self, rows):
+        """Add several rows to the end of the sequence.
+        """
+        for row in rows:
+            self.append(row)
+    
+    def close(self):
+        """Delete the file holding the rows.
+        
+        The sequence can no longer be used afterwards.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _assert_is_open(self):
+        if self._file is None:
+            raise InterfaceError('The spilled rows have been closed.')
+    
+    def _get_map(self):
+        """Return a memory map of the file, covering every row written.
+        """
+        self._assert_is_open()
+        if self._map_size != self._size:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.flush()
+            if self._size:
+                self._map = mmap.mmap(
+                    self._file.fileno(),
+                    self._size,
+                    access=mmap.ACCESS_READ
+                    )
+            self._map_size = self._size
+        if self._map is None:
+            return ''
+        return self._map
+
+def estimate_size(rows):
+    """Return a rough count of the bytes of memory used by a list of rows.
+    """
+    getsizeof = sys.getsizeof
+    total = getsizeof(rows)
+    for row in rows:
+        total += getsizeof(row)
+        if isinstance(row, LazyRow):
+            # Counting the values would convert them all.
+            total += row.raw_size()
+            continue
+        for value in row:
+            total += getsizeof(value)
+    return total
@@ -0,0 +1,210 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Utilities for examining and rewriting the text of SQL statements.
+"""
+
+import re
+
+from odbtp.errors import *
+
+_TOKENS = re.compile(r"""
+    (?P<string> '(?:[^']|'')*' )
+  | (?P<quoted> "(?:[^"]|"")*" | \[[^\]]*\] )
+  | (?P<comment> --[^\n]* | /\*.*?\*/ )
+  | (?P<number> \b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b )
+""", re.VERBOSE | re.DOTALL)
+
+# Parameter markers, along with the things that may contain a ? that is not
+# a marker. Only the markers are captured.
+_MARKERS = re.compile(r"""
+    '(?:[^']|'')*'
+  | "(?:[^"]|"")*" | \[[^\]]*\]
+  | --[^\n]* | /\*.*?\*/
+  | (\?)
+""", re.VERBOSE | re.DOTALL)
+
+# Whitespace, comments and opening parentheses before the first keyword.
+_LEADING = re.compile(r'(?:\s+|--[^\n]*|/\*.*?\*/|\()*', re.DOTALL)
+_SELECT = re.compile(r'SELECT\b', re.IGNORECASE)
+_WRITING_SELECT = re.compile(r'\bINTO\b|\bFOR\s+UPDATE\b', re.IGNORECASE)
+_DML = re.compile(r'(?:INSERT|UPDATE|DELETE|MERGE)\b', re.IGNORECASE)
+_RETURNING = re.compile(r'\bOUTPUT\b|\bRETURNING\b', re.IGNORECASE)
+
+_WHITESPACE = re.compile(r'\s+')
+_VALUE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+# Fingerprints and marker positions are remembered for up to this many
+# statements.
+_MAX_CACHED = 1000
+_fingerprints = {}
+_split_operations = {}
+
+def fingerprint(operation):
+    """Return the statement with its literal values taken out.
+    
+    String and numeric literals are replaced by ? markers, comments are
+    removed, runs of whitespace become single spaces, and lists of markers
+    such as IN (?, ?, ?) are shortened to (?, ...). Statements that only
+    differ in the values they use therefore have the same fingerprint,
+    which makes it suitable for grouping statistics about statements.
+    """
+    result = _fingerprints.get(operation)
+    if result is None:
+        result = _TOKENS.sub(_replace_token, operation)
+        result = _WHITESPACE.sub(' ', result).strip()
+        result = _VALUE_LIST.sub('(?, ...)', result)
+        if len(_fingerprints) >= _MAX_CACHED:
+            _fingerprints.clear()
+        _fingerprints[operation] = result
+    return result
+
+def is_query(operation):
+    """Return True if the operation is a SELECT statement that only reads.
+    
+    SELECT ... INTO and SELECT ... FOR UPDATE are not counted as queries.
+    This errs on the side of caution: a statement that merely mentions
+    INTO in a string literal is not counted either.
+    """
+    start = _LEADING.match(operation).end()
+    if not _SELECT.match(operation, start):
+        return False
+    return not _WRITING_SELECT.search(operation)
+
+def is_dml(operation):
+    """Return True if the operation is an INSERT, UPDATE, DELETE or MERGE
+    statement that returns no rows.
+    
+    Statements with an OUTPUT or RETURNING clause return rows, and are not
+    counted. As with is_query(), a statement that merely mentions one of
+    those words in a literal is not counted either.
+    """
+    start = _LEADING.match(operation).end()
+    if not _DML.match(operation, start):
+        return False
+    return not _RETURNING.search(operation)
+
+def encode_sql(operation):
+    """Return the text of an operation as sent to the server.
+    
+    Unicode operations are encoded as UTF-8, which the server decodes when
+    the connection uses unicode SQL (see odbtp.connection.Connection).
+    """
+    if isinstance(operation, unicode):
+        return operation.encode('utf-8')
+    return operation
+
+def split_at_markers(operation):
+    """Return the text of an operation around its qmark parameter markers.
+    
+    The result is a list with one more item than there are markers. Question
+    marks in string literals, quoted identifiers and comments are not
+    markers.
+    """
+    parts = _split_operations.get(operation)
+    if parts is None:
+        parts = []
+        last = 0
+        for match in _MARKERS.finditer(operation):
+            if match.group(1) is not None:
+                parts.append(operation[last:match.start()])
+                last = match.end()
+        parts.append(operation[last:])
+        if len(_split_operations) >= _MAX_CACHED:
+            _split_operations.clear()
+        _split_operations[operation] = parts
+    return parts
+
+def expand_lists(operation, parameters, max_size):
+    """Expand list and tuple parameters into one marker per value.
+    
+    This lets a whole list be passed for a single marker, as in
+    "WHERE id IN (?)". Returns None if no parameter is a list or tuple.
+    Otherwise, returns a list of (operation, parameters) pairs to execute.
+    
+    The number of markers a list expands to is rounded up to a power of
+    two, at most max_size, by repeating its last value. This keeps the
+    number of distinct statements small, so that prepared statements and
+    the server's plans can be reused. A list of more than max_size values
+    is split into chunks of max_size values, giving one pair per chunk;
+    only one such list is allowed per operation. Repeated values are
+    dropped from it, so that no row can match more than one chunk.
+    """
+    for value in parameters:
+        if isinstance(value, (list, tuple)):
+            break
+    else:
+        return None
+    
+    parts = split_at_markers(operation)
+    if len(parts) - 1 != len(parameters):
+        raise ProgrammingError(
+            'The operation has %d parameter markers, but %d parameters '
+            'were given.' % (len(parts) - 1, len(parameters))
+            )
+    
+    parameters = tuple(parameters)
+    chunked = None
+    for index, value in enumerate(parameters):
+        if not isinstance(value, (list, tuple)):
+            continue
+        if not value:
+            raise ProgrammingError('Parameter %d is an empty list.' % (
+                index + 1
+                ))
+        if len(value) > max_size:
+            if chunked is not None:
+                raise NotSupportedError(
+                    'Only one list parameter may have more than %d values.'
+                    % max_size
+                    )
+            chunked = index
+    
+    if chunked is None:
+        return [_expand(parts, parameters, max_size)]
+    values = _unique(parameters[chunked])
+    expansions = []
+    for start in range(0, len(values), max_size):
+        chunk = parameters[:chunked] + \
+            (values[start:start+max_size],) + \
+            parameters[chunked+1:]
+        expansions.append(_expand(parts, chunk, max_size))
+    return expansions
+
+def _expand(parts, parameters, max_size):
+    text = [parts[0]]
+    values = []
+    for value, part in zip(parameters, parts[1:]):
+        if isinstance(value, (list, tuple)):
+            size = 1
+            while size < len(value):
+                size *= 2
+            size = min(size, max_size)
+            text.append(', '.join(['?'] * size))
+            values.extend(value)
+            values.extend([value[-1]] * (size - len(value)))
+        else:
+            text.append('?')
+            values.append(value)
+        text.append(part)
+    return ''.join(text), tuple(values)
+
+def _unique(values):
+    """Return the values without repeats, in their original order.
+    """
+    seen = {}
+    unique = []
+    try:
+        for value in values:
+            if not seen.has_key(value):
+                seen[value] = True
+                unique.append(value)
+    except TypeError:
+        return list(values)
+    return unique
+
+def _replace_token(match):
+    if match.group('quoted') is not None:
+        return match.group('quoted')
+    if match.group('comment') is not None:
+        return ' '
+    return '?'
@@ -0,0 +1,327 @@
+# Copyright (c) 2010 Michael Saavedra
+
+"""Record the calls made to the ODBTP client library, and play them back.
+
+A recording captures every odb* call made by this package, with its
+arguments, its result, any values returned through output arguments, the
+column and parameter data it pointed to, and the time it took. Playing the
+recording back answers the same calls in the same order without touching
+the network, so that the python side of a real workload (decoding rows,
+building descriptions and so on) can be profiled anywhere:
+    
+    from odbtp import trace
+    
+    recorder = trace.record('orders.trace')
+    run_the_workload()
+    trace.uninstall()
+    recorder.close()
+    
+    # Later, possibly on another machine:
+    player = trace.replay('orders.trace', timing=False)
+    run_the_workload()
+
+With timing set, each call takes as long as it did when it was recorded;
+otherwise the calls return as fast as possible. The workload must make the
+same calls in the same order as when it was recorded, so it should be
+deterministic and use a single thread. Note that state kept by the package
+also affects which calls are made; for example, a capability profile that
+is already cached (see odbtp.capabilities) saves calls at login. It is
+simplest to record and play back in fresh processes. A call that does not
+match the recording raises an InterfaceError.
+
+The client library must still be installed to import the package, but it
+is never called while a recording is played back.
+
+Trace files are a gzip-compressed stream of marshalled records, each
+preceded by its length.
+"""
+
+import sys
+import time
+import gzip
+import struct
+import marshal
+import threading
+
+from ctypes import *
+from ctypes import _SimpleCData
+
+from odbtp.errors import *
+
+odb = cdll.LoadLibrary('libodbtp.so')
+
+TRACE_VERSION = 1
+
+# Functions that return the address of data, and the functions that give
+# the length of that data. The data itself is recorded.
+_DATA_FUNCTIONS = {
+    'odbColData': 'odbColDataLen',
+    'odbParamData': 'odbParamDataLen',
+    }
+
+# The smallest buffer handed out for data when playing back, since some
+# conversions (such as that of ODB_DATETIME) read a fixed size.
+_MIN_BUFFER_SIZE = 16
+
+_LENGTH = struct.Struct('<I')
+
+# The odb attributes of the package's modules before install() was called.
+_originals = {}
+
+class Recorder:
+    """A stand-in for the client library that records calls to a file.
+    
+    Calls are passed on to the real library. Attributes such as restype
+    that are set on the functions are passed on as well.
+    """
+    def __init__(self, filename, library=odb):
+        self.filename = filename
+        self.library = library
+        self.calls = 0
+        self._stream = gzip.open(filename, 'wb')
+        self._lock = threading.Lock()
+        self._write({'version': TRACE_VERSION, 'created': time.time()})
+    
+    def __getattr__(self, name):
+        if not name.startswith('odb'):
+            raise AttributeError(name)
+        function = _RecordedFunction(self, name, getattr(self.library, name))
+        self.__dict__[name] = function
+        return function
+    
+    def close(self):
+        """Finish writing the trace file.
+        """
+        self._lock.acquire()
+        try:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+        finally:
+            self._lock.release()
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _record(self, name, args, result, elapsed, data):
+        outputs = _get_outputs(args)
+        record = (name, _plain(args), result, outputs, elapsed, data)
+        self._lock.acquire()
+        try:
+            if self._stream is None:
+                raise InterfaceError('The trace recorder has been closed.')
+            self._write(record)
+            self.calls += 1
+        finally:
+            self._lock.release()
+    
+    def _write(self, item):
+        data = marshal.dumps(item)
+        self._stream.write(_LENGTH.pack(len(data)))
+        self._stream.write(data)
+
+class _RecordedFunction:
+    """A library function wrapped by a Recorder. For internal use only.
+    """
+    def __init__(self, recorder, name, function):
+        self.__dict__['_recorder'] = recorder
+        self.__dict__['_name'] = name
+        self.__dict__['_function'] = function
+    
+    def __setattr__(self, name, value):
+        setattr(self._function, name, value)
+    
+    def __call__(self, *args):
+        started = time.time()
+        result = self._function(*args)
+        elapsed = time.time() - started
+        
+        data = None
+        if result and _DATA_FUNCTIONS.has_key(self._name):
+            library = self._recorder.library
+            length = getattr(library, _DATA_FUNCTIONS[self._name])(*args)
+            data = string_at(result, length)
+        
+        self._recorder._record(self._name, args, result, elapsed, data)
+        return result
+
+class Player:
+    """A stand-in for the client library that plays back a trace file.
+    
+    If timing is set, each call sleeps for as long as the recorded call
+    took. If check_arguments is set, the arguments of each call must also
+    match the recording, rather than just the function called.
+    """
+    def __init__(self, filename, timing=False, check_arguments=False):
+        self.filename = filename
+        self.timing = timing
+        self.check_arguments = check_arguments
+        self.calls = 0
+        self._stream = gzip.open(filename, 'rb')
+        header = self._read()
+        if not isinstance(header, dict) or \
+                header.get('version') != TRACE_VERSION:
+            raise InterfaceError('%s is not a usable trace file.' % filename)
+        self.created = header.get('created')
+        self._buffers = {}
+        self._lock = threading.Lock()
+    
+    def __getattr__(self, name):
+        if not name.startswith('odb'):
+            raise AttributeError(name)
+        function = _ReplayedFunction(self, name)
+        self.__dict__[name] = function
+        return function
+    
+    def close(self):
+        """Close the trace file.
+        """
+        self._lock.acquire()
+        try:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+            self._buffers = {}
+        finally:
+            self._lock.release()
+    
+    ############## Helper methods that are not part of the API ##############
+    
+    def _play(self, name, args):
+        """Return the recorded result of the next call, which must be a
+        call to the named function.
+        """
+        self._lock.acquire()
+        try:
+            if self._stream is None:
+                raise InterfaceError('The trace player has been closed.')
+            record = self._read()
+            if record is None:
+                raise InterfaceError(
+                    'The trace has no more calls, but %s was called.' % name
+                    )
+            self.calls += 1
+        finally:
+            self._lock.release()
+        
+        recorded_name, recorded_args, result, outputs, elapsed, data = record
+        if name != recorded_name:
+            raise InterfaceError(
+                'Call %d was to %s, but %s was recorded.' % (
+                    self.calls, name, recorded_name
+                    )
+                )
+        if self.check_arguments and _plain(args) != recorded_args:
+            raise InterfaceError(
+                'Call %d to %s had the arguments %r, but %r were recorded.'
+                % (self.calls, name, _plain(args), recorded_args)
+                )
+        
+        if self.timing and elapsed > 0:
+            time.sleep(elapsed)
+        for index, value in outputs.items():
+            _set_output(args[index], value)
+        if data is not None:
+            # Keep the buffer alive until the same data is asked for again.
+            data_buffer = create_string_buffer(
+                data,
+                max(len(data), _MIN_BUFFER_SIZE)
+                )
+            self._buffers[name, recorded_args] = data_buffer
+            return addressof(data_buffer)
+        return result
+    
+    def _read(self):
+        """Return the next item of the trace file, or None at its end.
+        """
+        header = self._stream.read(_LENGTH.size)
+        if len(header) < _LENGTH.size:
+            return None
+        length, = _LENGTH.unpack(header)
+        return marshal.loads(self._stream.read(length))
+
+class _ReplayedFunction:
+    """A library function played back by a Player. For internal use only.
+    
+    Attributes such as restype can be set, but are ignored, since the
+    results were converted when they were recorded.
+    """
+    def __init__(self, player, name):
+        self._player = player
+        self._name = name
+    
+    def __call__(self, *args):
+        return self._player._play(self._name, args)
+
+def record(filename):
+    """Start recording library calls to a file, and return the Recorder.
+    """
+    recorder = Recorder(filename)
+    install(recorder)
+    return recorder
+
+def replay(filename, timing=False, check_arguments=False):
+    """Start playing back library calls from a file, and return the Player.
+    """
+    player = Player(filename, timing, check_arguments)
+    install(player)
+    return player
+
+def install(library):
+    """Make every loaded module of the package call library instead of the
+    ODBTP client library.
+    """
+    for name, module in sys.modules.items():
+        if module is None or name != 'odbtp' and \
+                not name.startswith('odbtp.'):
+            continue
+        if name == __name__ or not hasattr(module, 'odb'):
+            continue
+        if not _originals.has_key(name):
+            _originals[name] = module.odb
+        module.odb = library
+
+def uninstall():
+    """Make the package call the ODBTP client library again.
+    """
+    for name, library in _originals.items():
+        module = sys.modules.get(name)
+        if module is not None:
+            module.odb = library
+    _originals.clear()
+
+def _plain(args):
+    """Return the arguments of a call as values that can be marshalled.
+    
+    Simple ctypes values are replaced by their python values. Pointers and
+    buffers are replaced by None; what they hold after the call is
+    recorded separately.
+    """
+    plain = []
+    for arg in args:
+        if arg is None or isinstance(arg, (int, long, float, str, unicode)):
+            plain.append(arg)
+        elif isinstance(arg, _SimpleCData):
+            plain.append(arg.value)
+        else:
+            plain.append(None)
+    return tuple(plain)
+
+def _get_outputs(args):
+    """Return a dictionary of the values held by the pointer and buffer
+    arguments of a call, by argument index.
+    """
+    outputs = {}
+    for index, arg in enumerate(args):
+        if isinstance(arg, Array):
+            outputs[index] = string_at(addressof(arg), sizeof(arg))
+        elif type(arg).__name__ == 'CArgObject':
+            outputs[index] = arg._obj.value
+    return outputs
+
+def _set_output(arg, value):
+    """Put a recorded output value back into a pointer or buffer argument.
+    """
+    if isinstance(arg, Array):
+        memmove(arg, value, min(len(value), sizeof(arg)))
+    else:
+        arg._obj.value = value
@@ -5,6 +5,7 @@ conversions between them.
 """
 
 import time
+import codecs
 import struct
 
 from datetime import date, time, datetime
@@ -115,6 +116,18 @@ class _DbApiTypeObject(object):
             cursor.connection.rollback()
             raise get_exception(cursor.connection.handle)
     
+    def use_column(self, cursor, col_number, final):
+        """Use a parameter column that has already been bound by the server.
+        
+        This is the case for the parameters of prepared procedures, whose
+        types the server has looked up itself. Set final to True for the
+        last parameter that will be set before execution.
+        """
+        self.cursor = cursor
+        self.col_number = col_number
+        self.final = final
+        self.bound = True
+    
     def set_parameter(self, value):
         """Set the parameter column to the given value.
         
@@ -144,16 +157,30 @@ class _DbApiTypeObject(object):
             raise get_exception(self.cursor.connection.handle)
 
 class STRING(_DbApiTypeObject):
+    """Character parameter data.
+    
+    With wide set, the parameter is bound as SQL_WVARCHAR and unicode
+    values are sent as UTF-8, as the ODBTP server expects for ODB_WCHAR
+    data. The max_size is then in characters and the size in bytes.
+    """
     values = (ODB_CHAR, ODB_WCHAR)
     
-    def __init__(self, max_size):
-        self.odb_type = ODB_CHAR
-        self.sql_type = SQL_CHAR
+    def __init__(self, max_size, wide=False, size=None):
+        if wide:
+            self.odb_type = ODB_WCHAR
+            self.sql_type = SQL_WVARCHAR
+        else:
+            self.odb_type = ODB_CHAR
+            self.sql_type = SQL_CHAR
         self.odb_set_func = odb.odbSetParamText
         self.max_size = max_size
-        self.size = max_size
+        if size is None:
+            size = max_size
+        self.size = size
 
     def convert_to_c(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
         return c_char_p(value)
 
 class BINARY(_DbApiTypeObject):
@@ -170,11 +197,19 @@ class BINARY(_DbApiTypeObject):
         return c_char_p(str(value))
 
 class NUMBER(_DbApiTypeObject):
+    """Numeric parameter data.
+    
+    The decimal sub_type is sent as text, unless native is true, in which
+    case it is sent as an ODBC SQL_NUMERIC_STRUCT. The precision (total
+    digits) and scale of native decimals are given by the max_size and
+    precision attributes, which default to 38 and 8, and values are
+    rounded to that scale.
+    """
     values = (ODB_BIGINT, ODB_UBIGINT, ODB_BIT, ODB_DOUBLE, ODB_FLOAT,
                     ODB_INT, ODB_UINT, ODB_NUMERIC, ODB_REAL, 
                     ODB_SMALLINT, ODB_USMALLINT, ODB_TINYINT, ODB_UTINYINT)
     
-    def __init__(self, sub_type='decimal'):
+    def __init__(self, sub_type='decimal', native=False):
         self.sub_type = sub_type.lower()
         self.precision = 8
         
@@ -188,6 +223,13 @@ class NUMBER(_DbApiTypeObject):
             self.sql_type = SQL_DOUBLE
             self.odb_set_func = odb.odbSetParamDouble
             self.convert_to_c = self._convert_float_to_c
+        elif self.sub_type == 'decimal' and native:
+            self.odb_type = ODB_NUMERIC
+            self.sql_type = SQL_NUMERIC
+            self.odb_set_func = _set_param_struct
+            self.convert_to_c = self._convert_numeric_to_c
+            self.size = _NUMERIC.size
+            self.max_size = MAX_NUMERIC_PRECISION
         elif self.sub_type == 'decimal':
             self.odb_type = ODB_CHAR
             self.sql_type = SQL_CHAR
@@ -204,38 +246,89 @@ class NUMBER(_DbApiTypeObject):
     
     def _convert_decimal_to_c(self, value):
         return c_char_p(str(value))
+    
+    def _convert_numeric_to_c(self, value):
+        return _pack_numeric(Decimal(value), self.max_size, self.precision)
 
 class DATETIME(_DbApiTypeObject):
+    """Date and time parameter data.
+    
+    Values are sent as text, unless native is true, in which case they are
+    sent in the ODB_DATETIME structure that _convert_datetime() decodes,
+    and the database converts them to the SQL type of the sub_type. Native
+    timestamps keep fractions of a second to the number of digits given
+    by the precision attribute, which defaults to 3.
+    """
     values = (ODB_DATE, ODB_DATETIME, ODB_TIME)
     
-    def __init__(self, sub_type='datetime'):
+    def __init__(self, sub_type='datetime', native=False):
         self.sub_type = sub_type.lower()
-        self.odb_type = ODB_CHAR
-        self.sql_type = SQL_CHAR
-        self.odb_set_func = odb.odbSetParamText
+        if native:
+            self.odb_type = ODB_DATETIME
+            self.odb_set_func = _set_param_struct
+            self.convert_to_c = self._convert_native_to_c
+            self.size = _TIMESTAMP.size
+        else:
+            self.odb_type = ODB_CHAR
+            self.sql_type = SQL_CHAR
+            self.odb_set_func = odb.odbSetParamText
         
         if self.sub_type in ('datetime', 'timestamp'):
-            self.max_size = 22
-            self.size = 22
+            if native:
+                self.sql_type = SQL_TYPE_TIMESTAMP
+                self.precision = 3
+                self.max_size = 23
+            else:
+                self.max_size = 22
+                self.size = 22
         elif  self.sub_type =='date':
+            if native:
+                self.sql_type = SQL_TYPE_DATE
+            else:
+                self.size = 10
             self.max_size = 10
-            self.size = 10
         elif self.sub_type == 'time':
-            self.max_size = 11
-            self.size = 11
+            if native:
+                self.sql_type = SQL_TYPE_TIME
+                self.max_size = 8
+            else:
+                self.max_size = 11
+                self.size = 11
         else:
             raise ProgrammingError('Illegal sub_type for DATETIME.')
     
     def convert_to_c(self, value):
         return c_char_p(str(value))
+    
+    def _convert_native_to_c(self, value):
+        if isinstance(value, datetime):
+            # Drop the digits of the fraction beyond the bound precision.
+            step = 10 ** (6 - min(self.precision, 6))
+            return _TIMESTAMP.pack(
+                value.year, value.month, value.day,
+                value.hour, value.minute, value.second,
+                value.microsecond // step * step * 1000
+                )
+        elif isinstance(value, date):
+            return _TIMESTAMP.pack(value.year, value.month, value.day,
+                0, 0, 0, 0)
+        elif isinstance(value, time):
+            # The date is ignored when converting to SQL_TYPE_TIME.
+            return _TIMESTAMP.pack(1900, 1, 1,
+                value.hour, value.minute, value.second, 0)
+        raise DataError('%r is not a date or time.' % (value,))
 
 class ROWID(_DbApiTypeObject):
     value = (ODB_GUID,)
 
 ###### Functions to aid conversion between Python, DB API and ODB data #####
 
-def get_db_api_type(self, value):
+def get_db_api_type(self, value, native=False):
     """Return a db api type instance appropriate for the given python value.
+    
+    If native is true, dates, times and decimals are sent in binary form
+    rather than as text where they can be, with a precision and scale
+    fitted to the value.
     """
     if value is None:
         return _DbApiTypeObject()
@@ -243,39 +336,62 @@ def get_db_api_type(self, value):
         return BINARY(len(value))
     elif isinstance(value, str):
         return STRING(len(value))
+    elif isinstance(value, unicode):
+        # The column size counts UTF-16 code units.
+        size = len(value.encode('utf-8'))
+        if size > len(value):
+            length = len(value.encode('utf-16-le')) // 2
+        else:
+            length = size
+        return STRING(length, True, size)
     elif isinstance(value, datetime):
-        return DATETIME()
+        db_api_type = DATETIME('datetime', native)
+        if native:
+            if value.microsecond == 0:
+                db_api_type.precision = 0
+            elif value.microsecond % 1000:
+                db_api_type.precision = 6
+            db_api_type.max_size = 20 + db_api_type.precision
+        return db_api_type
     elif isinstance(value, date):
-        return DATETIME('date')
+        return DATETIME('date', native)
     elif isinstance(value, time):
-        return DATETIME('time')
+        # SQL_TYPE_TIME has no fraction of a second.
+        return DATETIME('time', native and not value.microsecond)
     elif isinstance(value, int):
         return NUMBER('int')
     elif isinstance(value, Decimal):
-        return NUMBER()
+        digits = native and _get_numeric_digits(value)
+        if not digits:
+            return NUMBER()
+        db_api_type = NUMBER('decimal', True)
+        db_api_type.max_size, db_api_type.precision = digits
+        return db_api_type
     elif isinstance(value, float):
         return NUMBER('float')
     else:
         raise DataError('Data type %s is not supported.' % str(type(value)))
 
-def get_odb_type(handle, column):
+def get_odb_type(handle, column, wide=False):
     """Determine the proper data type for a column in a result set.
     
     ODBC drivers (and ODBTP itself?) are not always rigorous about specifying
     the proper data type, so this is a best effort to figure it out by
     examining both the SQL type and the ODB type.
+    
+    Unicode columns are treated as ODB_CHAR, so that their values come back
+    as UTF-8 strs, unless wide is true.
     """
     sql_type = odb.odbColSqlType(handle, column)
     odb_type = odb.odbColDataType(handle, column)
-    if sql_type == odb_type:
+    if sql_type in _WIDE_SQL_TYPES and odb_type == ODB_WCHAR and not wide:
+        return ODB_CHAR
+    elif sql_type == odb_type:
         return odb_type
     elif sql_type == 91 and odb_type == ODB_CHAR:
         return ODB_DATE
     elif sql_type == 92 and odb_type == ODB_CHAR:
         return ODB_TIME
-    elif sql_type == -9 and odb_type == ODB_WCHAR:
-        # XXX TODO: Change back to ODB_WCHAR when unicode works properly?
-        return ODB_CHAR
     elif sql_type == 2 and odb_type == 1:
         return ODB_NUMERIC
     else:
@@ -321,8 +437,9 @@ def _convert_time(address, length):
     return time(*[int(arg) for arg in args])
 
 def _convert_datetime(address, length):
-    fields = struct.unpack('H5hi', string_at(address, 16))
-    return datetime(*fields)
+    fields = _TIMESTAMP.unpack(string_at(address, _TIMESTAMP.size))
+    # The fraction is in nanoseconds.
+    return datetime(*fields[:6] + (fields[6] // 1000,))
 
 def _convert_guid(address, length):
     # Not sure what this is for.
@@ -332,7 +449,61 @@ def _convert_numeric(address, length):
     return Decimal(string_at(address, length))
 
 def _convert_wchar(address, length):
-    return wstring_at(address, length)
+    # The server sends ODB_WCHAR data as UTF-8. It is decoded straight from
+    # the column buffer, through a buffer object, rather than from a copy.
+    return _utf_8_decode(
+        buffer(_SPAN.from_address(address), 0, length),
+        None,
+        True
+        )[0]
+
+def _set_param_struct(handle, column, data, final):
+    """Set a parameter to the binary structure held in a string.
+    """
+    return odb.odbSetParam(handle, column, data, len(data), final)
+
+def _get_numeric_digits(value):
+    """Return the (precision, scale) of a Decimal, or None if it cannot be
+    sent as a SQL_NUMERIC_STRUCT.
+    """
+    if not value.is_finite():
+        return None
+    sign, digits, exponent = value.as_tuple()
+    scale = max(-exponent, 0)
+    precision = max(len(digits) + max(exponent, 0), scale, 1)
+    if precision > MAX_NUMERIC_PRECISION:
+        return None
+    return precision, scale
+
+def _pack_numeric(value, precision, scale):
+    """Return a Decimal as a SQL_NUMERIC_STRUCT with the given precision
+    and scale, rounding half to even as Decimal does.
+    """
+    if not value.is_finite():
+        raise DataError('%s cannot be sent as a NUMERIC.' % value)
+    sign, digits, exponent = value.as_tuple()
+    integer = 0
+    for digit in digits:
+        integer = integer * 10 + digit
+    shift = exponent + scale
+    if shift >= 0:
+        integer *= 10 ** shift
+    else:
+        integer, remainder = divmod(integer, 10 ** -shift)
+        half = 5 * 10 ** (-shift - 1)
+        if remainder > half or remainder == half and integer % 2:
+            integer += 1
+    if integer >= 10 ** precision:
+        raise DataError('%s does not fit in NUMERIC(%d, %d).' % (
+            value, precision, scale
+            ))
+    return _NUMERIC.pack(
+        precision,
+        scale,
+        not sign,
+        integer & 0xFFFFFFFFFFFFFFFFL,
+        integer >> 64
+        )
 
 #### Code for building pre-calculated dictionaries of useful information ####
 
@@ -346,6 +517,23 @@ def _get_sizes(*data_types):
             size_dict[size] = data_type
     return size_dict
 
+# The ODB_DATETIME structure: year, month, day, hour, minute, second and
+# fraction of a second in nanoseconds.
+_TIMESTAMP = struct.Struct('H5hi')
+
+# The SQL_NUMERIC_STRUCT: precision, scale, sign (1 for positive) and the
+# unscaled value as a 128 bit little-endian integer.
+_NUMERIC = struct.Struct('<BbBQQ')
+MAX_NUMERIC_PRECISION = 38
+
+# An array type spanning any column buffer, for making buffer objects over
+# column data. It is never allocated.
+_SPAN = c_char * 0x7fffffff
+_utf_8_decode = codecs.utf_8_decode
+
+# The SQL types of NCHAR, NVARCHAR and NTEXT columns.
+_WIDE_SQL_TYPES = (SQL_WCHAR, SQL_WVARCHAR, SQL_WLONGVARCHAR)
+
 INT_SIZES = _get_sizes(c_byte, c_short, c_int, c_long, c_longlong)
 UINT_SIZES = _get_sizes(c_ubyte, c_ushort, c_uint, c_ulong, c_ulonglong)
 FLOAT_SIZES = _get_sizes(c_float, c_double)
@@ -0,0 +1,96 @@
+"""Tests for odbtp.converters.
+"""
+
+import calendar
+import unittest
+from ctypes import create_string_buffer, addressof
+
+from odbtp import converters
+from odbtp.constants import *
+from odbtp.types import ODB_TO_PYTHON, _TIMESTAMP
+from odbtp.rows import DecodePlan
+from odbtp.converters import ConverterRegistry
+
+def call(converter, data):
+    """Call a converter on a copy of data, as it would be on a column
+    buffer.
+    """
+    data_buffer = create_string_buffer(data, len(data) + 1)
+    return converter(addressof(data_buffer), len(data))
+
+def by_type(address, length):
+    return 'type'
+
+def by_parent_type(address, length):
+    return 'parent type'
+
+def by_name(address, length):
+    return 'name'
+
+def by_index(address, length):
+    return 'index'
+
+class ConverterRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.parent = ConverterRegistry()
+        self.registry = ConverterRegistry(self.parent)
+    
+    def test_defaults(self):
+        self.assertEqual(self.registry.get(0, 'a', ODB_NUMERIC),
+            ODB_TO_PYTHON[ODB_NUMERIC])
+        self.assertEqual(self.registry.get(0, 'a', 12345), None)
+    
+    def test_order(self):
+        self.parent.register(ODB_NUMERIC, by_parent_type)
+        self.assertEqual(self.registry.get(0, 'a', ODB_NUMERIC),
+            by_parent_type)
+        self.registry.register(ODB_NUMERIC, by_type)
+        self.assertEqual(self.registry.get(0, 'a', ODB_NUMERIC), by_type)
+        # Columns come before types, even those set in a parent.
+        self.parent.register_column('a', by_name)
+        self.assertEqual(self.registry.get(0, 'a', ODB_NUMERIC), by_name)
+        self.registry.register_column(0, by_index)
+        self.assertEqual(self.registry.get(0, 'a', ODB_NUMERIC), by_index)
+        self.assertEqual(self.registry.get(1, 'a', ODB_NUMERIC), by_name)
+        self.assertEqual(self.registry.get(1, 'b', ODB_NUMERIC), by_type)
+    
+    def test_unregister(self):
+        self.registry.register(ODB_NUMERIC, by_type)
+        self.registry.register_column('a', by_name)
+        self.registry.unregister(ODB_NUMERIC)
+        self.registry.unregister_column('a')
+        self.registry.unregister_column('missing')
+        self.assertEqual(self.registry.get(0, 'a', ODB_NUMERIC),
+            ODB_TO_PYTHON[ODB_NUMERIC])
+    
+    def test_decode_plan(self):
+        self.registry.register_column('b', by_name)
+        plan = DecodePlan([
+            ('a', ODB_CHAR, None, None, None, None, None),
+            ('b', ODB_CHAR, None, None, None, None, None),
+            ], self.registry)
+        self.assertEqual(plan.converters,
+            (ODB_TO_PYTHON[ODB_CHAR], by_name))
+
+class BuiltinConvertersTest(unittest.TestCase):
+    def test_text(self):
+        self.assertEqual(call(converters.numeric_as_float, '-12.5'), -12.5)
+        self.assertEqual(call(converters.numeric_as_string, '12.50'),
+            '12.50')
+        self.assertEqual(call(converters.raw_bytes, '\x00\xff'), '\x00\xff')
+        self.assertEqual(call(converters.wchar_as_utf8, '\xc3\xa9'),
+            '\xc3\xa9')
+        self.assertEqual(call(converters.date_as_string, '2010-03-04'),
+            '2010-03-04')
+        self.assertEqual(call(converters.time_as_string, '05:06:07'),
+            '05:06:07')
+    
+    def test_datetime(self):
+        data = _TIMESTAMP.pack(2010, 3, 4, 5, 6, 7, 890000000)
+        self.assertEqual(call(converters.datetime_as_tuple, data),
+            (2010, 3, 4, 5, 6, 7, 890000000))
+        self.assertEqual(call(converters.datetime_as_epoch, data),
+            calendar.timegm((2010, 3, 4, 5, 6, 7)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""Tests for odbtp.endpoints.
+"""
+
+import time
+import unittest
+
+from odbtp import endpoints
+from odbtp.errors import *
+from odbtp.constants import *
+from odbtp.endpoints import HealthRegistry, connect_any
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+    
+    def time(self):
+        return self.now
+
+class FixedRandom:
+    """Always picks the same point, as a fraction of the total."""
+    def __init__(self, value=0.0):
+        self.value = value
+    
+    def random(self):
+        return self.value
+
+def make_error(odbtp_error):
+    error = OperationalError('Error %d' % odbtp_error)
+    error.odbtp_error = odbtp_error
+    return error
+
+class HealthRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        endpoints.time = self.time
+        self.registry = HealthRegistry(smoothing=0.5, eject_time=5.0,
+            max_eject_time=12.0)
+    
+    def tearDown(self):
+        endpoints.time = time
+    
+    def plan(self, servers, value=0.0):
+        return [(endpoint.host, endpoint.port) for endpoint in
+            self.registry.plan(servers, 2799, FixedRandom(value))]
+    
+    def test_server_descriptions(self):
+        self.assertEqual(self.plan(['a', ('b', 1), ('c', 2, 5)]),
+            [('a', 2799), ('b', 1), ('c', 2)])
+        self.assertRaises(ProgrammingError, self.registry.plan, [('a',)])
+    
+    def test_weights(self):
+        # The first pick lands in the share of the server with the most
+        # weight when the point is past the shares of the others.
+        self.assertEqual(self.plan([('a', 1, 1), ('b', 1, 3)], 0.5),
+            [('b', 1), ('a', 1)])
+        self.assertEqual(self.plan([('a', 1, 1), ('b', 1, 3)], 0.1),
+            [('a', 1), ('b', 1)])
+    
+    def test_latency_and_health(self):
+        a = self.registry.get('a', 2799)
+        b = self.registry.get('b', 2799)
+        self.registry.succeeded(a, 0.4)
+        self.registry.succeeded(b, 0.1)
+        self.assertEqual(self.plan(['a', 'b'], 0.5), [('b', 2799),
+            ('a', 2799)])
+        self.registry.succeeded(a, 0.2)
+        self.assertAlmostEqual(a.latency, 0.3)
+        self.registry.failed(b)
+        self.assertAlmostEqual(b.health, 0.5)
+    
+    def test_ejection(self):
+        a = self.registry.get('a', 2799)
+        b = self.registry.get('b', 2799)
+        self.registry.failed(a)
+        self.registry.failed(b)
+        self.registry.failed(b)
+        self.assertEqual(a.ejected_until, 1005.0)
+        self.assertEqual(b.ejected_until, 1010.0)
+        self.assertEqual(self.plan(['b', 'c', 'a']),
+            [('c', 2799), ('a', 2799), ('b', 2799)])
+        
+        self.registry.failed(b)
+        self.assertEqual(b.ejected_until, 1012.0)
+    
+    def test_probe(self):
+        a = self.registry.get('a', 2799)
+        self.registry.failed(a)
+        self.time.now += 5
+        self.assertEqual(self.plan(['b', 'a'], 0.9), [('a', 2799),
+            ('b', 2799)])
+        # Only one plan gets the probe; the next ones try it last.
+        self.assertEqual(a.ejected_until, 1010.0)
+        self.assertEqual(self.plan(['a', 'b']), [('b', 2799), ('a', 2799)])
+        self.registry.succeeded(a, 0.1)
+        self.assertEqual(a.ejected_until, None)
+        self.assertEqual(a.ejections, 0)
+
+class ConnectAnyTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = HealthRegistry()
+        self.calls = []
+    
+    def factory(self, errors):
+        def connect(host, port):
+            self.calls.append(host)
+            if errors.has_key(host):
+                raise errors[host]
+            return host
+        return connect
+    
+    def test_fails_over(self):
+        connect = self.factory({'a': make_error(ODBTPERR_CONNECT)})
+        result = connect_any(connect, ['a', 'b'], registry=self.registry)
+        self.assertEqual(result, 'b')
+        self.failIf(self.registry.get('a', 2799).ejected_until is None)
+        self.failUnless(self.registry.get('b', 2799).latency is not None)
+        self.calls = []
+        self.assertEqual(connect_any(connect, ['a', 'b'],
+            registry=self.registry), 'b')
+        self.assertEqual(self.calls, ['b'])
+    
+    def test_other_errors_are_raised(self):
+        connect = self.factory({'a': make_error(ODBTPERR_RESPONSE),
+            'b': make_error(ODBTPERR_RESPONSE)})
+        self.assertRaises(OperationalError, connect_any, connect, ['a', 'b'],
+            registry=self.registry)
+        self.assertEqual(len(self.calls), 1)
+    
+    def test_every_server_fails(self):
+        connect = self.factory({'a': make_error(ODBTPERR_CONNECT),
+            'b': make_error(ODBTPERR_TIMEOUTCONN)})
+        self.assertRaises(OperationalError, connect_any, connect, ['a', 'b'],
+            registry=self.registry)
+        self.assertEqual(sorted(self.calls), ['a', 'b'])
+        self.assertRaises(ProgrammingError, connect_any, connect, [],
+            registry=self.registry)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Tests for odbtp.metrics.
+"""
+
+import unittest
+
+from odbtp.metrics import Registry, OVERFLOW_LABEL
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+    
+    def test_render(self):
+        errors = self.registry.counter('errors_total', 'Errors.\nBy code.',
+            ('code',))
+        errors.inc(('3',))
+        errors.inc(('a"b\\c',), 2)
+        self.registry.gauge('in_use', 'In use.').set(1.5)
+        latency = self.registry.histogram('latency_seconds', 'Latency.',
+            ('server',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 2.0):
+            latency.observe(value, ('db',))
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP errors_total Errors.\\nBy code.',
+            '# TYPE errors_total counter',
+            'errors_total{code="3"} 1',
+            'errors_total{code="a\\"b\\\\c"} 2',
+            '# HELP in_use In use.',
+            '# TYPE in_use gauge',
+            'in_use 1.5',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{server="db",le="0.1"} 1',
+            'latency_seconds_bucket{server="db",le="1.0"} 3',
+            'latency_seconds_bucket{server="db",le="+Inf"} 4',
+            'latency_seconds_sum{server="db"} 3.05',
+            'latency_seconds_count{server="db"} 4',
+            '',
+            ]))
+    
+    def test_render_special_values(self):
+        gauge = self.registry.gauge('value', 'Value.', ('kind',))
+        gauge.set(float('inf'), ('high',))
+        gauge.set(float('-inf'), ('low',))
+        gauge.set(float('nan'), ('none',))
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:], [
+            'value{kind="high"} +Inf',
+            'value{kind="low"} -Inf',
+            'value{kind="none"} NaN',
+            ])
+    
+    def test_shared_metrics(self):
+        first = self.registry.counter('calls', 'Calls.')
+        self.failUnless(self.registry.counter('calls', 'Calls.') is first)
+        first.inc()
+        self.registry.reset()
+        self.assertEqual(first.get(), 0)
+    
+    def test_max_series(self):
+        counter = self.registry.counter('calls', 'Calls.', ('name',),
+            max_series=2)
+        for name in ('a', 'b', 'c', 'd'):
+            counter.inc((name,))
+        self.assertEqual(counter.get(('a',)), 1)
+        self.assertEqual(counter.get((OVERFLOW_LABEL,)), 2)
+        self.assertRaises(ValueError, counter.inc, ('a', 'b'))
+    
+    def test_histogram_summary(self):
+        latency = self.registry.histogram('latency', 'Latency.',
+            buckets=(1.0, 2.0, 4.0))
+        self.assertEqual(latency.quantile(0.5), None)
+        for value in (0.5, 1.5, 1.5, 3.0):
+            latency.observe(value)
+        summary = latency.get()
+        self.assertEqual(summary['counts'], (1, 2, 1, 0))
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(latency.quantile(0.5), 1.5)
+        latency.observe(10.0)
+        self.assertEqual(latency.quantile(0.99), 4.0)
+        snapshot = self.registry.snapshot()['latency']
+        self.assertEqual(snapshot['type'], 'histogram')
+        self.assertEqual(snapshot['values'][()]['count'], 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Tests for odbtp.parallel.
+"""
+
+import threading
+import unittest
+
+from odbtp.errors import *
+from odbtp.parallel import KeyRanges, Modulo, read
+
+class FakeCursor:
+    def __init__(self, pool):
+        self.pool = pool
+        self.description = [('id', 1, None, None, None, None, None)]
+        self._rows = []
+    
+    def execute(self, operation, parameters=()):
+        self.pool.record(operation, tuple(parameters))
+        if self.pool.fail:
+            raise OperationalError('Failed.')
+        self._rows = self.pool.results[tuple(parameters)]
+    
+    def fetchmany(self, size):
+        rows = self._rows[:size]
+        self._rows = self._rows[size:]
+        return rows
+    
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+    
+    def cursor(self):
+        return FakeCursor(self.pool)
+
+class FakePool:
+    """Runs every statement on a fake connection, returning the rows of
+    results[parameters] and recording the statements executed. At most size
+    connections are handed out at once.
+    """
+    def __init__(self, results, size=2, fail=False):
+        self.size = size
+        self.results = results
+        self.fail = fail
+        self.executed = []
+        self.released = 0
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+    
+    def acquire(self, timeout=None, cancel=None):
+        self._condition.acquire()
+        try:
+            while self._in_use >= self.size:
+                if cancel is not None and cancel.isSet():
+                    raise OperationalError('Cancelled.')
+                self._condition.wait(0.01)
+            self._in_use += 1
+        finally:
+            self._condition.release()
+        return FakeConnection(self)
+    
+    def release(self, connection):
+        self._condition.acquire()
+        try:
+            self.released += 1
+            self._in_use -= 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+    
+    def record(self, operation, parameters):
+        self._lock.acquire()
+        self.executed.append((operation, parameters))
+        self._lock.release()
+
+class KeyRangesTest(unittest.TestCase):
+    def test_partitions(self):
+        self.assertEqual(KeyRanges('"Id"', (100, 200, 300)).partitions(), [
+            ('"Id" < ?', (100,)),
+            ('"Id" >= ? AND "Id" < ?', (100, 200)),
+            ('"Id" >= ? AND "Id" < ?', (200, 300)),
+            ('"Id" >= ?', (300,)),
+            ])
+    
+    def test_single_boundary(self):
+        self.assertEqual(KeyRanges('a', [5]).partitions(), [
+            ('a < ?', (5,)),
+            ('a >= ?', (5,)),
+            ])
+    
+    def test_invalid_boundaries(self):
+        self.assertRaises(ProgrammingError, KeyRanges, 'a', ())
+        self.assertRaises(ProgrammingError, KeyRanges, 'a', (2, 1))
+        self.assertRaises(ProgrammingError, KeyRanges, 'a', (1, 1))
+
+class ModuloTest(unittest.TestCase):
+    def test_partitions(self):
+        self.assertEqual(Modulo('"Id"', 3).partitions(), [
+            ('{fn MOD({fn ABS("Id")}, 3)} = 0', ()),
+            ('{fn MOD({fn ABS("Id")}, 3)} = 1', ()),
+            ('{fn MOD({fn ABS("Id")}, 3)} = 2', ()),
+            ])
+    
+    def test_invalid_count(self):
+        self.assertRaises(ProgrammingError, Modulo, 'a', 0)
+
+class ParallelReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = FakePool({
+            ('x', 1): [(1,), (2,), (3,)],
+            ('x', 1, 3): [(3,), (4,)],
+            ('x', 3): [(5,)],
+            })
+    
+    def test_statements(self):
+        reader = read(self.pool, 'SELECT * FROM t WHERE b = ?',
+            KeyRanges('a', (1, 3)), ('x',), batch_size=2)
+        self.assertEqual(list(reader), [(1,), (2,), (3,), (3,), (4,), (5,)])
+        self.assertEqual(sorted(self.pool.executed), sorted([
+            ('SELECT * FROM (SELECT * FROM t WHERE b = ?) odbtp_partition '
+                'WHERE a < ?', ('x', 1)),
+            ('SELECT * FROM (SELECT * FROM t WHERE b = ?) odbtp_partition '
+                'WHERE a >= ? AND a < ?', ('x', 1, 3)),
+            ('SELECT * FROM (SELECT * FROM t WHERE b = ?) odbtp_partition '
+                'WHERE a >= ?', ('x', 3)),
+            ]))
+        self.assertEqual(self.pool.released, 3)
+        self.assertEqual(reader.description[0][0], 'id')
+        self.assertEqual([timing.rows for timing in reader.timings],
+            [3, 2, 1])
+    
+    def test_unordered(self):
+        reader = read(self.pool, 'SELECT * FROM t WHERE b = ?',
+            KeyRanges('a', (1, 3)), ('x',), ordered=False, batch_size=1)
+        self.assertEqual(sorted(reader), [(1,), (2,), (3,), (3,), (4,), (5,)])
+    
+    def test_more_workers_than_connections(self):
+        partitioning = KeyRanges('a', range(1, 8))
+        results = {}
+        for index, (condition, params) in enumerate(
+                partitioning.partitions()):
+            results[params] = [(index,)] * 5
+        pool = FakePool(results, size=1)
+        result = []
+        def consume():
+            reader = read(pool, 'SELECT * FROM t', partitioning,
+                batch_size=1, max_batches=1, workers=6)
+            result.extend(reader)
+        thread = threading.Thread(target=consume)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(10)
+        self.failIf(thread.isAlive(), 'The reader did not finish.')
+        self.assertEqual(len(result), 40)
+        self.assertEqual(result, sorted(result))
+    
+    def test_errors_are_raised(self):
+        self.pool.fail = True
+        reader = read(self.pool, 'SELECT * FROM t', Modulo('a', 2))
+        self.assertRaises(OperationalError, list, reader)
+
+if __name__ == '__main__':
+    unittest.main()
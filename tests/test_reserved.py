@@ -0,0 +1,83 @@
+"""Tests for odbtp.reserved.
+"""
+
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from odbtp.errors import *
+from odbtp.reserved import ReservationRegistry
+
+SOURCE = ('gateway', 2799, 'DSN=ORDERS;PWD=secret')
+
+class ReservationRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'reserved.json')
+        self.registry = ReservationRegistry(self.filename)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_life_cycle(self):
+        self.assertEqual(self.registry.checkout(*SOURCE), None)
+        self.registry.attach(*SOURCE + ('C1',))
+        self.assertEqual(self.registry.entries(*SOURCE),
+            [('C1', os.getpid())])
+        self.assertEqual(self.registry.checkout(*SOURCE), None)
+        
+        self.registry.checkin(*SOURCE + ('C1',))
+        self.assertEqual(self.registry.entries(*SOURCE), [('C1', None)])
+        self.assertEqual(self.registry.checkout(*SOURCE), 'C1')
+        self.assertEqual(self.registry.entries(*SOURCE),
+            [('C1', os.getpid())])
+        
+        self.registry.discard(*SOURCE + ('C1',))
+        self.assertEqual(self.registry.entries(*SOURCE), [])
+    
+    def test_data_sources_are_separate(self):
+        self.registry.checkin(*SOURCE + ('C1',))
+        self.assertEqual(
+            self.registry.checkout('gateway', 2799, 'DSN=OTHER'),
+            None
+            )
+        self.assertEqual(self.registry.checkout('other', 2799, SOURCE[2]),
+            None)
+        self.assertEqual(self.registry.checkout(*SOURCE), 'C1')
+    
+    def test_file(self):
+        self.registry.checkin(*SOURCE + ('C1',))
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode),
+            0600)
+        self.failIf('secret' in open(self.filename).read())
+    
+    def test_dead_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.registry.attach(*SOURCE + ('C1',))
+        self.registry.attach(*SOURCE + ('C2',))
+        registry = ReservationRegistry(self.filename)
+        def give_to_dead_process(entries):
+            entries[0][1] = pid
+        registry._update(*SOURCE + (give_to_dead_process,))
+        self.assertEqual(self.registry.checkout(*SOURCE), 'C1')
+        self.assertEqual(self.registry.checkout(*SOURCE), None)
+    
+    def test_corrupt_file(self):
+        stream = open(self.filename, 'w')
+        stream.write('{not json')
+        stream.close()
+        self.assertRaises(InterfaceError, self.registry.checkout, *SOURCE)
+    
+    def test_symbolic_link(self):
+        target = os.path.join(self.directory, 'target')
+        open(target, 'w').close()
+        os.symlink(target, self.filename)
+        self.assertRaises(OSError, self.registry.checkout, *SOURCE)
+
+if __name__ == '__main__':
+    unittest.main()
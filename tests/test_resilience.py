@@ -0,0 +1,143 @@
+"""Tests for odbtp.resilience.
+"""
+
+import time
+import unittest
+
+from odbtp import resilience
+from odbtp.errors import *
+from odbtp.constants import *
+from odbtp.resilience import CircuitBreaker, RetryPolicy
+
+def make_error(odbtp_error, error_class=OperationalError):
+    error = error_class('Error %d' % odbtp_error)
+    error.odbtp_error = odbtp_error
+    return error
+
+class FakeLogin:
+    """Raises the given errors in turn, and then returns 'session'.
+    """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+    
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'session'
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+    
+    def time(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class FakeRandom:
+    def uniform(self, low, high):
+        return high
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        resilience.time = self.time
+        self.policy = RetryPolicy(max_attempts=3, base_delay=0.5,
+            max_delay=1.5, failure_threshold=4, reset_time=30.0,
+            rng=FakeRandom())
+    
+    def tearDown(self):
+        resilience.time = time
+    
+    def test_retries_connect_errors(self):
+        login = FakeLogin(make_error(ODBTPERR_CONNECT),
+            make_error(ODBTPERR_CONNECT))
+        self.assertEqual(self.policy.login('db', 2799, login), 'session')
+        self.assertEqual(login.calls, 3)
+        self.assertEqual(self.time.sleeps, [0.5, 1.0])
+        self.assertEqual(self.policy.get_breaker('db', 2799).failures, 0)
+    
+    def test_gives_up(self):
+        login = FakeLogin(*[make_error(ODBTPERR_CONNECT)] * 3)
+        self.assertRaises(OperationalError, self.policy.login, 'db', 2799,
+            login)
+        self.assertEqual(login.calls, 3)
+        self.assertEqual(len(self.time.sleeps), 2)
+    
+    def test_other_errors_are_not_retried(self):
+        login = FakeLogin(make_error(ODBTPERR_RESPONSE))
+        self.assertRaises(OperationalError, self.policy.login, 'db', 2799,
+            login)
+        self.assertEqual(login.calls, 1)
+        login = FakeLogin(ValueError('x'))
+        self.assertRaises(ValueError, self.policy.login, 'db', 2799, login)
+        self.assertEqual(self.policy.get_breaker('db', 2799).failures, 0)
+    
+    def test_delays(self):
+        self.assertEqual(
+            [self.policy.get_delay(attempt) for attempt in range(1, 5)],
+            [0.5, 1.0, 1.5, 1.5]
+            )
+    
+    def test_breaker_opens_and_probes(self):
+        self.assertRaises(OperationalError, self.policy.login, 'db', 2799,
+            FakeLogin(*[make_error(ODBTPERR_CONNECT)] * 3))
+        self.assertRaises(OperationalError, self.policy.login, 'db', 2799,
+            FakeLogin(make_error(ODBTPERR_CONNECT)))
+        breaker = self.policy.get_breaker('db', 2799)
+        self.failIf(breaker.opened_at is None)
+        
+        login = FakeLogin()
+        self.assertRaises(OperationalError, self.policy.login, 'db', 2799,
+            login)
+        self.assertEqual(login.calls, 0)
+        self.assertEqual(self.policy.login('other', 2799, login), 'session')
+        
+        self.time.now += 30
+        self.assertEqual(self.policy.login('db', 2799, login), 'session')
+        self.failUnless(breaker.opened_at is None)
+    
+    def test_aborted_probe_does_not_block(self):
+        breaker = self.policy.get_breaker('db', 2799)
+        for attempt in range(4):
+            breaker.failed()
+        self.time.now += 30
+        self.assertRaises(KeyboardInterrupt, self.policy.login, 'db', 2799,
+            FakeLogin(KeyboardInterrupt()))
+        self.assertEqual(self.policy.login('db', 2799, FakeLogin()),
+            'session')
+    
+    def test_is_transport_error(self):
+        self.failUnless(self.policy.is_transport_error(
+            make_error(ODBTPERR_DISCONNECTED)))
+        self.failIf(self.policy.is_transport_error(
+            make_error(ODBTPERR_CONNECT)))
+        self.failIf(self.policy.is_transport_error(ValueError()))
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_single_probe(self):
+        clock = FakeTime()
+        resilience.time = clock
+        try:
+            breaker = CircuitBreaker(failure_threshold=1, reset_time=10)
+            breaker.failed()
+            self.assertRaises(OperationalError, breaker.before_login)
+            clock.now += 10
+            breaker.before_login()
+            self.assertRaises(OperationalError, breaker.before_login)
+            breaker.failed()
+            self.assertRaises(OperationalError, breaker.before_login)
+            clock.now += 10
+            breaker.before_login()
+            breaker.succeeded()
+            breaker.before_login()
+        finally:
+            resilience.time = time
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""Tests for odbtp.resultcache.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from odbtp.errors import *
+from odbtp.resultcache import SharedResultCache, CachedRows
+
+class FakeConnection:
+    def __init__(self, connect_string='DSN=TEST'):
+        self.server = 'localhost'
+        self.port = 2799
+        self._connect_string = connect_string
+
+class FakeCursor:
+    """Returns the rows of results[operation], counting the executions.
+    """
+    def __init__(self, results, connection=None):
+        self.connection = connection or FakeConnection()
+        self.results = results
+        self.executed = []
+        self.description = None
+        self._rows = None
+    
+    def execute(self, operation, parameters=()):
+        self.executed.append((operation, tuple(parameters)))
+        self.description = [('a', 1, None, None, None, None, None)]
+        self._rows = self.results[operation]
+    
+    def fetchall(self):
+        return list(self._rows)
+
+class SharedResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'results')
+        self.cache = SharedResultCache(self.filename, size=4096, slots=8)
+        self.rows = [(index, 'row %d' % index) for index in range(20)]
+        self.cursor = FakeCursor({
+            'SELECT 1': self.rows,
+            'SELECT 2': [(None, u'x')],
+            'SELECT big': [('x' * 8192,)],
+            'SELECT object': [(object(),)],
+            })
+    
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+    
+    def test_miss_then_hit(self):
+        first = self.cache.fetchall(self.cursor, 'SELECT 1')
+        second = self.cache.fetchall(self.cursor, 'SELECT 1')
+        self.assertEqual(len(self.cursor.executed), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.failUnless(isinstance(second, CachedRows))
+        self.assertEqual(list(first), self.rows)
+        self.assertEqual(list(second), self.rows)
+        self.assertEqual(second[-1], self.rows[-1])
+        self.assertEqual(second[2:5], self.rows[2:5])
+        self.assertEqual(second.description[0][:2], ('a', 1))
+    
+    def test_keys(self):
+        self.cache.fetchall(self.cursor, 'SELECT 1', (1,))
+        self.cache.fetchall(self.cursor, 'SELECT 1', (2,))
+        other = FakeCursor(self.cursor.results, FakeConnection('DSN=OTHER'))
+        self.cache.fetchall(other, 'SELECT 1', (1,))
+        self.assertEqual(len(self.cursor.executed), 2)
+        self.assertEqual(len(other.executed), 1)
+    
+    def test_shared_between_objects(self):
+        self.cache.fetchall(self.cursor, 'SELECT 2')
+        cache = SharedResultCache(self.filename)
+        try:
+            rows = cache.fetchall(self.cursor, 'SELECT 2')
+            self.assertEqual(list(rows), [(None, u'x')])
+            self.assertEqual(cache.hits, 1)
+        finally:
+            cache.close()
+        self.assertEqual(len(self.cursor.executed), 1)
+    
+    def test_expiry(self):
+        self.cache.fetchall(self.cursor, 'SELECT 1', ttl=-1)
+        self.cache.fetchall(self.cursor, 'SELECT 1')
+        self.assertEqual(len(self.cursor.executed), 2)
+    
+    def test_invalidate(self):
+        rows = self.cache.fetchall(self.cursor, 'SELECT 1')
+        self.cache.fetchall(self.cursor, 'SELECT 2')
+        self.cache.invalidate(self.cursor.connection, 'SELECT 1')
+        self.assertRaises(InterfaceError, lambda: rows[0])
+        self.cache.fetchall(self.cursor, 'SELECT 2')
+        self.assertEqual(len(self.cursor.executed), 2)
+        self.cache.invalidate()
+        self.cache.fetchall(self.cursor, 'SELECT 2')
+        self.assertEqual(len(self.cursor.executed), 3)
+    
+    def test_replaced_view(self):
+        rows = self.cache.fetchall(self.cursor, 'SELECT 1')
+        self.cache.invalidate(self.cursor.connection, 'SELECT 1')
+        self.cache.fetchall(self.cursor, 'SELECT 1', ttl=600)
+        self.assertRaises(InterfaceError, list, rows)
+    
+    def test_eviction(self):
+        views = [self.cache.fetchall(self.cursor, 'SELECT 1', (index,))
+            for index in range(20)]
+        self.assertRaises(InterfaceError, lambda: views[0][0])
+        self.assertEqual(list(views[-1]), self.rows)
+    
+    def test_uncacheable_results(self):
+        rows = self.cache.fetchall(self.cursor, 'SELECT big')
+        self.assertEqual(list(rows), [('x' * 8192,)])
+        rows = self.cache.fetchall(self.cursor, 'SELECT object')
+        self.failUnless(isinstance(rows, list))
+        self.cache.fetchall(self.cursor, 'SELECT object')
+        self.assertEqual(len(self.cursor.executed), 3)
+    
+    def test_closed(self):
+        self.cache.close()
+        self.assertRaises(InterfaceError, self.cache.fetchall, self.cursor,
+            'SELECT 1')
+
+if __name__ == '__main__':
+    unittest.main()
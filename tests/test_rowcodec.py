@@ -0,0 +1,65 @@
+"""Tests for odbtp.rowcodec.
+"""
+
+import unittest
+from datetime import date, time, datetime
+from decimal import Decimal
+
+from odbtp.errors import *
+from odbtp.types import Binary
+from odbtp.rowcodec import encode_row, decode_row
+
+class RowCodecTest(unittest.TestCase):
+    def round_trip(self, row):
+        data = encode_row(row)
+        decoded, offset = decode_row(data)
+        self.assertEqual(offset, len(data))
+        return decoded
+    
+    def test_values(self):
+        row = (
+            None,
+            'text',
+            u'\u20ac uro',
+            Decimal('-12.340'),
+            True,
+            7,
+            -2**63,
+            2**64 - 1,
+            1.25,
+            date(2010, 3, 4),
+            time(5, 6, 7, 890),
+            datetime(2010, 3, 4, 5, 6, 7, 890),
+            )
+        self.assertEqual(self.round_trip(row), row)
+    
+    def test_types_are_kept(self):
+        row = self.round_trip((Binary('\x00\xff'), u'a', True, datetime(
+            2010, 1, 1)))
+        self.failUnless(isinstance(row[0], Binary))
+        self.failUnless(isinstance(row[1], unicode))
+        self.failUnless(row[2] is True)
+        self.failUnless(isinstance(row[3], datetime))
+    
+    def test_empty_row(self):
+        self.assertEqual(self.round_trip(()), ())
+    
+    def test_subclasses(self):
+        class Name(str):
+            pass
+        self.assertEqual(self.round_trip((Name('a'),)), ('a',))
+    
+    def test_consecutive_rows(self):
+        data = 'xx' + encode_row((1, 'a')) + encode_row((None,))
+        first, offset = decode_row(data, 2)
+        second, offset = decode_row(data, offset)
+        self.assertEqual((first, second), ((1, 'a'), (None,)))
+        self.assertEqual(offset, len(data))
+    
+    def test_unsupported_values(self):
+        self.assertRaises(DataError, encode_row, (object(),))
+        self.assertRaises(DataError, encode_row, (2**64,))
+        self.assertRaises(DataError, encode_row, (-2**63 - 1,))
+
+if __name__ == '__main__':
+    unittest.main()
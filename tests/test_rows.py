@@ -0,0 +1,98 @@
+"""Tests for odbtp.rows.
+"""
+
+import struct
+import pickle
+import unittest
+from ctypes import create_string_buffer
+from decimal import Decimal
+
+from odbtp.errors import *
+from odbtp.constants import *
+from odbtp.rows import DecodePlan, LazyRow, BUFFER_PADDING
+
+DESCRIPTION = [
+    ('id', ODB_INT, None, None, None, None, None),
+    ('name', ODB_CHAR, None, None, None, None, None),
+    ('price', ODB_NUMERIC, None, None, None, None, None),
+    ('id', ODB_CHAR, None, None, None, None, None),
+    ]
+
+def make_row(plan, values):
+    """Make a LazyRow from the raw data of each value, or None for nulls.
+    """
+    data = ''.join([value or '' for value in values])
+    data_buffer = create_string_buffer(data, len(data) + BUFFER_PADDING)
+    layout = []
+    offset = 0
+    for value in values:
+        if value is None:
+            layout.extend((offset, -1))
+        else:
+            layout.extend((offset, len(value)))
+            offset += len(value)
+    return LazyRow(plan, data_buffer, tuple(layout))
+
+class LazyRowTest(unittest.TestCase):
+    def setUp(self):
+        self.plan = DecodePlan(DESCRIPTION)
+        self.row = make_row(self.plan,
+            [struct.pack('i', 42), 'widget', '9.50', None])
+        self.values = (42, 'widget', Decimal('9.50'), None)
+    
+    def test_sequence(self):
+        row = self.row
+        self.assertEqual(len(row), 4)
+        self.assertEqual(row[0], 42)
+        self.assertEqual(row[-2], Decimal('9.50'))
+        self.assertEqual(row[1:3], ('widget', Decimal('9.50')))
+        self.assertEqual(tuple(row), self.values)
+        self.failUnless('widget' in row)
+        self.assertEqual(row.index(None), 3)
+        self.assertEqual(row.count(42), 1)
+        self.assertRaises(IndexError, lambda: row[4])
+        self.assertRaises(TypeError, lambda: row[1.0])
+    
+    def test_names(self):
+        row = self.row
+        self.assertEqual(row['name'], 'widget')
+        # The first of several columns with the same name is used.
+        self.assertEqual(row['id'], 42)
+        self.assertEqual(row.get('missing', 1), 1)
+        self.assertRaises(KeyError, lambda: row['missing'])
+        self.assertEqual(row.keys(), ['id', 'name', 'price', 'id'])
+    
+    def test_like_a_tuple(self):
+        row = self.row
+        self.assertEqual(row, self.values)
+        self.failIf(row != self.values)
+        self.failUnless(row < (43,))
+        self.assertEqual(hash(row), hash(self.values))
+        self.assertEqual(row + (1,), self.values + (1,))
+        self.assertEqual((1,) + row, (1,) + self.values)
+        self.assertEqual(repr(row), repr(self.values))
+        self.assertEqual(pickle.loads(pickle.dumps(row)), self.values)
+    
+    def test_values_are_converted_once_when_read(self):
+        calls = []
+        def convert(address, length):
+            calls.append(length)
+            return length
+        self.plan.converters = (convert,) * 4
+        self.assertEqual(self.row[1], 6)
+        self.assertEqual(self.row[1], 6)
+        self.assertEqual(calls, [6])
+        self.assertEqual(self.row[3], None)
+        self.assertEqual(calls, [6])
+    
+    def test_unknown_type(self):
+        plan = DecodePlan([('x', 12345, None, None, None, None, None)])
+        row = make_row(plan, ['data'])
+        self.assertEqual(len(row), 1)
+        self.assertRaises(DataError, lambda: row[0])
+    
+    def test_raw_size(self):
+        self.assertEqual(self.row.raw_size(), 14 + BUFFER_PADDING)
+
+if __name__ == '__main__':
+    unittest.main()
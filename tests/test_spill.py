@@ -0,0 +1,54 @@
+"""Tests for odbtp.spill.
+"""
+
+import unittest
+
+from odbtp.errors import *
+from odbtp.spill import SpilledRows, estimate_size
+
+class SpilledRowsTest(unittest.TestCase):
+    def setUp(self):
+        self.rows = [(index, 'row %d' % index, None) for index in range(50)]
+        self.spilled = SpilledRows(self.rows)
+    
+    def tearDown(self):
+        self.spilled.close()
+    
+    def test_sequence(self):
+        self.assertEqual(len(self.spilled), 50)
+        self.assertEqual(list(self.spilled), self.rows)
+        self.assertEqual(self.spilled[0], self.rows[0])
+        self.assertEqual(self.spilled[-1], self.rows[-1])
+        self.assertEqual(self.spilled[10:20:3], self.rows[10:20:3])
+        self.assertRaises(IndexError, lambda: self.spilled[50])
+        self.assertRaises(IndexError, lambda: self.spilled[-51])
+        self.assertEqual(repr(self.spilled), '<SpilledRows: 50 rows>')
+    
+    def test_append_after_reading(self):
+        self.assertEqual(self.spilled[49], self.rows[49])
+        self.spilled.append((50, u'last', 1.5))
+        self.spilled.extend([(51, 'x', None)])
+        self.assertEqual(len(self.spilled), 52)
+        self.assertEqual(self.spilled[50], (50, u'last', 1.5))
+        self.assertEqual(list(self.spilled)[-1], (51, 'x', None))
+    
+    def test_empty(self):
+        spilled = SpilledRows()
+        try:
+            self.assertEqual(len(spilled), 0)
+            self.assertEqual(list(spilled), [])
+            self.assertEqual(spilled[:], [])
+        finally:
+            spilled.close()
+    
+    def test_closed(self):
+        self.spilled.close()
+        self.assertRaises(InterfaceError, lambda: self.spilled[0])
+        self.assertRaises(InterfaceError, self.spilled.append, (1,))
+        self.spilled.close()
+    
+    def test_estimate_size(self):
+        self.failUnless(estimate_size(self.rows) > estimate_size([]))
+
+if __name__ == '__main__':
+    unittest.main()
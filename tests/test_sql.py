@@ -0,0 +1,104 @@
+"""Tests for odbtp.sql.
+"""
+
+import unittest
+
+from odbtp.errors import *
+from odbtp.sql import *
+
+class FingerprintTest(unittest.TestCase):
+    def test_literals_become_markers(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE a = 'x''y' AND b = 1.5e3"),
+            'SELECT * FROM t WHERE a = ? AND b = ?'
+            )
+    
+    def test_comments_and_whitespace(self):
+        self.assertEqual(
+            fingerprint('SELECT  a -- note\nFROM /* old */ t\n\tWHERE b=2'),
+            'SELECT a FROM t WHERE b=?'
+            )
+    
+    def test_quoted_identifiers_are_kept(self):
+        self.assertEqual(
+            fingerprint('SELECT "Col 1", [Col 2] FROM "T1"'),
+            'SELECT "Col 1", [Col 2] FROM "T1"'
+            )
+    
+    def test_value_lists_are_shortened(self):
+        self.assertEqual(
+            fingerprint('SELECT a FROM t WHERE b IN (1, 2, 3)'),
+            fingerprint('SELECT a FROM t WHERE b IN (?,?)')
+            )
+        self.assertEqual(
+            fingerprint('SELECT a FROM t WHERE b IN (?, ?)'),
+            'SELECT a FROM t WHERE b IN (?, ...)'
+            )
+
+class ClassificationTest(unittest.TestCase):
+    def test_is_query(self):
+        self.failUnless(is_query('SELECT 1'))
+        self.failUnless(is_query(' /* x */ (select a FROM t)'))
+        self.failIf(is_query('SELECT a INTO t2 FROM t'))
+        self.failIf(is_query('SELECT a FROM t FOR UPDATE'))
+        self.failIf(is_query('UPDATE t SET a = 1'))
+    
+    def test_is_dml(self):
+        self.failUnless(is_dml('INSERT INTO t VALUES (1)'))
+        self.failUnless(is_dml('-- x\ndelete FROM t'))
+        self.failIf(is_dml('SELECT 1'))
+        self.failIf(is_dml('CREATE TABLE t (a INT)'))
+    
+    def test_encode_sql(self):
+        self.assertEqual(encode_sql(u'SELECT \xe9'), 'SELECT \xc3\xa9')
+        self.assertEqual(encode_sql('SELECT 1'), 'SELECT 1')
+
+class SplitAtMarkersTest(unittest.TestCase):
+    def test_markers(self):
+        self.assertEqual(
+            split_at_markers('a = ? AND b = ?'),
+            ['a = ', ' AND b = ', '']
+            )
+    
+    def test_question_marks_that_are_not_markers(self):
+        operation = 'SELECT \'?\', "a?", [b?] /* ? */ FROM t -- ?\nWHERE c=?'
+        parts = split_at_markers(operation)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual('?'.join(parts), operation)
+
+class ExpandListsTest(unittest.TestCase):
+    def test_no_lists(self):
+        self.assertEqual(expand_lists('a = ?', (1,), 8), None)
+    
+    def test_padded_to_power_of_two(self):
+        self.assertEqual(
+            expand_lists('a IN (?) AND b = ?', ([1, 2, 3], 'x'), 8),
+            [('a IN (?, ?, ?, ?) AND b = ?', (1, 2, 3, 3, 'x'))]
+            )
+    
+    def test_padding_is_capped(self):
+        operation, params = expand_lists('a IN (?)', (range(6),), 6)[0]
+        self.assertEqual(operation.count('?'), 6)
+        self.assertEqual(params, tuple(range(6)))
+    
+    def test_chunks(self):
+        result = expand_lists('a IN (?)', (range(100),), 40)
+        self.assertEqual(len(result), 3)
+        self.assertEqual([len(params) for op, params in result], [40, 40, 32])
+        self.assertEqual(result[0][1], tuple(range(40)))
+        self.assertEqual(result[2][1], tuple(range(80, 100)) + (99,) * 12)
+    
+    def test_chunked_values_are_unique(self):
+        result = expand_lists('a IN (?)', ([1, 2, 1, 3, 2],), 2)
+        self.assertEqual([params for op, params in result], [(1, 2), (3,)])
+    
+    def test_errors(self):
+        self.assertRaises(ProgrammingError, expand_lists,
+            'a IN (?)', ([],), 8)
+        self.assertRaises(ProgrammingError, expand_lists,
+            'a IN (?) AND b = ?', ([1],), 8)
+        self.assertRaises(NotSupportedError, expand_lists,
+            'a IN (?) AND b IN (?)', (range(3), range(3)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
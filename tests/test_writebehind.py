@@ -0,0 +1,227 @@
+"""Tests for the write-behind mode of odbtp.connection.Connection.
+"""
+
+import itertools
+import time
+import unittest
+
+from odbtp import connection
+from odbtp import trace
+from odbtp.connection import Connection
+from odbtp.constants import *
+from odbtp.errors import *
+
+class FakeFunction:
+    """A function of a FakeLibrary, which takes restype and argtypes like a
+    ctypes function.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.restype = None
+        self.argtypes = None
+    
+    def __call__(self, *args):
+        return self.function(*args)
+
+class FakeLibrary:
+    """Stands in for the ODBTP client library.
+    
+    Every statement of a batch reports a row count of its position in the
+    batch plus one. If fail_at is set, the statement at that position
+    fails. Functions with nothing to fake succeed.
+    """
+    def __init__(self):
+        self.handles = itertools.count(1)
+        self.errors = {}
+        self.prepared = {}
+        self.results = {}
+        self.executed = []
+        self.parameters = []
+        self.fail_at = None
+    
+    def __getattr__(self, name):
+        if not name.startswith('odb'):
+            raise AttributeError(name)
+        function = FakeFunction(getattr(self, '_' + name, self._succeed))
+        self.__dict__[name] = function
+        return function
+    
+    def _succeed(self, *args):
+        return 1
+    
+    def _odbAllocate(self, handle):
+        return self.handles.next()
+    
+    def _odbGetError(self, handle):
+        return self.errors.get(handle, ODBTPERR_NONE)
+    
+    def _odbGetErrorText(self, handle):
+        return ''
+    
+    def _odbPrepare(self, handle, sql):
+        self.prepared[handle] = sql
+        return 1
+    
+    def _odbExecute(self, handle, sql):
+        if sql is None:
+            sql = self.prepared[handle]
+        self.executed.append(sql)
+        self.results[handle] = [0, len(sql.split(';\n'))]
+        return self._check(handle)
+    
+    def _odbGetRowCount(self, handle):
+        return self.results[handle][0] + 1
+    
+    def _odbFetchNextResult(self, handle):
+        self.results[handle][0] += 1
+        return self._check(handle)
+    
+    def _odbNoData(self, handle):
+        position, total = self.results[handle]
+        return position >= total
+    
+    def _odbGetTotalCols(self, handle):
+        return 0
+    
+    def _odbSetParamLongLong(self, handle, column, value, final):
+        self.parameters.append(value.value)
+        return 1
+    
+    def _odbSetParamText(self, handle, column, value, final):
+        self.parameters.append(value.value)
+        return 1
+    
+    def _check(self, handle):
+        if self.results[handle][0] == self.fail_at:
+            self.errors[handle] = ODBTPERR_RESPONSE
+            return 0
+        return 1
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+    
+    def time(self):
+        return self.now
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.library = FakeLibrary()
+        trace.install(self.library)
+        self.time = FakeTime()
+        connection.time = self.time
+        self.connection = Connection('DSN=test', 'db',
+            capability_cache=None, write_behind=True, max_pending_writes=3,
+            max_write_delay=5.0)
+        self.cursor = self.connection.cursor()
+    
+    def tearDown(self):
+        self.connection.close()
+        connection.time = time
+        trace.uninstall()
+    
+    def test_queues_dml(self):
+        self.cursor.execute('INSERT INTO t VALUES (?)', (1,))
+        self.cursor.execute('DELETE FROM t WHERE a = ?', (2,))
+        self.assertEqual(self.library.executed, [])
+        self.assertEqual(len(self.connection._pending_writes), 2)
+        self.assertEqual(self.cursor.rowcount, -1)
+        self.failIf(self.connection.committed)
+    
+    def test_flush_sends_one_batch(self):
+        self.cursor.execute('INSERT INTO t VALUES (?, ?)', (1, 'a'))
+        other = self.connection.cursor()
+        other.execute('UPDATE t SET b = ? WHERE a = ?', ('b', 1))
+        self.assertEqual(self.connection.flush(), [1, 2])
+        self.assertEqual(self.library.executed, [
+            'INSERT INTO t VALUES (?, ?);\nUPDATE t SET b = ? WHERE a = ?'
+            ])
+        self.assertEqual(self.library.parameters, [1, 'a', 'b', 1])
+        self.assertEqual(self.connection.flushed_rowcounts, [1, 2])
+        self.assertEqual(self.cursor.rowcount, 1)
+        self.assertEqual(other.rowcount, 2)
+        self.assertEqual(self.connection._pending_writes, [])
+        self.assertEqual(self.connection.flush(), [])
+    
+    def test_flush_without_parameters(self):
+        self.cursor.execute('DELETE FROM t')
+        self.cursor.execute('DELETE FROM u')
+        self.connection.flush()
+        self.assertEqual(self.library.executed,
+            ['DELETE FROM t;\nDELETE FROM u'])
+        self.assertEqual(self.library.prepared, {})
+    
+    def test_flushes_at_max_pending_writes(self):
+        self.cursor.execute('DELETE FROM t WHERE a = 1')
+        self.cursor.execute('DELETE FROM t WHERE a = 2')
+        self.assertEqual(self.library.executed, [])
+        self.cursor.execute('DELETE FROM t WHERE a = 3')
+        self.assertEqual(len(self.library.executed), 1)
+        self.assertEqual(self.connection.flushed_rowcounts, [1, 2, 3])
+        self.assertEqual(self.connection._pending_writes, [])
+    
+    def test_flushes_after_max_write_delay(self):
+        self.cursor.execute('DELETE FROM t WHERE a = 1')
+        self.time.now += 4.9
+        self.cursor.execute('DELETE FROM t WHERE a = 2')
+        self.assertEqual(self.library.executed, [])
+        self.time.now += 0.1
+        self.cursor.execute('DELETE FROM t WHERE a = 3')
+        self.assertEqual(len(self.library.executed), 1)
+        # The delay is counted again from the next statement queued.
+        self.cursor.execute('DELETE FROM t WHERE a = 4')
+        self.time.now += 4.9
+        self.cursor.execute('DELETE FROM t WHERE a = 5')
+        self.assertEqual(len(self.library.executed), 1)
+    
+    def test_flushes_on_commit(self):
+        self.cursor.execute('DELETE FROM t')
+        self.connection.commit()
+        self.assertEqual(self.library.executed, ['DELETE FROM t'])
+        self.failUnless(self.connection.committed)
+    
+    def test_flushes_before_other_statements(self):
+        self.cursor.execute('DELETE FROM t')
+        self.cursor.execute('CREATE TABLE u (a INT)')
+        self.assertEqual(self.library.executed,
+            ['DELETE FROM t', 'CREATE TABLE u (a INT)'])
+    
+    def test_rollback_discards(self):
+        self.cursor.execute('DELETE FROM t')
+        self.connection.rollback()
+        self.assertEqual(self.connection._pending_writes, [])
+        self.connection.commit()
+        self.assertEqual(self.library.executed, [])
+    
+    def test_failed_flush(self):
+        self.cursor.execute('DELETE FROM t WHERE a = 1')
+        self.cursor.execute('DELETE FROM t WHERE a = 2')
+        self.library.fail_at = 1
+        try:
+            self.connection.flush()
+        except Error, e:
+            self.assertEqual(e.statement_index, 1)
+            self.assertEqual(e.statement, 'DELETE FROM t WHERE a = 2')
+            self.assertEqual(e.rowcounts, [1])
+        else:
+            self.fail('The failed flush did not raise an error.')
+        # The queue is gone, and is not sent again.
+        self.assertEqual(self.connection._pending_writes, [])
+        self.library.fail_at = None
+        self.assertEqual(self.connection.flush(), [])
+    
+    def test_failed_first_statement(self):
+        self.cursor.execute('DELETE FROM t')
+        self.library.fail_at = 0
+        try:
+            self.cursor.execute('SELECT a FROM t')
+        except Error, e:
+            self.assertEqual(e.statement_index, 0)
+            self.assertEqual(e.statement, 'DELETE FROM t')
+            self.assertEqual(e.rowcounts, [])
+        else:
+            self.fail('The failed flush did not raise an error.')
+        self.assertEqual(self.library.executed, ['DELETE FROM t'])
+
+if __name__ == '__main__':
+    unittest.main()